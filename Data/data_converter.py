@@ -52,6 +52,17 @@ def convert_pg19_dataset(tokenizer, seq_len = 4096, end = 20):
     data = torch.cat(tokenized_prompts, dim=0).repeat(end,1)
     return TensorDataset(data)
 
+def pg19_token_counts(tokenizer, vocab_size, start = 50, end = None):
+    # occurrences of every token id in the PG-19 books [start, end), by default the ones convert_pg19_dataset leaves out
+    datasetparent = "Data/pg19/"
+    d_files = os.listdir(datasetparent)
+    dataset = load_dataset("json", data_files = [datasetparent + name for name in d_files], split = "train")
+    counts = torch.zeros(vocab_size, dtype=torch.long)
+    for i in tqdm(range(start, len(dataset) if end is None else end)):
+        tokens = tokenizer.encode(dataset[i]['text'], return_tensors="pt").flatten()
+        counts += torch.bincount(tokens, minlength=vocab_size)[:vocab_size]
+    return counts
+
 # if __name__ == "__main__":
 #     from transformers import LlamaTokenizer, DataCollatorForLanguageModeling
 #     from torch.utils.data import DataLoader, TensorDataset
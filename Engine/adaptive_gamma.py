@@ -0,0 +1,130 @@
+import torch
+
+
+class GammaController:
+    """Picks the speculation length of every round from `gammas`, the lengths the target is compiled for.
+
+    The per-token acceptance rate a is estimated online as the ratio of two EWMAs: accepted draft tokens
+    and draft tokens tried up to the first rejection. A round drafting gamma tokens then yields
+    (1 - a^(gamma + 1)) / (1 - a) tokens per row in gamma * t_draft + t_target(gamma) seconds, with the
+    draft step and target verification times also tracked as EWMAs, and the gamma with the highest
+    expected tokens per second is chosen. Every gamma is run once first to time its verification.
+    """
+    def __init__(self, gammas, momentum: float = 0.9, init_accept_rate: float = 0.7):
+        self.gammas = sorted(set(gammas))
+        self.momentum = momentum
+        self.accepted = init_accept_rate
+        self.trials = 1.0
+        self.draft_time = None
+        self.target_time = {}
+        self.counts = {gamma: 0 for gamma in self.gammas}
+
+    def _ewma(self, old, new):
+        return new if old is None else self.momentum * old + (1 - self.momentum) * new
+
+    @property
+    def accept_rate(self) -> float:
+        return min(self.accepted / max(self.trials, 1e-6), 0.999)
+
+    def expected_tokens(self, gamma: int) -> float:
+        a = self.accept_rate
+        return (1 - a ** (gamma + 1)) / (1 - a)
+
+    def expected_time(self, gamma: int) -> float:
+        return gamma * (self.draft_time or 0.0) + self.target_time[gamma]
+
+    def choose(self) -> int:
+        for gamma in self.gammas:
+            if gamma not in self.target_time:
+                return gamma
+        return max(self.gammas, key=lambda gamma: self.expected_tokens(gamma) / self.expected_time(gamma))
+
+    def update(self, gamma: int, accept_nums, draft_lens=None, draft_steps: int = None, draft_time: float = None, target_time: float = None):
+        # gamma: the length chosen for the round, accept_nums: [B] or [B, 1] tokens accepted including the bonus token,
+        # draft_lens: [B] tokens each row drafted when rows stop early (see DraftStopper), draft_steps: draft steps run
+        accept_nums = accept_nums.flatten()
+        draft_lens = torch.full_like(accept_nums, gamma) if draft_lens is None else draft_lens.flatten()
+        draft_steps = gamma if draft_steps is None else draft_steps
+        accepted = torch.minimum(accept_nums.float() - 1, draft_lens.float())
+        self.accepted = self._ewma(self.accepted, accepted.mean().item())
+        # a row tried its accepted tokens plus the rejected one, if it drafted past them
+        self.trials = self._ewma(self.trials, (accepted + (accepted < draft_lens).float()).mean().item())
+        if draft_time is not None and draft_steps > 0:
+            self.draft_time = self._ewma(self.draft_time, draft_time / draft_steps)
+        if target_time is not None:
+            self.target_time[gamma] = self._ewma(self.target_time.get(gamma), target_time)
+        self.counts[gamma] += 1
+
+    def __repr__(self):
+        return f"GammaController(accept_rate={self.accept_rate:.3f}, rounds per gamma={self.counts})"
+
+
+class DraftStopper:
+    """Per-row early stop of drafting within a round. A row stops after drafting a token whose draft
+    probability (top-1 for greedy decoding) is below `threshold`, or once the product of these probabilities
+    over the round, an estimate of the chance that the whole chain is accepted, drops below `min_accept`.
+    Rows that stopped keep running with the batch, their extra tokens are simply not verified; the round
+    ends early once every row has stopped.
+    """
+    def __init__(self, batch_size: int, device, threshold: float = 0.0, min_accept: float = 0.0):
+        self.threshold = threshold
+        self.min_accept = min_accept
+        self.active = torch.ones(batch_size, dtype=torch.bool, device=device)
+        self.accept_estimate = torch.ones(batch_size, device=device)
+        self.draft_lens = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def reset(self, gamma: int, disabled=None):
+        # disabled: [B] rows that do not speculate this round (see SpecModeTracker)
+        self.active.fill_(True)
+        self.accept_estimate.fill_(1.0)
+        self.draft_lens.fill_(gamma)
+        if disabled is not None:
+            self.active &= ~disabled
+            self.draft_lens.masked_fill_(disabled, 0)
+
+    def step(self, i: int, probs, tokens) -> bool:
+        # probs: [B, V] draft distribution of step i, tokens: [B] drafted tokens. Returns whether every row stopped.
+        confidence = probs.gather(-1, tokens.view(-1, 1)).squeeze(-1).float()
+        self.accept_estimate *= confidence
+        stop = self.active & ((confidence < self.threshold) | (self.accept_estimate < self.min_accept))
+        self.draft_lens.masked_fill_(stop, i + 1)
+        self.active &= ~stop
+        return not self.active.any()
+
+
+class SpecModeTracker:
+    """Per-row speculation on/off from recent acceptance. A row whose EWMA of accepted draft tokens per
+    round falls below `min_accept` switches to plain decoding: its draft tokens are dropped (draft_lens 0) and
+    only its own next token can be accepted in the batched target call. Every `probe_every` rounds all rows
+    speculate again, so rows whose acceptance recovers switch back.
+
+    The batch still runs as one: a disabled row goes through every draft step of the round and is verified
+    over verify_gamma + 1 positions (the longest draft of the batch), writing that much KV. Disabling a row
+    saves compute only when every row is disabled, which shrinks the round to one draft step and one verified
+    token; otherwise it protects the row's output length, not the batch's cost.
+    """
+    def __init__(self, batch_size: int, device, min_accept: float = 0.5, momentum: float = 0.8, probe_every: int = 16):
+        self.min_accept = min_accept
+        self.momentum = momentum
+        self.probe_every = probe_every
+        self.accepted = torch.full((batch_size,), float("nan"), device=device)
+        self.rounds = 0
+
+    def reset(self, slot: int = None):
+        if slot is None:
+            self.accepted.fill_(float("nan"))
+            self.rounds = 0
+        else:
+            self.accepted[slot] = float("nan")
+
+    def disabled(self):
+        self.rounds += 1
+        if self.rounds % self.probe_every == 0:
+            return torch.zeros_like(self.accepted, dtype=torch.bool)
+        return self.accepted < self.min_accept
+
+    def update(self, accept_nums, draft_lens):
+        # rows that drafted nothing this round keep their estimate
+        accepted = accept_nums.flatten().float() - 1
+        ewma = torch.where(torch.isnan(self.accepted), accepted, self.momentum * self.accepted + (1 - self.momentum) * accepted)
+        self.accepted = torch.where(draft_lens > 0, ewma, self.accepted)
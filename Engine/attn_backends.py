@@ -0,0 +1,428 @@
+import math
+from dataclasses import dataclass
+from typing import Callable
+
+import torch
+import torch.nn.functional as F
+
+# importing utils registers the flash-attn backed mylib ops
+from MagicDec.Engine.utils import flash_attn_with_kvcache, flash_attn_varlen_func, merge_attn_states
+from MagicDec.Engine.kv_cache import quantize_kv, dequantize_kv
+
+try:
+    import flashinfer
+except ImportError:
+    flashinfer = None
+
+try:
+    from MagicDec.Engine.triton_attn import gqa_decode_attention, split_kv_decode_attention, quant_decode_attention
+except ImportError:
+    gqa_decode_attention = split_kv_decode_attention = quant_decode_attention = None
+
+
+def _write_kv(k_cache, v_cache, k, v, cache_seqlens):
+    # insert new k and v to k_cache and v_cache, starting from cache_seqlens position
+    B, T = k.shape[:2]
+    positions = cache_seqlens.long().view(-1, 1) + torch.arange(T, device=k.device).unsqueeze(0)
+    batch_indices = torch.arange(B, device=k.device).view(-1, 1)
+    k_cache[batch_indices, positions] = k
+    v_cache[batch_indices, positions] = v
+    return positions
+
+def _masked_sdpa(q, k, v, mask):
+    # q: [B, T, H_q, D], k/v: [B, S, H_k, D], mask: [B, T, S] (True = attend)
+    # The rep query heads of each KV head are folded into the query length, so K/V are
+    # read once per KV head instead of being repeated rep times.
+    B, T, H_q, D = q.size()
+    H_k = k.size(2)
+    rep = H_q // H_k
+    q = q.view(B, T, H_k, rep, D).permute(0, 2, 3, 1, 4).reshape(B, H_k, rep * T, D)
+    mask = mask.unsqueeze(1).expand(-1, rep, -1, -1).reshape(B, 1, rep * T, -1)
+    y = F.scaled_dot_product_attention(q, k.transpose(1, 2), v.transpose(1, 2), attn_mask=mask)
+    return y.view(B, H_k, rep, T, D).permute(0, 3, 1, 2, 4).reshape(B, T, H_q, D)
+
+
+# Pure PyTorch reference backend, runs on any device
+torch.library.define(
+    "mylib::sdpa_func",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor k, Tensor v, Tensor cache_seqlens) -> Tensor",
+)
+
+def sdpa_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens):
+    positions = _write_kv(k_cache, v_cache, k, v, cache_seqlens)
+    mask = torch.arange(k_cache.size(1), device=q.device).view(1, 1, -1) <= positions.unsqueeze(-1)
+    return _masked_sdpa(q, k_cache, v_cache, mask)
+
+@torch.library.impl("mylib::sdpa_func", ("cpu", "cuda"))
+def sdpa_func(q, k_cache, v_cache, k, v, cache_seqlens):
+    return sdpa_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens)
+
+@torch.library.impl_abstract("mylib::sdpa_func")
+def sdpa_func_abstract(q, k_cache, v_cache, k, v, cache_seqlens):
+    return torch.empty_like(q)
+
+def sdpa_paged_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, block_table):
+    # k_cache/v_cache: [num_pages, page_size, H_k, D], block_table: [B, max_pages_per_seq]
+    B, T = q.shape[:2]
+    page_size = k_cache.size(1)
+    block_table = block_table.long()
+    positions = cache_seqlens.long().view(-1, 1) + torch.arange(T, device=q.device).unsqueeze(0)
+    pages = block_table[torch.arange(B, device=q.device).view(-1, 1), positions // page_size]
+    k_cache[pages, positions % page_size] = k
+    v_cache[pages, positions % page_size] = v
+    k_seq = k_cache[block_table].flatten(1, 2)
+    v_seq = v_cache[block_table].flatten(1, 2)
+    mask = torch.arange(k_seq.size(1), device=q.device).view(1, 1, -1) <= positions.unsqueeze(-1)
+    return _masked_sdpa(q, k_seq, v_seq, mask)
+
+torch.library.define(
+    "mylib::sdpa_paged_func",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor k, Tensor v, Tensor cache_seqlens, Tensor block_table) -> Tensor",
+)
+
+@torch.library.impl("mylib::sdpa_paged_func", ("cpu", "cuda"))
+def sdpa_paged_func(q, k_cache, v_cache, k, v, cache_seqlens, block_table):
+    return sdpa_paged_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, block_table)
+
+@torch.library.impl_abstract("mylib::sdpa_paged_func")
+def sdpa_paged_func_abstract(q, k_cache, v_cache, k, v, cache_seqlens, block_table):
+    return torch.empty_like(q)
+
+torch.library.define(
+    "mylib::sdpa_func_2",
+    "(Tensor q, Tensor k, Tensor v) -> Tensor",
+)
+
+@torch.library.impl("mylib::sdpa_func_2", ("cpu", "cuda"))
+def sdpa_func_2(q, k, v):
+    # causal mask aligned to the bottom right corner, as in flash-attn
+    T, S = q.size(1), k.size(1)
+    mask = torch.arange(S, device=q.device).view(1, -1) <= torch.arange(T, device=q.device).view(-1, 1) + (S - T)
+    return _masked_sdpa(q, k, v, mask.unsqueeze(0).expand(q.size(0), -1, -1))
+
+@torch.library.impl_abstract("mylib::sdpa_func_2")
+def sdpa_func_2_abstract(q, k, v):
+    return torch.empty_like(q)
+
+
+# FlashInfer backend. Every batch row of the contiguous cache is viewed as one page of a
+# paged cache (page_size = max_seq_length), so no copy of the cache is needed.
+# Planning happens on every call, so this backend is not CUDA graph safe: run it without --compile.
+_flashinfer_workspace = {}
+
+def _flashinfer_workspace_buffer(device):
+    if device not in _flashinfer_workspace:
+        _flashinfer_workspace[device] = torch.empty(128 * 1024 * 1024, dtype=torch.uint8, device=device)
+    return _flashinfer_workspace[device]
+
+torch.library.define(
+    "mylib::flashinfer_func",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor k, Tensor v, Tensor cache_seqlens) -> Tensor",
+)
+
+@torch.library.impl("mylib::flashinfer_func", "cuda")
+def flashinfer_func(q, k_cache, v_cache, k, v, cache_seqlens):
+    B, T, H_q, D = q.size()
+    _write_kv(k_cache, v_cache, k, v, cache_seqlens)
+    qo_indptr = torch.arange(B + 1, dtype=torch.int32, device=q.device) * T
+    kv_indptr = torch.arange(B + 1, dtype=torch.int32, device=q.device)
+    kv_indices = torch.arange(B, dtype=torch.int32, device=q.device)
+    kv_last_page_len = (cache_seqlens + T).int()
+    wrapper = flashinfer.BatchPrefillWithPagedKVCacheWrapper(_flashinfer_workspace_buffer(q.device), "NHD")
+    wrapper.plan(qo_indptr, kv_indptr, kv_indices, kv_last_page_len, H_q, k_cache.size(2), D, k_cache.size(1), causal=True, q_data_type=q.dtype)
+    y = wrapper.run(q.reshape(B * T, H_q, D), (k_cache, v_cache))
+    return y.view(B, T, H_q, D)
+
+@torch.library.impl_abstract("mylib::flashinfer_func")
+def flashinfer_func_abstract(q, k_cache, v_cache, k, v, cache_seqlens):
+    return torch.empty_like(q)
+
+torch.library.define(
+    "mylib::flashinfer_func_2",
+    "(Tensor q, Tensor k, Tensor v) -> Tensor",
+)
+
+@torch.library.impl("mylib::flashinfer_func_2", "cuda")
+def flashinfer_func_2(q, k, v):
+    B, T, H_q, D = q.size()
+    S, H_k = k.size(1), k.size(2)
+    qo_indptr = torch.arange(B + 1, dtype=torch.int32, device=q.device) * T
+    kv_indptr = torch.arange(B + 1, dtype=torch.int32, device=q.device) * S
+    wrapper = flashinfer.BatchPrefillWithRaggedKVCacheWrapper(_flashinfer_workspace_buffer(q.device), "NHD")
+    wrapper.plan(qo_indptr, kv_indptr, H_q, H_k, D, causal=True, q_data_type=q.dtype)
+    y = wrapper.run(q.reshape(B * T, H_q, D), k.reshape(B * S, H_k, D), v.reshape(B * S, H_k, D))
+    return y.view(B, T, H_q, D)
+
+@torch.library.impl_abstract("mylib::flashinfer_func_2")
+def flashinfer_func_2_abstract(q, k, v):
+    return torch.empty_like(q)
+
+
+# Grouped-query decoding: new k/v are appended to the cache and attended with grouped heads in a
+# single pass (Triton on CUDA), replacing the zero padding and lse correction of mylib::gqa_custom.
+torch.library.define(
+    "mylib::gqa_decode",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor k, Tensor v, Tensor cache_seqlens) -> Tensor",
+)
+
+@torch.library.impl("mylib::gqa_decode", "cuda")
+def gqa_decode(q, k_cache, v_cache, k, v, cache_seqlens):
+    return gqa_decode_attention(q, k_cache, v_cache, k, v, cache_seqlens)
+
+@torch.library.impl("mylib::gqa_decode", "cpu")
+def gqa_decode_cpu(q, k_cache, v_cache, k, v, cache_seqlens):
+    return sdpa_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens)
+
+@torch.library.impl_abstract("mylib::gqa_decode")
+def gqa_decode_abstract(q, k_cache, v_cache, k, v, cache_seqlens):
+    return torch.empty_like(q)
+
+
+# Split-KV (flash-decoding) attention: the cached sequence is cut into partitions whose partial
+# softmax results are computed in parallel and merged with log-sum-exp.
+def sdpa_split_kv_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, num_splits=None):
+    positions = _write_kv(k_cache, v_cache, k, v, cache_seqlens)
+    B, T, H_q, D = q.size()
+    S, H_k = k_cache.size(1), k_cache.size(2)
+    rep = H_q // H_k
+    if num_splits is None:
+        num_splits = max(1, min(16, -(-S // 2048)))
+    chunk = -(-S // num_splits)
+    q = q.view(B, T, H_k, rep, D).permute(0, 2, 3, 1, 4).reshape(B, H_k, rep * T, D).float()
+    q_pos = positions.unsqueeze(1).expand(-1, rep, -1).reshape(B, 1, rep * T, 1)
+    outs, lses = [], []
+    for start in range(0, S, chunk):
+        k_part = k_cache[:, start:start + chunk].transpose(1, 2).float()
+        v_part = v_cache[:, start:start + chunk].transpose(1, 2).float()
+        scores = q @ k_part.transpose(-1, -2) / math.sqrt(D)
+        cols = torch.arange(start, start + k_part.size(2), device=q.device).view(1, 1, 1, -1)
+        scores = scores.masked_fill(cols > q_pos, float("-inf"))
+        lse = torch.logsumexp(scores, dim=-1)
+        out = torch.softmax(scores, dim=-1) @ v_part
+        outs.append(torch.where(torch.isfinite(lse).unsqueeze(-1), out, 0.0))
+        lses.append(lse)
+    y, _ = merge_attn_states(torch.stack(outs, dim=-2), torch.stack(lses, dim=-1))
+    return y.view(B, H_k, rep, T, D).permute(0, 3, 1, 2, 4).reshape(B, T, H_q, D).to(k.dtype)
+
+torch.library.define(
+    "mylib::split_kv_decode",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor k, Tensor v, Tensor cache_seqlens) -> Tensor",
+)
+
+@torch.library.impl("mylib::split_kv_decode", "cuda")
+def split_kv_decode(q, k_cache, v_cache, k, v, cache_seqlens):
+    return split_kv_decode_attention(q, k_cache, v_cache, k, v, cache_seqlens)
+
+@torch.library.impl("mylib::split_kv_decode", "cpu")
+def split_kv_decode_cpu(q, k_cache, v_cache, k, v, cache_seqlens):
+    return sdpa_split_kv_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens)
+
+@torch.library.impl_abstract("mylib::split_kv_decode")
+def split_kv_decode_abstract(q, k_cache, v_cache, k, v, cache_seqlens):
+    return torch.empty_like(q)
+
+
+# Tree attention for token-tree verification: the new tokens attend to the whole cache and, among
+# themselves, only to their ancestors given by tree_mask [T, T]. The two parts are merged with log-sum-exp.
+def _attn_with_lse(q, k, v, mask):
+    # q: [B, T, H_q, D], k/v: [B, S, H_k, D], mask: [B, T, S]. Returns float32 out [B, T, H_q, D] and
+    # lse [B, T, H_q]; rows with nothing to attend give out = 0 and lse = -inf.
+    B, T, H_q, D = q.size()
+    H_k = k.size(2)
+    rep = H_q // H_k
+    q = q.view(B, T, H_k, rep, D).permute(0, 2, 3, 1, 4).reshape(B, H_k, rep * T, D).float()
+    mask = mask.unsqueeze(1).expand(-1, rep, -1, -1).reshape(B, 1, rep * T, -1)
+    scores = (q @ k.transpose(1, 2).float().transpose(-1, -2) / math.sqrt(D)).masked_fill(~mask, float("-inf"))
+    lse = torch.logsumexp(scores, dim=-1)
+    out = torch.softmax(scores, dim=-1) @ v.transpose(1, 2).float()
+    out = torch.where(torch.isfinite(lse).unsqueeze(-1), out, 0.0)
+    out = out.view(B, H_k, rep, T, D).permute(0, 3, 1, 2, 4).reshape(B, T, H_q, D)
+    return out, lse.view(B, H_k, rep, T).permute(0, 3, 1, 2).reshape(B, T, H_q)
+
+def tree_attn_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, tree_mask):
+    B, T = q.shape[:2]
+    if flash_attn_with_kvcache is not None and q.is_cuda:
+        out_cache, lse_cache = flash_attn_with_kvcache(q, k_cache, v_cache, cache_seqlens=cache_seqlens, causal=False, return_softmax_lse=True)
+        lse_cache = lse_cache.transpose(1, 2)
+    else:
+        mask = torch.arange(k_cache.size(1), device=q.device).view(1, 1, -1) < cache_seqlens.view(-1, 1, 1)
+        out_cache, lse_cache = _attn_with_lse(q, k_cache, v_cache, mask.expand(-1, T, -1))
+    out_tree, lse_tree = _attn_with_lse(q, k, v, tree_mask.unsqueeze(0).expand(B, -1, -1))
+    _write_kv(k_cache, v_cache, k, v, cache_seqlens)
+    y, _ = merge_attn_states(torch.stack([out_cache.float(), out_tree], dim=-2), torch.stack([lse_cache.float(), lse_tree], dim=-1))
+    return y.to(q.dtype)
+
+torch.library.define(
+    "mylib::tree_func",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor k, Tensor v, Tensor cache_seqlens, Tensor tree_mask) -> Tensor",
+)
+
+@torch.library.impl("mylib::tree_func", ("cpu", "cuda"))
+def tree_func(q, k_cache, v_cache, k, v, cache_seqlens, tree_mask):
+    return tree_attn_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, tree_mask)
+
+@torch.library.impl_abstract("mylib::tree_func")
+def tree_func_abstract(q, k_cache, v_cache, k, v, cache_seqlens, tree_mask):
+    return torch.empty_like(q)
+
+
+# Packed (varlen) prefill: the new tokens of all rows are concatenated along the sequence dimension, row b
+# owning q/k/v[:, cu_seqlens[b]:cu_seqlens[b + 1]], so rows of different lengths carry no padding.
+def _varlen_indices(lens, cu_lens, total):
+    # row and offset within the row of each of the total packed tokens
+    rows = torch.repeat_interleave(torch.arange(lens.numel(), device=lens.device), lens, output_size=total)
+    return rows, torch.arange(total, device=lens.device) - cu_lens[rows]
+
+def varlen_attn_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, cu_seqlens):
+    # q/k/v: [1, N, H, D]. The tokens of row b are written to its cache from cache_seqlens[b] on and attend
+    # causally to the first cache_seqlens[b] cached tokens and to each other.
+    N = q.size(1)
+    seqlens = (cu_seqlens[1:] - cu_seqlens[:-1]).long()
+    rows, offsets = _varlen_indices(seqlens, cu_seqlens.long(), N)
+    positions = cache_seqlens.long()[rows] + offsets
+    k_cache[rows, positions] = k[0]
+    v_cache[rows, positions] = v[0]
+    # keys of every row with new tokens (its cache prefix and the new tokens), packed the same way
+    kv_lens = torch.where(seqlens > 0, cache_seqlens.long() + seqlens, 0)
+    cu_kv = F.pad(kv_lens.cumsum(0), (1, 0))
+    kv_rows, kv_positions = _varlen_indices(kv_lens, cu_kv, int(cu_kv[-1]))
+    k_packed, v_packed = k_cache[kv_rows, kv_positions], v_cache[kv_rows, kv_positions]
+    if flash_attn_varlen_func is not None and q.is_cuda:
+        y = flash_attn_varlen_func(q[0], k_packed, v_packed, cu_seqlens.int(), cu_kv.int(), int(seqlens.max()), int(kv_lens.max()), causal=True)
+        return y.unsqueeze(0)
+    mask = (rows.view(-1, 1) == kv_rows.view(1, -1)) & (kv_positions.view(1, -1) <= positions.view(-1, 1))
+    return _masked_sdpa(q, k_packed.unsqueeze(0), v_packed.unsqueeze(0), mask.unsqueeze(0))
+
+torch.library.define(
+    "mylib::varlen_func",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor k, Tensor v, Tensor cache_seqlens, Tensor cu_seqlens) -> Tensor",
+)
+
+@torch.library.impl("mylib::varlen_func", ("cpu", "cuda"))
+def varlen_func(q, k_cache, v_cache, k, v, cache_seqlens, cu_seqlens):
+    return varlen_attn_with_kvcache(q, k_cache, v_cache, k, v, cache_seqlens, cu_seqlens)
+
+@torch.library.impl_abstract("mylib::varlen_func")
+def varlen_func_abstract(q, k_cache, v_cache, k, v, cache_seqlens, cu_seqlens):
+    return torch.empty_like(q)
+
+
+# Quantized (int8/fp8) KV cache: k/v are stored at 8 bits with per-token, per-head float32 scales
+# k_scale/v_scale [B, S, H_k] and dequantized inside attention.
+def _write_quant_kv(k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens):
+    k_q, k_s = quantize_kv(k, k_cache.dtype)
+    v_q, v_s = quantize_kv(v, v_cache.dtype)
+    # index_put is written through a uint8 view, as it is not implemented for every float8 dtype
+    _write_kv(k_cache.view(torch.uint8), v_cache.view(torch.uint8), k_q.view(torch.uint8), v_q.view(torch.uint8), cache_seqlens)
+    return _write_kv(k_scale, v_scale, k_s, v_s, cache_seqlens)
+
+def sdpa_quant_with_kvcache(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens):
+    positions = _write_quant_kv(k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens)
+    mask = torch.arange(k_cache.size(1), device=q.device).view(1, 1, -1) <= positions.unsqueeze(-1)
+    return _masked_sdpa(q, dequantize_kv(k_cache, k_scale, q.dtype), dequantize_kv(v_cache, v_scale, q.dtype), mask)
+
+torch.library.define(
+    "mylib::sdpa_quant_func",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor(c!) k_scale, Tensor(d!) v_scale, Tensor k, Tensor v, Tensor cache_seqlens) -> Tensor",
+)
+
+@torch.library.impl("mylib::sdpa_quant_func", ("cpu", "cuda"))
+def sdpa_quant_func(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens):
+    return sdpa_quant_with_kvcache(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens)
+
+@torch.library.impl_abstract("mylib::sdpa_quant_func")
+def sdpa_quant_func_abstract(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens):
+    return torch.empty_like(q)
+
+torch.library.define(
+    "mylib::quant_decode",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor(c!) k_scale, Tensor(d!) v_scale, Tensor k, Tensor v, Tensor cache_seqlens) -> Tensor",
+)
+
+@torch.library.impl("mylib::quant_decode", "cuda")
+def quant_decode(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens):
+    # the kernel only reads the first cache_seqlens tokens, so the new ones can be written first
+    _write_quant_kv(k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens)
+    return quant_decode_attention(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens)
+
+@torch.library.impl("mylib::quant_decode", "cpu")
+def quant_decode_cpu(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens):
+    return sdpa_quant_with_kvcache(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens)
+
+@torch.library.impl_abstract("mylib::quant_decode")
+def quant_decode_abstract(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens):
+    return torch.empty_like(q)
+
+
+@dataclass
+class AttnBackend:
+    """The set of mylib ops an Attention module dispatches to.
+
+    attn_with_kvcache: append k/v to the cache at cache_seqlens and attend causally (mylib::custom_func).
+    gqa_with_kvcache: same contract, used for decoding/verification when n_head != n_local_heads.
+    attn: causal attention over the given k/v, without a cache (mylib::custom_func_2).
+    decode_with_kvcache: same contract as attn_with_kvcache, used for decoding/verification when
+        n_head == n_local_heads. Defaults to attn_with_kvcache.
+    paged_attn_with_kvcache: attn_with_kvcache over a paged cache, taking an extra block_table argument.
+    quant_attn_with_kvcache: decoding/verification over a quantized cache, taking k_scale/v_scale after
+        v_cache. Prefill over a quantized cache always uses mylib::sdpa_quant_func.
+    """
+    name: str
+    attn_with_kvcache: Callable
+    gqa_with_kvcache: Callable
+    attn: Callable
+    decode_with_kvcache: Callable = None
+    paged_attn_with_kvcache: Callable = None
+    quant_attn_with_kvcache: Callable = None
+    is_available: Callable[[], bool] = lambda: True
+
+ATTN_BACKENDS = {}
+
+def register_attn_backend(backend: AttnBackend):
+    ATTN_BACKENDS[backend.name] = backend
+    return backend
+
+register_attn_backend(AttnBackend(
+    name="flash_attn",
+    attn_with_kvcache=torch.ops.mylib.custom_func,
+    gqa_with_kvcache=torch.ops.mylib.gqa_decode if gqa_decode_attention is not None else torch.ops.mylib.gqa_custom,
+    attn=torch.ops.mylib.custom_func_2,
+    paged_attn_with_kvcache=torch.ops.mylib.paged_func,
+    quant_attn_with_kvcache=torch.ops.mylib.quant_decode if quant_decode_attention is not None else torch.ops.mylib.sdpa_quant_func,
+    is_available=lambda: flash_attn_with_kvcache is not None and torch.cuda.is_available(),
+))
+register_attn_backend(AttnBackend(
+    name="flashinfer",
+    attn_with_kvcache=torch.ops.mylib.flashinfer_func,
+    gqa_with_kvcache=torch.ops.mylib.flashinfer_func,
+    attn=torch.ops.mylib.flashinfer_func_2,
+    paged_attn_with_kvcache=torch.ops.mylib.sdpa_paged_func,
+    quant_attn_with_kvcache=torch.ops.mylib.sdpa_quant_func,
+    is_available=lambda: flashinfer is not None and torch.cuda.is_available(),
+))
+register_attn_backend(AttnBackend(
+    name="flash_decoding",
+    attn_with_kvcache=torch.ops.mylib.custom_func,
+    gqa_with_kvcache=torch.ops.mylib.split_kv_decode,
+    attn=torch.ops.mylib.custom_func_2,
+    decode_with_kvcache=torch.ops.mylib.split_kv_decode,
+    paged_attn_with_kvcache=torch.ops.mylib.paged_func,
+    quant_attn_with_kvcache=torch.ops.mylib.quant_decode,
+    is_available=lambda: flash_attn_with_kvcache is not None and split_kv_decode_attention is not None and torch.cuda.is_available(),
+))
+register_attn_backend(AttnBackend(
+    name="sdpa",
+    attn_with_kvcache=torch.ops.mylib.sdpa_func,
+    gqa_with_kvcache=torch.ops.mylib.sdpa_func,
+    attn=torch.ops.mylib.sdpa_func_2,
+    paged_attn_with_kvcache=torch.ops.mylib.sdpa_paged_func,
+    quant_attn_with_kvcache=torch.ops.mylib.sdpa_quant_func,
+))
+
+def get_attn_backend(name: str = None, device: str = "cuda") -> AttnBackend:
+    if name is None:
+        name = "flash_attn" if ("cuda" in str(device) and ATTN_BACKENDS["flash_attn"].is_available()) else "sdpa"
+    assert name in ATTN_BACKENDS, f"Unknown attention backend {name}, choose from {list(ATTN_BACKENDS.keys())}"
+    backend = ATTN_BACKENDS[name]
+    assert backend.is_available(), f"Attention backend {name} is not available on this machine"
+    return backend
@@ -1,28 +1,43 @@
 import torch
-from MagicDec.Engine.model import Transformer
+from MagicDec.Engine.model import Transformer, KVCache
 from MagicDec.Engine.utils import load_model
+from MagicDec.Engine.attn_backends import get_attn_backend
+from MagicDec.Engine.tree import SpecTree
+from MagicDec.Engine.kv_cache import BlockManager, slot_caches
 
 class LMBackend:
-    def __init__(self, dtype = torch.bfloat16, device: str = "cuda:0", dec_list: list = [1]) -> None:
+    def __init__(self, dtype = torch.bfloat16, device: str = "cuda:0", dec_list: list = [1], attn_backend: str = None) -> None:
         self.dtype = dtype
         self.device = device
+        self.attn_backend = get_attn_backend(attn_backend, device)
         self.model_forward = {}
         for dec_len in dec_list:
             if dec_len == 0: continue
             self.model_forward[dec_len] = lambda model, x, input_pos, cache_seqlens: model(x, input_pos, cache_seqlens)
+        self.tree_forward = lambda model, x, input_pos, cache_seqlens, tree_mask: model(x, input_pos, cache_seqlens, tree_mask)
         self.prefill = lambda model, x, input_pos, cache_seqlens: model.prefill(x, input_pos, cache_seqlens)
         self.cachelens = None
+        self.block_manager = None
 
     def load_model(self, checkpoints: str, use_tp: bool, rank_group=None, group = None):
         self.model: Transformer = load_model(checkpoint_path=checkpoints, device=self.device, precision=self.dtype, use_tp= use_tp, rank_group=rank_group, group = group)
+        self.model.set_attn_backend(self.attn_backend)
 
     @torch.inference_mode()
-    def setup_caches(self, max_batch_size: int = 1, max_seq_length: int = 2048):
+    def setup_caches(self, max_batch_size: int = 1, max_seq_length: int = 2048, page_size: int = None, num_pages: int = None, kv_quant: str = None, offload_layers: int = 0):
+        # offload_layers: keep the KV of the last offload_layers layers in host memory, streamed in layer by layer
         self.max_length = max_seq_length
         self.batch_size = max_batch_size
         self.cachelens = torch.zeros(max_batch_size, dtype=torch.int32, device=self.device)
+        # every prefill chunk streams the whole offloaded KV in, so offloading prefills in larger chunks
+        self.prefill_chunk_size = 32 if offload_layers == 0 else 4096
         with torch.device(self.device):
-            self.model.setup_caches(max_batch_size=max_batch_size, max_seq_length=max_seq_length)
+            self.model.setup_caches(max_batch_size=max_batch_size, max_seq_length=max_seq_length, page_size=page_size, num_pages=num_pages, kv_quant=kv_quant, offload_layers=offload_layers)
+        if page_size is not None:
+            # the last page of the pool is the scratch page
+            self.block_manager = BlockManager(self.model.block_table, self.model.layers[0].attention.kv_cache.k_cache.size(0) - 1, page_size)
+            # paged sequences are bounded by their block table, not max_seq_length
+            self.max_length = min(self.block_manager.max_tokens_per_seq(), self.model.config.block_size)
 
     def compile(self, encode=False):
         import torch._dynamo.config
@@ -32,12 +47,14 @@ class LMBackend:
         torch._inductor.config.fx_graph_cache = True # Experimental feature to reduce compilation times, will be on by default in future
         for key in self.model_forward.keys():
             self.model_forward[key] = torch.compile(self.model_forward[key], mode="reduce-overhead", fullgraph=True)
+        self.tree_forward = torch.compile(self.tree_forward, mode="reduce-overhead", fullgraph=True)
         if encode:
              self.prefill = torch.compile(self.prefill, mode="reduce-overhead", fullgraph=True)      
              
     @torch.inference_mode()
     def inference(self, input_ids: torch.LongTensor, benchmark = False):
             dec_len = input_ids.shape[1]
+            # a paged cache must already have pages for the dec_len new tokens of every decoding row, see reserve
             position_ids = self.cachelens.view(-1,1) + torch.arange(dec_len, device=self.device).unsqueeze(0).repeat(self.batch_size,1)
             logits = self.model_forward[dec_len](
                 model=self.model, 
@@ -49,23 +66,90 @@ class LMBackend:
             return logits
     
     @torch.inference_mode()
-    def encode(self, input_ids: torch.LongTensor):
+    def tree_inference(self, input_ids: torch.LongTensor, tree: SpecTree):
+        """Verify a token tree ([B, tree.size] node tokens) in one forward pass, each node at position
+        cachelens + its depth. cachelens is left unchanged until commit_tree_path."""
+        assert self.block_manager is None and self.model.kv_offload is None and not hasattr(self.model.layers[0].attention.kv_cache, "k_scale"), "Tree verification needs the plain KV cache"
+        position_ids = self.cachelens.view(-1,1) + tree.depths.view(1,-1)
+        return self.tree_forward(
+            model=self.model,
+            x=input_ids.clone(),
+            input_pos=position_ids.clone(),
+            cache_seqlens=self.cachelens.clone(),
+            tree_mask=tree.mask)
+
+    @torch.inference_mode()
+    def commit_tree_path(self, path: torch.LongTensor, accept_nums: torch.LongTensor):
+        # keep the KV of the accepted path ([B, depth + 1] node indices, accept_nums valid per row)
+        self.model.commit_tree_path(self.cachelens, path)
+        self.cachelens += accept_nums.to(self.cachelens.dtype)
+
+    @torch.inference_mode()
+    def encode(self, input_ids: torch.LongTensor, seqlens: torch.LongTensor = None):
+        """Prefill a batch of prompts into empty caches. With seqlens [B] the prompt of row b is
+        input_ids[b, :seqlens[b]] (the rest is ignored) and the logits [B, 1, vocab] of the last prompt token
+        of every row are returned."""
         self.cachelens.zero_()
         self.clear_kv()
-        logits = None
+        if seqlens is not None:
+            return self._encode_ragged(input_ids, seqlens)
         seq_len = input_ids.shape[1]
-        position_ids = torch.arange(seq_len, device=self.device).unsqueeze(0).repeat(self.batch_size,1)
-        division = seq_len > 1000
+        if self.block_manager is not None:
+            self.block_manager.resize([seq_len] * self.batch_size)
+        logits = self._prefill(input_ids)
+        self.cachelens += seq_len
+        return logits
+
+    @torch.inference_mode()
+    def prefill_slot(self, slot: int, input_ids: torch.LongTensor, start: int = 0, end: int = None):
+        """Prefill one sequence (input_ids [1, T]) into batch slot `slot`, leaving the other slots untouched.
+        With start / end only tokens [start, end) are prefilled, after the first start ones already in the slot."""
+        end = input_ids.shape[1] if end is None else end
+        assert self.model.kv_offload is None, "Offloaded KV caches are prefilled for the whole batch"
+        if self.block_manager is not None:
+            self.block_manager.resize_slot(slot, end)
+        with slot_caches([b.attention.kv_cache for b in self.model.layers], slot):
+            logits = self._prefill(input_ids, start, end)
+        self.cachelens[slot] = end
+        return logits
+
+    def _encode_ragged(self, input_ids: torch.LongTensor, seqlens: torch.LongTensor):
+        assert bool((seqlens > 0).all()) and int(seqlens.max()) <= input_ids.shape[1], "Prompt lengths must be within 1 and input_ids.shape[1]"
+        seqlens = seqlens.to(device=self.device, dtype=torch.int32)
+        if not isinstance(self.model.layers[0].attention.kv_cache, KVCache):
+            # paged and quantized caches prefill one row at a time, each at its own length
+            return torch.cat([self.prefill_slot(b, input_ids[b:b+1, :seq_len])[:, -1:] for b, seq_len in enumerate(seqlens.tolist())])
+        # packed prefill over the real tokens of every row, in rounds of up to chunk_size tokens per row
+        chunk_size = 1024
+        logits = None
+        for start in range(0, int(seqlens.max()), chunk_size):
+            chunk_lens = (seqlens - start).clamp(min=0, max=chunk_size)
+            cu_seqlens = torch.cat([chunk_lens.new_zeros(1), chunk_lens.cumsum(0, dtype=torch.int32)])
+            rows = torch.repeat_interleave(torch.arange(self.batch_size, device=self.device), chunk_lens)
+            position_ids = start + torch.arange(rows.numel(), device=self.device) - cu_seqlens[rows]
+            chunk_logits = self.model.prefill(input_ids[rows, position_ids].view(1, -1), position_ids.view(1, -1), seqlens.clamp(max=start), cu_seqlens)[0]
+            # keep the logits of the rows whose prompt ends in this round
+            last = (seqlens > start) & (seqlens <= start + chunk_size)
+            logits = chunk_logits if logits is None else torch.where(last.view(-1, 1), chunk_logits, logits)
+        self.cachelens.copy_(seqlens)
+        return logits.unsqueeze(1)
+
+    def _prefill(self, input_ids: torch.LongTensor, start: int = 0, end: int = None):
+        # prefill input_ids[:, start:end] after start tokens already in the caches, in chunks for long prompts
+        logits = None
+        batch_size, seq_len = input_ids.shape
+        end = seq_len if end is None else end
+        cachelens = torch.zeros(batch_size, dtype=torch.int32, device=self.device)
+        position_ids = torch.arange(seq_len, device=self.device).unsqueeze(0).repeat(batch_size,1)
+        division = end - start > 1000
         if division:
-            chunk_size = 32
-            num_chunks = (seq_len + chunk_size - 1) // chunk_size  # Ceil division
-            for i in range(num_chunks):
-                start_idx = i * chunk_size
-                end_idx = min((i + 1) * chunk_size, seq_len)
+            chunk_size = self.prefill_chunk_size
+            for start_idx in range(start, end, chunk_size):
+                end_idx = min(start_idx + chunk_size, end)
                 
                 chunk_input_ids = input_ids[:, start_idx:end_idx]
                 chunk_position_ids = position_ids[:, start_idx:end_idx]
-                chunk_cache_seqlens = self.cachelens + start_idx
+                chunk_cache_seqlens = cachelens + start_idx
 
                 logits = self.prefill(
                     model=self.model,
@@ -77,21 +161,46 @@ class LMBackend:
         else:
             logits = self.prefill(
                 model=self.model,
-                x=input_ids,
-                input_pos=position_ids,
-                cache_seqlens=self.cachelens
+                x=input_ids[:, start:end],
+                input_pos=position_ids[:, start:end],
+                cache_seqlens=cachelens + start
             )
 
-        self.cachelens += seq_len
-        
         return logits
           
     
+    def kv_cache_bytes(self) -> int:
+        return sum(buf.numel() * buf.element_size() for b in self.model.layers for buf in b.attention.kv_cache.buffers())
+
+    def can_admit(self, num_tokens: int, reserved: dict = None) -> bool:
+        """Whether the paged KV pool can hold a new sequence of num_tokens tokens on top of reserved, a
+        {slot: tokens} dict of host-side lengths the admitted slots may still grow to (always True without paging)."""
+        if self.block_manager is None:
+            return True
+        return self.block_manager.can_allocate(num_tokens, reserved)
+
+    def reserve(self, lengths):
+        """Size the paged KV for lengths[slot] tokens (a list over all slots, or a {slot: tokens} dict leaving the
+        other slots as they are) from host-side lengths. Paged decoding calls it once per round with the length
+        every decoding row can reach in the round, e.g. its length + gamma + 1: inference does not grow the
+        block tables, which would read the device cache lengths every step. No-op without paging."""
+        if self.block_manager is not None:
+            self.block_manager.resize(lengths)
+
+    def free_slot(self, slot: int):
+        """Return the pages held by a finished sequence to the pool."""
+        self.cachelens[slot] = 0
+        if self.block_manager is not None:
+            self.block_manager.free(slot)
+
     @torch.inference_mode()
     def clear_kv(self):
         for b in self.model.layers:
-            b.attention.kv_cache.k_cache.zero_()
-            b.attention.kv_cache.v_cache.zero_()
+            if b.attention.kv_cache.k_cache is not None:
+                b.attention.kv_cache.k_cache.zero_()
+                b.attention.kv_cache.v_cache.zero_()
+        if self.model.kv_offload is not None:
+            self.model.kv_offload.reset()
             
 
     
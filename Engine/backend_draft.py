@@ -1,29 +1,38 @@
 import torch
 from MagicDec.Engine.model_draft import Transformer
 from MagicDec.Engine.utils import load_model_draft
+from MagicDec.Engine.attn_backends import get_attn_backend
+from MagicDec.Engine.kv_cache import slot_caches
 
 class LMBackend_Draft:
-    def __init__(self, dtype = torch.bfloat16, device: str = "cuda:0", dec_list: list = [1]) -> None:
+    def __init__(self, dtype = torch.bfloat16, device: str = "cuda:0", dec_list: list = [1], attn_backend: str = None) -> None:
         self.dtype = dtype
         self.device = device
+        self.attn_backend = get_attn_backend(attn_backend, device)
         self.model_forward = {}
         for dec_len in dec_list:
             if dec_len == 0: continue
             self.model_forward[dec_len] = lambda model, x, input_pos, cache_seqlens: model(x, input_pos, cache_seqlens)
-        self.prefill = lambda model, x, input_pos, cache_seqlens, is_last: model.prefill(x, input_pos, cache_seqlens, is_last)
+        self.prefill = lambda model, x, input_pos, cache_seqlens: model.prefill(x, input_pos, cache_seqlens)
         self.cachelens = None
 
-    def load_model(self, checkpoints: str, use_tp: bool, rank_group=None, group = None):
+    def load_model(self, checkpoints: str, use_tp: bool, rank_group=None, group = None, draft_vocab: str = None):
+        # draft_vocab: file of the token ids (written by build_draft_vocab.py) the LM head is pruned to
         self.model: Transformer = load_model_draft(checkpoint_path=checkpoints, device=self.device, precision=self.dtype, use_tp= use_tp, rank_group=rank_group, group = group)
+        self.model.set_attn_backend(self.attn_backend)
+        if draft_vocab is not None:
+            self.model.setup_draft_vocab(torch.load(draft_vocab))
 
     @torch.inference_mode()
-    def setup_caches(self, max_batch_size: int = 1, max_seq_length: int = 2048, kv_len: int = 512):
+    def setup_caches(self, max_batch_size: int = 1, max_seq_length: int = 2048, kv_len: int = 512, num_sinks: int = 16, buffer: int = 64):
+        # max_seq_length bounds the logical positions (prompt + generation), the cache itself holds kv_len + buffer tokens
+        assert buffer >= 32, "The ring buffer slack must hold a whole 32-token prefill chunk"
         self.max_length = max_seq_length
         self.batch_size = max_batch_size
         self.cachelens = torch.zeros(max_batch_size, dtype=torch.int32, device=self.device)
         self.kv_len = kv_len
         with torch.device(self.device):
-            self.model.setup_caches(max_batch_size=max_batch_size, max_seq_length=max_seq_length, kv_len=kv_len)
+            self.model.setup_caches(max_batch_size=max_batch_size, max_seq_length=max_seq_length, kv_len=kv_len, num_sinks=num_sinks, buffer=buffer)
 
     def compile(self, encode=False):
         import torch._dynamo.config
@@ -53,41 +62,53 @@ class LMBackend_Draft:
             return logits
     
     @torch.inference_mode()
-    def encode(self, input_ids: torch.LongTensor):
+    def encode(self, input_ids: torch.LongTensor, seqlens: torch.LongTensor = None):
+        # with seqlens [B] the prompt of row b is input_ids[b, :seqlens[b]], prefilled on its own at its length
+        if seqlens is not None:
+            return torch.cat([self.prefill_slot(b, input_ids[b:b+1, :seq_len])[:, -1:] for b, seq_len in enumerate(seqlens.tolist())])
         self.cachelens.zero_()
         self.clear_kv()
+        logits = self._prefill(input_ids)
+        self.cachelens += input_ids.shape[1]
+        return logits
+
+    @torch.inference_mode()
+    def prefill_slot(self, slot: int, input_ids: torch.LongTensor, start: int = 0, end: int = None):
+        """Prefill one sequence (input_ids [1, T]) into batch slot `slot`, leaving the other slots untouched.
+        With start / end only tokens [start, end) are prefilled, after the first start ones already in the slot."""
+        end = input_ids.shape[1] if end is None else end
+        with slot_caches([b.attention.kv_cache for b in self.model.layers], slot):
+            if start == 0:
+                for b in self.model.layers:
+                    b.attention.kv_cache.reset()
+            logits = self._prefill(input_ids, start, end)
+        self.cachelens[slot] = end
+        return logits
+
+    def _prefill(self, input_ids: torch.LongTensor, start: int = 0, end: int = None):
         logits = None
-        seq_len = input_ids.shape[1]
+        end = input_ids.shape[1] if end is None else end
+        cachelens = torch.zeros(input_ids.shape[0], dtype=torch.int32, device=self.device)
         chunk_size = 32
-        num_chunks = (seq_len + chunk_size - 1) // chunk_size  # Ceil division
-        for i in range(num_chunks):
-            is_last = i == num_chunks-1
-            start_idx = i * chunk_size
-            end_idx = min((i + 1) * chunk_size, seq_len)
+        for start_idx in range(start, end, chunk_size):
+            end_idx = min(start_idx + chunk_size, end)
             chunk_input_ids = input_ids[:, start_idx:end_idx]
-            if end_idx > self.kv_len:
-                chunk_position_ids = torch.arange(self.kv_len - chunk_input_ids.shape[1], self.kv_len, device = self.device).unsqueeze(0).repeat(input_ids.shape[0],1).long()
-            else:
-                chunk_position_ids = torch.arange(start_idx, end_idx, device = self.device).unsqueeze(0).repeat(input_ids.shape[0],1).long()
-            chunk_cache_seqlens = start_idx
+            chunk_position_ids = torch.arange(start_idx, end_idx, device = self.device).unsqueeze(0).repeat(input_ids.shape[0],1).long()
+            chunk_cache_seqlens = cachelens + start_idx
 
             logits = self.prefill(
                 model=self.model,
                 x=chunk_input_ids,
                 input_pos=chunk_position_ids,
-                cache_seqlens=chunk_cache_seqlens,
-                is_last=is_last
+                cache_seqlens=chunk_cache_seqlens
             )
-            
-        self.cachelens += self.kv_len
-        
+
         return logits
           
     
     @torch.inference_mode()
     def clear_kv(self):
         for b in self.model.layers:
-            b.attention.kv_cache.k_cache.zero_()
-            b.attention.kv_cache.v_cache.zero_()
+            b.attention.kv_cache.reset()
 
     
@@ -1,11 +1,17 @@
 import torch
 from MagicDec.Engine.model_selfspec import Transformer
 from MagicDec.Engine.utils import load_model_selfspec
+from MagicDec.Engine.attn_backends import get_attn_backend
+from MagicDec.Engine.tree import SpecTree
+from MagicDec.Engine.draft_policies import get_draft_policy
+from MagicDec.Engine.kv_cache import slot_caches
+from MagicDec.Engine.draft_vocab import to_full_vocab
 
 class LMBackend:
-    def __init__(self, dtype = torch.bfloat16, device: str = "cuda:0", dec_list: list = [1], draft_dec_list: list = [1]) -> None:
+    def __init__(self, dtype = torch.bfloat16, device: str = "cuda:0", dec_list: list = [1], draft_dec_list: list = [1], attn_backend: str = None) -> None:
         self.dtype = dtype
         self.device = device
+        self.attn_backend = get_attn_backend(attn_backend, device)
         self.model_forward = {}
         self.draft_forward = {}
         for dec_len in dec_list:
@@ -13,25 +19,41 @@ class LMBackend:
             self.model_forward[dec_len] = lambda model, x, input_pos, cache_seqlens: model(x, input_pos, cache_seqlens)
         for dec_len in draft_dec_list:
             if dec_len == 0: continue
-            self.draft_forward[dec_len] = lambda model, x, input_pos, cache_seqlens: model.draft_forward(x, input_pos, cache_seqlens)
-        self.prefill = lambda model, x, input_pos, cache_seqlens: model.prefill(x, input_pos, cache_seqlens)
-        self.draft_prefill = lambda model, x, input_pos, cache_seqlens, is_last: model.draft_prefill(x, input_pos, cache_seqlens, is_last)
+            self.draft_forward[dec_len] = lambda model, x, input_pos, cache_seqlens, target_seqlens: model.draft_forward(x, input_pos, cache_seqlens, target_seqlens)
+        self.tree_forward = lambda model, x, input_pos, cache_seqlens, tree_mask: model(x, input_pos, cache_seqlens, tree_mask)
+        self.prefill = lambda model, x, input_pos, cache_seqlens, score_queries=0, score_len=None: model.prefill(x, input_pos, cache_seqlens, score_queries, score_len)
+        self.draft_prefill = lambda model, x, input_pos, cache_seqlens: model.draft_prefill(x, input_pos, cache_seqlens)
         self.cachelens = None
         self.draft_cachelens = None
-        self.streaming_budget = None
+        self.draft_policy = None
 
-    def load_model(self, checkpoints: str, use_tp: bool, rank_group=None, group = None):
+    def load_model(self, checkpoints: str, use_tp: bool, rank_group=None, group = None, draft_quant: str = None, draft_groupsize: int = 128, draft_vocab: str = None):
+        # draft_quant: int8 or int4 weights for drafting only, quantized from the (sharded) full precision ones
+        # draft_vocab: file of the token ids (written by build_draft_vocab.py) the draft LM head is pruned to
         self.model: Transformer = load_model_selfspec(checkpoint_path=checkpoints, device=self.device, precision=self.dtype, use_tp= use_tp, rank_group=rank_group, group = group)
+        self.model.set_attn_backend(self.attn_backend)
+        if draft_vocab is not None:
+            self.model.setup_draft_vocab(torch.load(draft_vocab))
+        if draft_quant is not None:
+            self.model.setup_draft_weights(draft_quant, draft_groupsize)
 
     @torch.inference_mode()
-    def setup_caches(self, max_batch_size: int = 1, max_seq_length: int = 2048, streamingllm_budget: int = 256, buffer: int = 0):
+    def setup_caches(self, max_batch_size: int = 1, max_seq_length: int = 2048, streamingllm_budget: int = 256, num_sinks: int = 16, buffer: int = 64,
+                     draft_policy: str = "streamingllm", draft_window: int = None, page_size: int = 16, offload_layers: int = 0, draft_skip_layers: list = ()):
+        # the draft keeps streamingllm_budget tokens per layer and KV head, chosen by draft_policy
+        # offload_layers: keep the target KV of the last offload_layers layers in host memory, streamed in layer by layer
+        # draft_skip_layers: layers the draft passes through, with no draft KV (see also search_draft_skip_layers)
+        assert buffer >= 32, "The ring buffer slack must hold a whole 32-token prefill chunk"
         self.max_length = max_seq_length
         self.batch_size = max_batch_size
         self.cachelens = torch.zeros(max_batch_size, dtype=torch.int32, device=self.device)
         self.draft_cachelens = torch.zeros(max_batch_size, dtype=torch.int32, device=self.device)
+        self.draft_policy = get_draft_policy(draft_policy, streamingllm_budget, num_sinks=num_sinks, window=draft_window, page_size=page_size)
+        # every target prefill chunk streams the whole offloaded KV in, so offloading prefills in larger chunks
+        self.prefill_chunk_size = 32 if offload_layers == 0 else 4096
         with torch.device(self.device):
-            self.model.setup_caches(max_batch_size=max_batch_size, max_seq_length=max_seq_length, streaming_budget=streamingllm_budget, buffer=buffer)
-        self.streaming_budget = streamingllm_budget
+            self.model.setup_caches(max_batch_size=max_batch_size, max_seq_length=max_seq_length, draft_policy=self.draft_policy, buffer=buffer, offload_layers=offload_layers,
+                                    draft_skip_layers=draft_skip_layers)
 
     def compile(self, encode=False):
         import torch._dynamo.config
@@ -41,6 +63,7 @@ class LMBackend:
         torch._inductor.config.fx_graph_cache = True # Experimental feature to reduce compilation times, will be on by default in future
         for key in self.model_forward.keys():
             self.model_forward[key] = torch.compile(self.model_forward[key], mode="reduce-overhead", fullgraph=True)
+        self.tree_forward = torch.compile(self.tree_forward, mode="reduce-overhead", fullgraph=True)
         for key in self.draft_forward.keys():
             self.draft_forward[key] = torch.compile(self.draft_forward[key], mode="reduce-overhead", fullgraph=True)
         if encode:
@@ -70,7 +93,8 @@ class LMBackend:
                 model=self.model, 
                 x=input_ids.clone(),
                 input_pos=position_ids.clone(), 
-                cache_seqlens= self.draft_cachelens.clone()) if dec_len in self.draft_forward.keys() else self.model.draft_forward(input_ids.clone(), position_ids.clone(), self.draft_cachelens.clone())
+                cache_seqlens= self.draft_cachelens.clone(),
+                target_seqlens=self.cachelens.clone()) if dec_len in self.draft_forward.keys() else self.model.draft_forward(input_ids.clone(), position_ids.clone(), self.draft_cachelens.clone(), self.cachelens.clone())
             if not benchmark:
                 if cachelen_update == None:
                     self.draft_cachelens += dec_len
@@ -79,62 +103,163 @@ class LMBackend:
             return logits
     
     @torch.inference_mode()
-    def encode(self, input_ids: torch.LongTensor):
+    def tree_inference(self, input_ids: torch.LongTensor, tree: SpecTree):
+        """Verify a token tree ([B, tree.size] node tokens) in one forward pass, each node at position
+        cachelens + its depth. cachelens is left unchanged until commit_tree_path."""
+        assert self.model.kv_offload is None, "Tree verification needs the resident KV cache"
+        position_ids = self.cachelens.view(-1,1) + tree.depths.view(1,-1)
+        return self.tree_forward(
+            model=self.model,
+            x=input_ids.clone(),
+            input_pos=position_ids.clone(),
+            cache_seqlens=self.cachelens.clone(),
+            tree_mask=tree.mask)
+
+    @torch.inference_mode()
+    def commit_tree_path(self, path: torch.LongTensor, accept_nums: torch.LongTensor):
+        # keep the KV of the accepted path ([B, depth + 1] node indices, accept_nums valid per row)
+        self.model.commit_tree_path(self.cachelens, path)
+        self.cachelens += accept_nums.to(self.cachelens.dtype)
+
+    @torch.inference_mode()
+    def encode(self, input_ids: torch.LongTensor, seqlens: torch.LongTensor = None):
+        # with seqlens [B] the prompt of row b is input_ids[b, :seqlens[b]], prefilled on its own at its length
+        if seqlens is not None:
+            return torch.cat([self.prefill_slot(b, input_ids[b:b+1, :seq_len])[:, -1:] for b, seq_len in enumerate(seqlens.tolist())])
         self.cachelens.zero_()
         self.draft_cachelens.zero_()
         self.clear_kv()
+        logits = self._prefill(input_ids)
+        self.cachelens += input_ids.shape[1]
+        self.draft_cachelens += input_ids.shape[1]
+        return logits
+
+    @torch.inference_mode()
+    def prefill_slot(self, slot: int, input_ids: torch.LongTensor, start: int = 0, end: int = None):
+        """Prefill one sequence (input_ids [1, T]) into batch slot `slot` of the target and draft caches,
+        leaving the other slots untouched. With start / end only tokens [start, end) are prefilled, after the
+        first start ones already in the slot; the draft KV is selected once the whole prompt is in."""
+        end = input_ids.shape[1] if end is None else end
+        assert self.model.kv_offload is None, "Offloaded KV caches are prefilled for the whole batch"
+        with slot_caches([b.attention.kv_cache for b in self.model.layers], slot):
+            if start == 0:
+                self.clear_kv()
+            logits = self._prefill(input_ids, start, end)
+        self.cachelens[slot] = end
+        self.draft_cachelens[slot] = end
+        return logits
+
+    def _prefill(self, input_ids: torch.LongTensor, start: int = 0, end: int = None):
+        # prefill the target caches and build the draft's from them
         logits = None
-        seq_len = input_ids.shape[1]
-        position_ids = torch.arange(seq_len, device=self.device).unsqueeze(0).repeat(self.batch_size,1)
-        division = seq_len > 1000
-        if division:
-            chunk_size = 32
-            num_chunks = (seq_len + chunk_size - 1) // chunk_size  # Ceil division
-            for i in range(num_chunks):
-                start_idx = i * chunk_size
-                end_idx = min((i + 1) * chunk_size, seq_len)
-                
-                chunk_input_ids = input_ids[:, start_idx:end_idx]
-                chunk_position_ids = position_ids[:, start_idx:end_idx]
-                chunk_cache_seqlens = self.cachelens + start_idx
-
-                logits = self.prefill(
-                    model=self.model,
-                    x=chunk_input_ids,
-                    input_pos=chunk_position_ids,
-                    cache_seqlens=chunk_cache_seqlens
-                )
-
-                if end_idx > self.streaming_budget:
-                    chunk_position_ids = torch.arange(self.streaming_budget - chunk_input_ids.shape[1], self.streaming_budget, device = self.device).unsqueeze(0).repeat(input_ids.shape[0],1).long()
-                self.draft_prefill(
-                    model=self.model,
-                    x=chunk_input_ids,
-                    input_pos=chunk_position_ids,
-                    cache_seqlens=chunk_cache_seqlens,
-                    is_last = i == num_chunks-1
-                )
-        else:
-            raise NotImplementedError("Not implemented for seq_len < 1000")
+        batch_size, seq_len = input_ids.shape
+        end = seq_len if end is None else end
+        cachelens = torch.zeros(batch_size, dtype=torch.int32, device=self.device)
+        position_ids = torch.arange(seq_len, device=self.device).unsqueeze(0).repeat(batch_size,1)
+        for start_idx in range(start, end, self.prefill_chunk_size):
+            end_idx = min(start_idx + self.prefill_chunk_size, end)
+
+            chunk_input_ids = input_ids[:, start_idx:end_idx]
+            chunk_position_ids = position_ids[:, start_idx:end_idx]
+            chunk_cache_seqlens = cachelens + start_idx
+
             logits = self.prefill(
                 model=self.model,
-                x=input_ids,
-                input_pos=position_ids,
-                cache_seqlens=self.cachelens
+                x=chunk_input_ids,
+                input_pos=chunk_position_ids,
+                cache_seqlens=chunk_cache_seqlens,
+                score_queries=self.draft_policy.scored_queries(start_idx, end_idx, seq_len) if self.draft_policy.needs_scores else 0,
+                score_len=end_idx
             )
 
-        self.cachelens += seq_len
-        # self.draft_cachelens += seq_len
-        self.draft_cachelens += self.streaming_budget
+            if self.draft_policy.streaming_prefill:
+                # the draft ring buffer takes at most 32 tokens at a time
+                for draft_start in range(start_idx, end_idx, 32):
+                    draft_end = min(draft_start + 32, end_idx)
+                    self.draft_prefill(
+                        model=self.model,
+                        x=input_ids[:, draft_start:draft_end],
+                        input_pos=position_ids[:, draft_start:draft_end],
+                        cache_seqlens=cachelens + draft_start
+                    )
+        if self.draft_policy.needs_scores and end == seq_len:
+            self.model.select_draft_kv(seq_len)
 
         return logits
           
     
+    def _prefill_draft(self, input_ids: torch.LongTensor):
+        # rebuild the draft KV of a prompt already in the target caches
+        batch_size, seq_len = input_ids.shape
+        cachelens = torch.zeros(batch_size, dtype=torch.int32, device=self.device)
+        position_ids = torch.arange(seq_len, device=self.device).unsqueeze(0).repeat(batch_size,1)
+        for b in self.model.layers:
+            if b.attention.kv_cache.draft_cache is not None:
+                b.attention.kv_cache.draft_cache.reset()
+        if self.draft_policy.streaming_prefill:
+            for start in range(0, seq_len, 32):
+                end = min(start + 32, seq_len)
+                self.model.draft_prefill(input_ids[:, start:end], position_ids[:, start:end], cachelens + start)
+        elif self.draft_policy.needs_scores:
+            self.model.select_draft_kv(seq_len)
+        self.draft_cachelens.fill_(seq_len)
+
+    @torch.inference_mode()
+    def search_draft_skip_layers(self, input_ids: torch.LongTensor, num_skip: int, num_calib_tokens: int = 64):
+        """Greedily add num_skip layers to the ones the draft skips, each time the layer whose skipping keeps the
+        draft's greedy predictions closest to the target's on the last num_calib_tokens tokens of the calibration
+        prompts input_ids [B, T] (teacher forced). The draft KV of the chosen layers is freed.
+        Returns all skipped layers and, for every pick, the agreement of each candidate layer {layer: agreement}.
+        Run it before encode and compile: it prefills the calibration prompts into the caches, leaving them empty
+        afterwards, and every candidate skip set is a new draft graph."""
+        assert input_ids.shape[0] == self.batch_size, f"Calibrate with a full batch of {self.batch_size} prompts"
+        assert int(self.cachelens.max()) == 0, "Search the draft skip layers before encode, it overwrites the caches"
+        prompt, cont = input_ids[:, :-num_calib_tokens], input_ids[:, -num_calib_tokens:-1]
+        prompt_len = prompt.shape[1]
+        self.encode(prompt)
+        target = self.inference(cont).argmax(dim=-1)
+        position_ids = prompt_len + torch.arange(cont.shape[1], device=self.device).unsqueeze(0).repeat(self.batch_size,1)
+
+        def agreement():
+            self._prefill_draft(prompt)
+            matches = []
+            for start in range(0, cont.shape[1], 32):
+                end = min(start + 32, cont.shape[1])
+                logits = self.model.draft_forward(cont[:, start:end], position_ids[:, start:end], self.draft_cachelens + start)
+                matches.append(to_full_vocab(logits.argmax(dim=-1), self.model.draft_vocab) == target[:, start:end])
+            return torch.cat(matches, dim=1).float().mean().item()
+
+        skip = set(self.model.draft_skip_layers)
+        history = []
+        for _ in range(num_skip):
+            scores = {}
+            for i in range(self.model.config.n_layer):
+                if i in skip: continue
+                self.model.set_draft_skip_layers(skip | {i}, free=False)
+                scores[i] = agreement()
+            skip.add(max(scores, key=scores.get))
+            history.append(scores)
+        self.model.set_draft_skip_layers(skip)
+        self.cachelens.zero_()
+        self.draft_cachelens.zero_()
+        return sorted(skip), history
+
+    def free_slot(self, slot: int):
+        self.cachelens[slot] = 0
+        self.draft_cachelens[slot] = 0
+
     @torch.inference_mode()
     def clear_kv(self):
+        if self.model.kv_offload is not None:
+            self.model.kv_offload.reset()
         for b in self.model.layers:
-            b.attention.kv_cache.k_cache.zero_()
-            b.attention.kv_cache.v_cache.zero_()
+            if b.attention.kv_cache.k_cache is not None:
+                b.attention.kv_cache.k_cache.zero_()
+                b.attention.kv_cache.v_cache.zero_()
+            if b.attention.kv_cache.draft_cache is not None:
+                b.attention.kv_cache.draft_cache.reset()
+            if b.attention.kv_cache.draft_scores is not None:
+                b.attention.kv_cache.draft_scores.zero_()
 
     
 
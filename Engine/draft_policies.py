@@ -0,0 +1,102 @@
+import torch
+import torch.nn.functional as F
+
+
+class DraftKVPolicy:
+    """Chooses which prompt tokens the self-speculation draft keeps in its KV cache.
+
+    Every layer and KV head keeps `budget` tokens: `num_static` picked by the policy plus a window of
+    the most recent ones, which keeps rolling during generation (see kv_cache.StreamingKVCache).
+    """
+    name = None
+    # attend the static tokens as if they preceded the window (StreamingLLM sinks)
+    shift_static = False
+    # run the draft over the prompt through its own ring buffer instead of selecting from the target KV
+    streaming_prefill = False
+    # accumulate attention scores of the prompt during the target prefill
+    needs_scores = False
+    # no draft cache: every draft step attends to pages of the target KV chosen for its query
+    paged = False
+
+    def __init__(self, budget: int, window: int):
+        assert 0 < window <= budget, f"window ({window}) must be in (0, budget ({budget})]"
+        self.budget = budget
+        self.window = window
+        self.num_static = budget - window
+
+    def scored_queries(self, start: int, end: int, prompt_len: int) -> int:
+        """How many of the last queries of the prompt chunk [start, end) add their attention to the
+        selection scores: those of the observation window, the last `window` prompt tokens."""
+        return max(0, end - max(start, prompt_len - self.window))
+
+    def select(self, scores: torch.Tensor) -> torch.Tensor:
+        """scores: [B, H, L] accumulated over the prompt tokens before the window.
+        Returns the positions of the num_static tokens to keep, [B, H, num_static]."""
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{self.name}(budget={self.budget}, static={self.num_static}, window={self.window})"
+
+
+class StreamingLLMPolicy(DraftKVPolicy):
+    """Attention sinks plus a sliding window (StreamingLLM)."""
+    name = "streamingllm"
+    shift_static = True
+    streaming_prefill = True
+
+    def __init__(self, budget: int, num_sinks: int = 16, **kwargs):
+        super().__init__(budget, budget - num_sinks)
+
+
+class SnapKVPolicy(DraftKVPolicy):
+    """SnapKV: keys ranked by the attention they get from the last `window` prompt tokens (the
+    observation window), smoothed with a 1D pooling so neighbouring tokens are kept together."""
+    name = "snapkv"
+    needs_scores = True
+
+    def __init__(self, budget: int, window: int = None, kernel_size: int = 5, **kwargs):
+        super().__init__(budget, window or 32)
+        self.kernel_size = kernel_size
+
+    def select(self, scores):
+        scores = F.avg_pool1d(scores, kernel_size=self.kernel_size, stride=1, padding=self.kernel_size // 2)
+        return scores.topk(self.num_static, dim=-1).indices.sort(dim=-1).values
+
+
+class H2OPolicy(DraftKVPolicy):
+    """H2O: heavy hitters by the attention accumulated over all the prompt queries, plus the recent window."""
+    name = "h2o"
+    needs_scores = True
+
+    def __init__(self, budget: int, window: int = None, **kwargs):
+        super().__init__(budget, window or budget // 2)
+
+    def scored_queries(self, start, end, prompt_len):
+        return end - start
+
+    def select(self, scores):
+        return scores.topk(self.num_static, dim=-1).indices.sort(dim=-1).values
+
+
+class QuestPolicy(DraftKVPolicy):
+    """Quest: the target KV is split into pages of page_size tokens with per-page min/max key
+    summaries. Each draft step scores the pages against its query (an upper bound of q.k within the
+    page) and attends to the top budget // page_size pages of the target cache, so no KV is duplicated."""
+    name = "quest"
+    paged = True
+
+    def __init__(self, budget: int, page_size: int = 16, **kwargs):
+        super().__init__(budget, budget)
+        assert budget % page_size == 0, f"budget ({budget}) must be a multiple of the page size ({page_size})"
+        self.page_size = page_size
+        self.num_pages = budget // page_size
+
+    def __repr__(self):
+        return f"{self.name}(budget={self.budget}, pages={self.num_pages}x{self.page_size})"
+
+
+DRAFT_POLICIES = {policy.name: policy for policy in [StreamingLLMPolicy, SnapKVPolicy, H2OPolicy, QuestPolicy]}
+
+def get_draft_policy(name: str, budget: int, num_sinks: int = 16, window: int = None, page_size: int = 16) -> DraftKVPolicy:
+    assert name in DRAFT_POLICIES, f"Unknown draft KV policy {name}, choose from {list(DRAFT_POLICIES.keys())}"
+    return DRAFT_POLICIES[name](budget, num_sinks=num_sinks, window=window, page_size=page_size)
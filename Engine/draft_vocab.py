@@ -0,0 +1,43 @@
+import torch
+import torch.nn as nn
+
+from MagicDec.Engine.quantize import WeightOnlyInt8Linear, WeightOnlyInt4Linear
+
+
+def top_tokens(counts: torch.Tensor, size: int, keep=()) -> torch.Tensor:
+    """The size most frequent token ids by counts [V], always including the ids in keep (special tokens), sorted."""
+    counts = counts.clone()
+    counts[list(keep)] = counts.max() + 1
+    return counts.topk(min(size, counts.numel())).indices.sort().values
+
+@torch.no_grad()
+def prune_rows(linear: nn.Module, rows: torch.Tensor) -> nn.Module:
+    """A copy of linear keeping only the output features rows, for full precision and weight-only quantized layers."""
+    device = linear.weight.device
+    rows = rows.to(device)
+    with torch.device(device):
+        if isinstance(linear, WeightOnlyInt8Linear):
+            pruned = WeightOnlyInt8Linear(linear.in_features, rows.numel())
+            pruned.weight = linear.weight[rows]
+            pruned.scales = linear.scales[rows]
+        elif isinstance(linear, WeightOnlyInt4Linear):
+            pruned = WeightOnlyInt4Linear(linear.in_features, rows.numel(), groupsize=linear.groupsize)
+            pruned.weight = linear.weight[rows]
+            pruned.scales_and_zeros = linear.scales_and_zeros[:, rows].contiguous()
+        else:
+            assert isinstance(linear, nn.Linear) and linear.bias is None, f"Can not prune the rows of {type(linear).__name__}"
+            pruned = nn.Linear(linear.in_features, rows.numel(), bias=False, dtype=linear.weight.dtype)
+            pruned.weight = nn.Parameter(linear.weight[rows], requires_grad=False)
+    return pruned
+
+def to_full_vocab(tokens: torch.Tensor, draft_vocab: torch.Tensor) -> torch.Tensor:
+    # token ids of a pruned draft head back to ids of the full vocabulary
+    return tokens if draft_vocab is None else draft_vocab[tokens]
+
+def full_vocab_probs(probs: torch.Tensor, draft_vocab: torch.Tensor, vocab_size: int) -> torch.Tensor:
+    # a distribution over the pruned draft vocabulary as one over the full vocabulary, zero outside draft_vocab
+    if draft_vocab is None:
+        return probs
+    full = probs.new_zeros((*probs.shape[:-1], vocab_size))
+    full[..., draft_vocab] = probs
+    return full
@@ -0,0 +1,110 @@
+import torch
+
+import torch.nn.functional as F
+
+try:
+    from MagicDec.Engine.triton_fused import add_rms_norm as triton_add_rms_norm, rotary_emb_ as triton_rotary_emb_, silu_mul as triton_silu_mul
+except ImportError:
+    triton_add_rms_norm = triton_rotary_emb_ = triton_silu_mul = None
+
+
+# PyTorch references, matching RMSNorm.forward, apply_rotary_emb and the SwiGLU of the model files
+def rms_norm_ref(x, weight, eps):
+    xf = x.float()
+    return (xf * torch.rsqrt(torch.mean(xf * xf, dim=-1, keepdim=True) + eps)).type_as(x) * weight
+
+def rotary_emb_ref(x, freqs_cis):
+    # model.py imports this module for the ops, so its apply_rotary_emb is imported when first used
+    from MagicDec.Engine.model import apply_rotary_emb
+    return apply_rotary_emb(x, freqs_cis)
+
+def silu_mul_ref(x):
+    gate, up = x.chunk(2, dim=-1)
+    return F.silu(gate) * up
+
+
+# RMSNorm in one pass over each row (Triton on CUDA)
+torch.library.define(
+    "mylib::rms_norm",
+    "(Tensor x, Tensor weight, float eps) -> Tensor",
+)
+
+@torch.library.impl("mylib::rms_norm", "cuda")
+def rms_norm(x, weight, eps):
+    if triton_add_rms_norm is None:
+        return rms_norm_ref(x, weight, eps)
+    return triton_add_rms_norm(x, None, weight, eps)[0].view(x.shape)
+
+@torch.library.impl("mylib::rms_norm", "cpu")
+def rms_norm_cpu(x, weight, eps):
+    return rms_norm_ref(x, weight, eps)
+
+@torch.library.impl_abstract("mylib::rms_norm")
+def rms_norm_abstract(x, weight, eps):
+    return torch.empty(x.shape, dtype=torch.result_type(x, weight), device=x.device)
+
+
+# Residual add and the following RMSNorm fused: returns (norm(x + residual) * weight, x + residual)
+torch.library.define(
+    "mylib::add_rms_norm",
+    "(Tensor x, Tensor residual, Tensor weight, float eps) -> (Tensor, Tensor)",
+)
+
+@torch.library.impl("mylib::add_rms_norm", "cuda")
+def add_rms_norm(x, residual, weight, eps):
+    if triton_add_rms_norm is None:
+        return add_rms_norm_cpu(x, residual, weight, eps)
+    out, h = triton_add_rms_norm(x, residual, weight, eps)
+    return out.view(x.shape), h.view(x.shape)
+
+@torch.library.impl("mylib::add_rms_norm", "cpu")
+def add_rms_norm_cpu(x, residual, weight, eps):
+    h = x + residual
+    return rms_norm_ref(h, weight, eps), h
+
+@torch.library.impl_abstract("mylib::add_rms_norm")
+def add_rms_norm_abstract(x, residual, weight, eps):
+    return torch.empty(x.shape, dtype=torch.result_type(x, weight), device=x.device), torch.empty_like(x)
+
+
+# Rotary embedding of x ([B, T, H, D]) at freqs_cis ([B, T, D // 2, 2]), in place
+torch.library.define(
+    "mylib::rope_",
+    "(Tensor(a!) x, Tensor freqs_cis) -> ()",
+)
+
+@torch.library.impl("mylib::rope_", "cuda")
+def rope_(x, freqs_cis):
+    if triton_rotary_emb_ is None or x.stride(-1) != 1:
+        rope_cpu(x, freqs_cis)
+        return
+    triton_rotary_emb_(x, freqs_cis)
+
+@torch.library.impl("mylib::rope_", "cpu")
+def rope_cpu(x, freqs_cis):
+    x.copy_(rotary_emb_ref(x, freqs_cis))
+
+@torch.library.impl_abstract("mylib::rope_")
+def rope_abstract(x, freqs_cis):
+    return None
+
+
+# SwiGLU activation of the merged gate/up projection: silu(x[..., :N]) * x[..., N:] for x [..., 2N]
+torch.library.define(
+    "mylib::silu_mul",
+    "(Tensor x) -> Tensor",
+)
+
+@torch.library.impl("mylib::silu_mul", "cuda")
+def silu_mul(x):
+    if triton_silu_mul is None:
+        return silu_mul_ref(x)
+    return triton_silu_mul(x)
+
+@torch.library.impl("mylib::silu_mul", "cpu")
+def silu_mul_cpu(x):
+    return silu_mul_ref(x)
+
+@torch.library.impl_abstract("mylib::silu_mul")
+def silu_mul_abstract(x):
+    return x.new_empty((*x.shape[:-1], x.size(-1) // 2))
@@ -0,0 +1,358 @@
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+# registers mylib::rope_, used to re-rotate the attention sinks
+import MagicDec.Engine.fused_ops
+
+# storage dtypes for the quantized KV cache, selected with setup_caches(kv_quant=...)
+KV_QUANT_DTYPES = {"int8": torch.int8}
+if hasattr(torch, "float8_e4m3fn"):
+    KV_QUANT_DTYPES["fp8"] = torch.float8_e4m3fn
+
+
+def quantize_kv(x: torch.Tensor, dtype: torch.dtype):
+    """Symmetric per-token, per-head quantization of x [..., head_dim]. Returns (x_q, scale [...] float32)."""
+    x = x.float()
+    qmax = 127.0 if dtype == torch.int8 else torch.finfo(dtype).max
+    scale = x.abs().amax(dim=-1).clamp(min=1e-8) / qmax
+    x_q = x / scale.unsqueeze(-1)
+    if dtype == torch.int8:
+        x_q = x_q.round().clamp(-127, 127)
+    return x_q.to(dtype), scale
+
+def dequantize_kv(x_q: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype):
+    return (x_q.float() * scale.unsqueeze(-1)).to(dtype)
+
+
+class BlockManager:
+    """Hands out fixed-size KV pages from a pool shared by all batch slots.
+
+    The pages owned by each slot are recorded in `block_table` ([max_batch_size, max_pages_per_seq] int32,
+    shared by every layer's PagedKVCache), so a sequence only holds pages for the tokens it actually has.
+    Page num_pages of the pool is a scratch page: every block table entry not owned by its slot points
+    there, so the writes of rows that run with the batch without pages for them (free or still prefilling
+    slots) never land in another sequence's pages.
+    Block tables are sized from host-side lengths (resize), never by reading the device cache lengths.
+    """
+    def __init__(self, block_table: torch.Tensor, num_pages: int, page_size: int):
+        self.block_table = block_table
+        self.num_pages = num_pages
+        self.page_size = page_size
+        self.max_pages_per_seq = block_table.size(1)
+        self.free_pages = list(range(num_pages - 1, -1, -1))
+        self.slot_pages = [[] for _ in range(block_table.size(0))]
+        self.block_table.fill_(num_pages)
+
+    def pages_needed(self, num_tokens: int) -> int:
+        return (num_tokens + self.page_size - 1) // self.page_size
+
+    def num_free_tokens(self) -> int:
+        return len(self.free_pages) * self.page_size
+
+    def max_tokens_per_seq(self) -> int:
+        return self.max_pages_per_seq * self.page_size
+
+    def pages_owed(self, lengths: dict) -> int:
+        """Pages the slots still have to take from the pool to reach lengths[slot] tokens."""
+        return sum(max(self.pages_needed(length) - len(self.slot_pages[slot]), 0) for slot, length in lengths.items())
+
+    def can_allocate(self, num_tokens: int, reserved: dict = None) -> bool:
+        """Whether a new sequence of num_tokens fits, after the pages owed to the slots in reserved."""
+        needed = self.pages_needed(num_tokens)
+        owed = self.pages_owed(reserved) if reserved else 0
+        return needed <= self.max_pages_per_seq and needed + owed <= len(self.free_pages)
+
+    def resize(self, lengths):
+        """Grow or shrink the pages of every slot to hold lengths[slot] tokens. lengths is a list over all
+        slots or a {slot: tokens} dict, which leaves the other slots as they are."""
+        self._resize(lengths.items() if isinstance(lengths, dict) else enumerate(lengths))
+
+    def resize_slot(self, slot: int, length: int):
+        self._resize([(slot, length)])
+
+    def _resize(self, slot_lengths):
+        rows, cols, pages = [], [], []
+        for slot, length in slot_lengths:
+            needed = self.pages_needed(length)
+            assert needed <= self.max_pages_per_seq, f"Sequence of {length} tokens exceeds the block table ({self.max_tokens_per_seq()} tokens)"
+            owned = self.slot_pages[slot]
+            while len(owned) > needed:
+                self.free_pages.append(owned.pop())
+                rows.append(slot)
+                cols.append(len(owned))
+                pages.append(self.num_pages)
+            while len(owned) < needed:
+                assert len(self.free_pages) > 0, f"KV page pool exhausted ({self.num_pages} pages of {self.page_size} tokens)"
+                rows.append(slot)
+                cols.append(len(owned))
+                pages.append(self.free_pages.pop())
+                owned.append(pages[-1])
+        self._set_entries(rows, cols, pages)
+
+    def _set_entries(self, rows, cols, pages):
+        if len(pages) > 0:
+            device = self.block_table.device
+            self.block_table[torch.tensor(rows, device=device), torch.tensor(cols, device=device)] = torch.tensor(pages, dtype=self.block_table.dtype, device=device)
+
+    def free(self, slot: int):
+        self.resize_slot(slot, 0)
+
+    def reset(self):
+        for slot in range(len(self.slot_pages)):
+            self.free(slot)
+
+
+@contextmanager
+def slot_caches(caches, slot: int):
+    """Narrow the batch-indexed buffers of the given cache modules (and their submodules) to batch slot
+    `slot`, so one sequence can be prefilled with batch size 1 while the other slots keep their state.
+    The views share storage with the full caches. Paged caches keep their page pool and narrow the block table.
+    """
+    saved = []
+    for cache in caches:
+        for module in cache.modules():
+            if getattr(module, "block_table", None) is not None:
+                saved.append((module, "block_table", module.block_table))
+                module.block_table = module.block_table[slot:slot + 1]
+                continue
+            for name, buf in list(module.named_buffers(recurse=False)):
+                if buf is not None:
+                    saved.append((module, name, buf))
+                    setattr(module, name, buf[slot:slot + 1])
+    try:
+        yield
+    finally:
+        for module, name, buf in reversed(saved):
+            setattr(module, name, buf)
+
+
+class StreamingKVCache(nn.Module):
+    """Fixed-budget draft cache: num_static static slots plus a ring holding the most recent
+    budget - num_static tokens, laid out [B, slots, H, D] like the target cache so that the attention
+    backend's kvcache ops attend it directly (see attention).
+
+    Slots [0, num_static) are static, [num_static, budget) the ring, written in place at
+    num_static + (position - num_static) % window, and the last `buffer` slots take the tokens of one
+    step (a prefill chunk or gamma + 1 verified tokens), appended by the op after the filled slots.
+    Keys are stored rotated at their logical positions. With shift_static (StreamingLLM) the first
+    num_static tokens are attention sinks: their keys are also kept in sink_k and re-rotated every step
+    as if they preceded the window. Otherwise the static slots are filled per KV head by load_static
+    (tokens picked by a draft policy, see draft_policies.py) and keep their own positions.
+    A ring write evicts the token a window before it. The evicted tokens of the last `buffer` positions
+    are kept in an undo log, and put back by restore once speculation is rolled back.
+    The last slot of each buffer absorbs the writes meant for the others.
+    """
+    def __init__(self, max_batch_size, n_heads, head_dim, budget, num_static=16, buffer=64, dtype=torch.bfloat16, shift_static=True):
+        super().__init__()
+        assert 0 <= num_static < budget, f"num_static ({num_static}) must be smaller than the budget ({budget})"
+        self.budget = budget
+        self.num_static = num_static
+        self.shift_static = shift_static
+        self.window = budget - num_static
+        assert buffer <= self.window, f"The buffer ({buffer}) must not exceed the window ({self.window})"
+        self.buffer = buffer
+        cache_shape = (max_batch_size, budget + buffer, n_heads, head_dim)
+        self.register_buffer('k_cache', torch.zeros(cache_shape, dtype=dtype))
+        self.register_buffer('v_cache', torch.zeros(cache_shape, dtype=dtype))
+        self.register_buffer('sink_k', torch.zeros((max_batch_size, num_static + 1, n_heads, head_dim), dtype=dtype) if shift_static else None)
+        # logical position held by each ring slot, -1 when empty
+        self.register_buffer('ring_pos', torch.full((max_batch_size, self.window + 1), -1, dtype=torch.long))
+        # token evicted by position p, at p % buffer
+        undo_shape = (max_batch_size, buffer + 1, n_heads, head_dim)
+        self.register_buffer('undo_k', torch.zeros(undo_shape, dtype=dtype))
+        self.register_buffer('undo_v', torch.zeros(undo_shape, dtype=dtype))
+        self.register_buffer('undo_pos', torch.full((max_batch_size, buffer + 1), -1, dtype=torch.long))
+
+    def reset(self):
+        self.ring_pos.fill_(-1)
+
+    def update(self, k, v, cache_seqlens):
+        # k/v: [B, T, H, D], rotated at positions cache_seqlens + arange(T)
+        B, T = k.shape[:2]
+        S, R, U = self.num_static, self.window, self.buffer
+        dummy = self.k_cache.size(1) - 1
+        positions = cache_seqlens.long().view(-1, 1) + torch.arange(T, device=k.device)
+        batch_indices = torch.arange(B, device=k.device).view(-1, 1)
+        if self.shift_static:
+            is_static = positions < S
+            self.sink_k[batch_indices, torch.where(is_static, positions, S)] = k
+            static_slots = torch.where(is_static, positions, dummy)
+            self.k_cache[batch_indices, static_slots] = k
+            self.v_cache[batch_indices, static_slots] = v
+        # tokens of this step pushed out of the window by later ones are not written
+        last = positions[:, -1:]
+        in_ring = (positions >= S) & (positions > last - R)
+        ring_slots = torch.where(in_ring, (positions - S) % R, R)
+        logged = in_ring & (positions > last - U)
+        undo_slots = torch.where(logged, positions % U, U)
+        self.undo_k[batch_indices, undo_slots] = self.k_cache[batch_indices, S + ring_slots]
+        self.undo_v[batch_indices, undo_slots] = self.v_cache[batch_indices, S + ring_slots]
+        self.undo_pos[batch_indices, undo_slots] = self.ring_pos[batch_indices, ring_slots]
+        slots = torch.where(in_ring, S + ring_slots, dummy)
+        self.k_cache[batch_indices, slots] = k
+        self.v_cache[batch_indices, slots] = v
+        self.ring_pos[batch_indices, ring_slots] = positions
+        return positions
+
+    def restore(self, cache_seqlens):
+        # ring slots still holding positions from cache_seqlens on are rolled back speculation:
+        # put back the tokens they evicted. Before the ring wraps such slots lie past the filled ones.
+        B = cache_seqlens.size(0)
+        S, R, U = self.num_static, self.window, self.buffer
+        positions = cache_seqlens.long().view(-1, 1) + torch.arange(U, device=cache_seqlens.device)
+        batch_indices = torch.arange(B, device=cache_seqlens.device).view(-1, 1)
+        ring_slots = (positions - S) % R
+        stale = (positions >= self.budget) & (self.ring_pos[batch_indices, ring_slots] == positions)
+        undo_slots = positions % U
+        slots = torch.where(stale, S + ring_slots, self.k_cache.size(1) - 1)
+        self.k_cache[batch_indices, slots] = self.undo_k[batch_indices, undo_slots]
+        self.v_cache[batch_indices, slots] = self.undo_v[batch_indices, undo_slots]
+        self.ring_pos[batch_indices, torch.where(stale, ring_slots, R)] = self.undo_pos[batch_indices, undo_slots]
+
+    def load_static(self, k, v):
+        # k/v: [B, num_static, H, D], rotated at their own positions
+        B = k.size(0)
+        self.k_cache[:B, :self.num_static] = k
+        self.v_cache[:B, :self.num_static] = v
+
+    def attention(self, q, k, v, cache_seqlens, attn, sink_freqs=None):
+        """q: [B, T, H_q, D] and k/v: [B, T, H_k, D] rotated at cache_seqlens + arange(T). attn is a kvcache op
+        of the attention backend, run over the static and ring slots with the new tokens appended.
+        sink_freqs: [B, num_static, D // 2, 2] rotation by max(0, last position - (budget - 1)), placing the
+        sinks right before the window of the last query (with shift_static)."""
+        B = q.size(0)
+        self.restore(cache_seqlens)
+        if self.shift_static:
+            sink_k = self.sink_k[:B, :self.num_static].clone()
+            torch.ops.mylib.rope_(sink_k, sink_freqs)
+            self.k_cache[:B, :self.num_static] = sink_k
+        y = attn(q, self.k_cache, self.v_cache, k, v, cache_seqlens.clamp(max=self.budget))
+        self.update(k, v, cache_seqlens)
+        return y
+
+
+class KVOffload:
+    """Target KV of the layers from first_layer on, split into a cold prefix kept in (pinned) host memory and
+    a hot tail of recent tokens kept on the device.
+
+    Every row keeps its tokens from cold[row] on (at most resident + block_size of them, the new tokens of a
+    forward included) in a device ring per layer; the tokens before cold[row] live on the host, and move
+    there block_size at a time once more than resident tokens follow them. During a forward two device
+    buffers take turns: the next offloaded layer's cold prefix is copied in from the host on a side stream
+    (plus its hot tail, device to device) while the current layer computes, and after the layer its new
+    tokens go to the ring and the blocks turning cold to the host. The model calls start() once per forward,
+    then load(i) / store(i) around every layer i; the caches of the offloaded layers (with k_cache / v_cache
+    None) point to a device buffer between the two.
+
+    Attention reads the whole context, so each forward still moves the cold prefix of every offloaded layer
+    over the host link; only writes are amortized to one copy per block. Copies are issued per row, so both
+    sides of every transfer are contiguous.
+    """
+    def __init__(self, caches, first_layer, max_batch_size, max_seq_length, n_heads, head_dim, dtype, device, resident: int = 512, block_size: int = 256):
+        self.caches = caches
+        self.first_layer = first_layer
+        self.device = torch.device(device)
+        self.resident = resident
+        self.block_size = block_size
+        self.ring_size = resident + block_size
+        use_cuda = self.device.type == "cuda"
+        shape = (max_batch_size, max_seq_length, n_heads, head_dim)
+        ring_shape = (max_batch_size, self.ring_size, n_heads, head_dim)
+        self.host_k = [torch.zeros(shape, dtype=dtype, pin_memory=use_cuda) for _ in caches]
+        self.host_v = [torch.zeros(shape, dtype=dtype, pin_memory=use_cuda) for _ in caches]
+        self.ring_k = [torch.zeros(ring_shape, dtype=dtype, device=self.device) for _ in caches]
+        self.ring_v = [torch.zeros(ring_shape, dtype=dtype, device=self.device) for _ in caches]
+        self.buffers = [(torch.zeros(shape, dtype=dtype, device=self.device), torch.zeros(shape, dtype=dtype, device=self.device)) for _ in range(2)]
+        self.copy_stream = torch.cuda.Stream(self.device) if use_cuda else None
+        self.loaded = [None] * len(caches)
+        self.freed = [None, None]
+        # tokens of each row held on the host, a multiple of block_size
+        self.cold = [0] * max_batch_size
+
+    def host_bytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.host_k + self.host_v)
+
+    def reset(self):
+        for t in self.host_k + self.host_v:
+            t.zero_()
+        self.cold = [0] * len(self.cold)
+
+    def _on_copy_stream(self, fn, wait=None):
+        if self.copy_stream is None:
+            fn()
+            return None
+        with torch.cuda.stream(self.copy_stream):
+            if wait is not None:
+                self.copy_stream.wait_event(wait)
+            fn()
+            event = torch.cuda.Event()
+            event.record(self.copy_stream)
+        return event
+
+    def _ring_pieces(self, lo: int, hi: int):
+        # positions [lo, hi) of a row as contiguous (ring slot, position, length) pieces of the ring
+        while lo < hi:
+            slot = lo % self.ring_size
+            n = min(hi - lo, self.ring_size - slot)
+            yield slot, lo, n
+            lo += n
+
+    def _prefetch(self, j):
+        k_buf, v_buf = self.buffers[j % 2]
+        def copy():
+            for row, (host_hi, ring_lo, ring_hi) in enumerate(self.load_ranges):
+                k_buf[row, :host_hi].copy_(self.host_k[j][row, :host_hi], non_blocking=True)
+                v_buf[row, :host_hi].copy_(self.host_v[j][row, :host_hi], non_blocking=True)
+                for slot, pos, n in self._ring_pieces(ring_lo, ring_hi):
+                    k_buf[row, pos:pos + n].copy_(self.ring_k[j][row, slot:slot + n])
+                    v_buf[row, pos:pos + n].copy_(self.ring_v[j][row, slot:slot + n])
+        self.loaded[j] = self._on_copy_stream(copy, wait=self.freed[j % 2])
+
+    def start(self, cache_seqlens, num_new: int):
+        # one host sync per forward for the per-row ranges of tokens to move
+        self.load_ranges, self.store_ranges = [], []
+        for row, length in enumerate(cache_seqlens.tolist()):
+            end = length + num_new
+            old_cold = self.cold[row]
+            # a row rewritten below its cold boundary (a new prompt) takes those blocks back into the ring
+            base = min(old_cold, length // self.block_size * self.block_size)
+            cold = max(base, max(end - self.resident, 0) // self.block_size * self.block_size)
+            # read the cold prefix from the host and the rest of the cached tokens from the ring
+            self.load_ranges.append((min(old_cold, length), old_cold, length))
+            # write the tokens turning cold to the host, and the ring's new or reloaded tokens to it
+            ring_lo = max(cold, length) if length >= old_cold else cold
+            self.store_ranges.append((min(old_cold, length), cold, ring_lo, end))
+            self.cold[row] = cold
+        if len(self.caches) > 0:
+            self._prefetch(0)
+
+    def load(self, layer: int):
+        j = layer - self.first_layer
+        if j < 0:
+            return
+        if j + 1 < len(self.caches):
+            self._prefetch(j + 1)
+        if self.loaded[j] is not None:
+            torch.cuda.current_stream(self.device).wait_event(self.loaded[j])
+        self.caches[j].k_cache, self.caches[j].v_cache = self.buffers[j % 2]
+
+    def store(self, layer: int):
+        j = layer - self.first_layer
+        if j < 0:
+            return
+        k_buf, v_buf = self.buffers[j % 2]
+        def copy():
+            for row, (host_lo, host_hi, ring_lo, ring_hi) in enumerate(self.store_ranges):
+                if host_lo < host_hi:
+                    self.host_k[j][row, host_lo:host_hi].copy_(k_buf[row, host_lo:host_hi], non_blocking=True)
+                    self.host_v[j][row, host_lo:host_hi].copy_(v_buf[row, host_lo:host_hi], non_blocking=True)
+                for slot, pos, n in self._ring_pieces(ring_lo, ring_hi):
+                    self.ring_k[j][row, slot:slot + n].copy_(k_buf[row, pos:pos + n])
+                    self.ring_v[j][row, slot:slot + n].copy_(v_buf[row, pos:pos + n])
+        computed = None
+        if self.copy_stream is not None:
+            computed = torch.cuda.Event()
+            computed.record(torch.cuda.current_stream(self.device))
+        self.freed[j % 2] = self._on_copy_stream(copy, wait=computed)
+        self.caches[j].k_cache, self.caches[j].v_cache = None, None
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+
+import torch
+
+from MagicDec.Engine.kv_cache import slot_caches
+
+# per-token buffers of a target KV cache, [B, max_seq_length, ...]
+TARGET_BUFFERS = ("k_cache", "v_cache", "k_scale", "v_scale")
+
+
+def token_hash(tokens: torch.LongTensor) -> str:
+    return hashlib.sha256(tokens.flatten().to(device="cpu", dtype=torch.int64).numpy().tobytes()).hexdigest()
+
+
+class KVSnapshotStore:
+    """Snapshots of single sequences' KV caches on disk, indexed by a hash of their tokens.
+
+    A snapshot holds the target KV of a batch slot up to its length, the draft cache state of the slot
+    (the draft model's or the self-speculation engine's streaming cache), the target and draft cachelens
+    and optionally the logits of the last token. Its tensors are laid out in one raw file next to a JSON
+    header, written and read through torch.from_file, so restoring pages in only what is copied to the
+    device. index.json maps the sha256 of the token prefix of every snapshot to its length; a prompt is
+    matched against its longest stored prefix.
+
+    engine is a target LMBackend (plain or quantized KV cache, optionally with draft an LMBackend_Draft)
+    or a self-speculation LMBackend. With the score-based draft policies the draft KV depends on the whole
+    prompt, so only snapshots of the whole prompt are matched.
+    """
+    def __init__(self, directory: str, engine, draft=None):
+        assert getattr(engine, "block_manager", None) is None and engine.model.kv_offload is None, "KV snapshots need a resident, unpaged KV cache"
+        self.directory = directory
+        self.engine = engine
+        self.draft = draft
+        policy = getattr(engine, "draft_policy", None)
+        self.whole_prompt_only = policy is not None and policy.needs_scores
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def _target_caches(self):
+        return [b.attention.kv_cache for b in self.engine.model.layers]
+
+    def _draft_caches(self):
+        if self.draft is not None:
+            return [b.attention.kv_cache for b in self.draft.model.layers]
+        return [b.attention.kv_cache.draft_cache for b in self.engine.model.layers if getattr(b.attention.kv_cache, "draft_cache", None) is not None]
+
+    def _tensors(self, slot: int, length: int):
+        # (name, tensor) of everything a snapshot holds for slot, views into the live caches
+        tensors = []
+        for layer, cache in enumerate(self._target_caches()):
+            for name in TARGET_BUFFERS:
+                buf = getattr(cache, name, None)
+                if buf is not None:
+                    tensors.append((f"target.{layer}.{name}", buf[slot, :length]))
+        for layer, cache in enumerate(self._draft_caches()):
+            for name, buf in cache.named_buffers():
+                if buf is not None:
+                    tensors.append((f"draft.{layer}.{name}", buf[slot]))
+        return tensors
+
+    def _draft_cachelens(self):
+        if self.draft is not None:
+            return self.draft.cachelens
+        return getattr(self.engine, "draft_cachelens", None)
+
+    def _paths(self, key: str):
+        return os.path.join(self.directory, key + ".json"), os.path.join(self.directory, key + ".kv")
+
+    def _write_json(self, path: str, obj):
+        # write to a temporary file and rename, so readers never see a partial file
+        with open(path + ".tmp", "w") as f:
+            json.dump(obj, f)
+        os.replace(path + ".tmp", path)
+
+    @torch.inference_mode()
+    def save(self, slot: int, tokens: torch.LongTensor, logits: torch.Tensor = None) -> str:
+        """Snapshot slot, holding the first engine.cachelens[slot] tokens of tokens (1D). logits [vocab] of
+        its last token are stored when given. Returns the key of the snapshot."""
+        length = int(self.engine.cachelens[slot])
+        tokens = tokens.flatten()
+        assert 0 < length <= tokens.numel()
+        key = token_hash(tokens[:length])
+        header_path, data_path = self._paths(key)
+        tensors = self._tensors(slot, length)
+        if logits is not None:
+            tensors.append(("logits", logits.flatten()))
+        entries, offset = [], 0
+        for name, t in tensors:
+            entries.append({"name": name, "dtype": str(t.dtype).replace("torch.", ""), "shape": list(t.shape), "offset": offset})
+            # keep every tensor 64-byte aligned so it can be viewed in place
+            offset += (t.numel() * t.element_size() + 63) // 64 * 64
+        data = torch.from_file(data_path + ".tmp", shared=True, size=max(offset, 1), dtype=torch.uint8)
+        for entry, (_, t) in zip(entries, tensors):
+            self._view(data, entry).copy_(t)
+        del data
+        os.replace(data_path + ".tmp", data_path)
+        draft_cachelens = self._draft_cachelens()
+        self._write_json(header_path, {"length": length, "size": offset, "tensors": entries,
+                                       "draft_cachelen": None if draft_cachelens is None else int(draft_cachelens[slot])})
+        self.index[key] = length
+        self._write_json(self.index_path, self.index)
+        return key
+
+    def _view(self, data: torch.Tensor, entry):
+        dtype = getattr(torch, entry["dtype"])
+        shape = entry["shape"]
+        numel = 1
+        for s in shape:
+            numel *= s
+        nbytes = numel * torch.empty(0, dtype=dtype).element_size()
+        return data[entry["offset"]:entry["offset"] + nbytes].view(dtype).view(shape)
+
+    def lookup(self, tokens: torch.LongTensor):
+        """Key and length of the longest stored prefix of tokens (1D), or (None, 0)."""
+        tokens = tokens.flatten()
+        lengths = sorted(set(self.index.values()), reverse=True)
+        for length in lengths:
+            if length > tokens.numel() or (self.whole_prompt_only and length != tokens.numel()):
+                continue
+            key = token_hash(tokens[:length])
+            if key in self.index and os.path.exists(self._paths(key)[0]):
+                return key, length
+        return None, 0
+
+    @torch.inference_mode()
+    def restore(self, slot: int, tokens: torch.LongTensor):
+        """Load the snapshot of the longest stored prefix of tokens into slot of the target and draft caches.
+        Returns (number of tokens restored, logits of the last one or None); prefill goes on from there."""
+        key, length = self.lookup(tokens)
+        if key is None:
+            return 0, None
+        header_path, data_path = self._paths(key)
+        with open(header_path) as f:
+            header = json.load(f)
+        data = torch.from_file(data_path, shared=False, size=max(header["size"], 1), dtype=torch.uint8)
+        live = dict(self._tensors(slot, length))
+        logits = None
+        for entry in header["tensors"]:
+            if entry["name"] == "logits":
+                logits = self._view(data, entry).to(self.engine.device)
+                continue
+            assert entry["name"] in live and list(live[entry["name"]].shape) == entry["shape"], f"Snapshot {key} does not match the caches of this engine ({entry['name']})"
+            live[entry["name"]].copy_(self._view(data, entry))
+        for cache in self._target_caches():
+            if hasattr(cache, "page_min"):
+                with slot_caches([cache], slot):
+                    cache.refresh_pages(torch.zeros(1, dtype=torch.int32, device=self.engine.device), length)
+        self.engine.cachelens[slot] = length
+        draft_cachelens = self._draft_cachelens()
+        if draft_cachelens is not None:
+            draft_cachelens[slot] = header["draft_cachelen"]
+        return length, logits
+
+    def remove(self, key: str):
+        self.index.pop(key, None)
+        self._write_json(self.index_path, self.index)
+        for path in self._paths(key):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @torch.inference_mode()
+    def encode(self, input_ids: torch.LongTensor, seqlens: torch.LongTensor = None):
+        """Like engine.encode (and draft.encode): prefill every row into its slot, starting from the longest
+        stored snapshot of its prompt, and snapshot the whole prompts. Returns the logits [B, 1, vocab] of the
+        last prompt token of every row."""
+        logits = []
+        for b in range(input_ids.shape[0]):
+            seq_len = input_ids.shape[1] if seqlens is None else int(seqlens[b])
+            prompt = input_ids[b:b+1, :seq_len]
+            start, last_logits = self.restore(b, prompt)
+            if start < seq_len or last_logits is None:
+                # a whole-prompt snapshot without logits recomputes the last token
+                start = min(start, seq_len - 1)
+                last_logits = self.engine.prefill_slot(b, prompt, start)[0, -1]
+                if self.draft is not None:
+                    self.draft.prefill_slot(b, prompt, start)
+                self.save(b, prompt, last_logits)
+            logits.append(last_logits.view(1, 1, -1))
+        return torch.cat(logits)
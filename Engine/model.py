@@ -7,6 +7,10 @@ from torch import Tensor
 from torch.nn import functional as F
 import torch.distributed as dist
 import math 
+from MagicDec.Engine.attn_backends import AttnBackend, get_attn_backend
+# registers the fused mylib::rms_norm, mylib::add_rms_norm, mylib::rope_ and mylib::silu_mul ops
+import MagicDec.Engine.fused_ops
+from MagicDec.Engine.kv_cache import KV_QUANT_DTYPES, KVOffload
 
 def find_multiple(n: int, k: int) -> int:
     if n % k == 0:
@@ -68,11 +72,40 @@ transformer_configs = {
 }
 
 class KVCache(nn.Module):
-    def __init__(self, max_batch_size, max_seq_length, n_heads, head_dim, dtype=torch.bfloat16):
+    def __init__(self, max_batch_size, max_seq_length, n_heads, head_dim, dtype=torch.bfloat16, offload=False):
+        super().__init__()
+        cache_shape = (max_batch_size, max_seq_length, n_heads, head_dim)
+        # offloaded caches get their device buffers from KVOffload while their layer runs
+        self.register_buffer('k_cache', None if offload else torch.zeros(cache_shape, dtype=dtype))
+        self.register_buffer('v_cache', None if offload else torch.zeros(cache_shape, dtype=dtype))
+
+    def commit_path(self, cache_seqlens, path):
+        # move the KV of the accepted tree nodes path [B, L] to the slots cache_seqlens + arange(L)
+        B, L = path.size()
+        batch_indices = torch.arange(B, device=path.device).view(-1, 1)
+        src = cache_seqlens.long().view(-1, 1) + path
+        dst = cache_seqlens.long().view(-1, 1) + torch.arange(L, device=path.device)
+        self.k_cache[batch_indices, dst] = self.k_cache[batch_indices, src]
+        self.v_cache[batch_indices, dst] = self.v_cache[batch_indices, src]
+
+class PagedKVCache(nn.Module):
+    def __init__(self, num_pages, page_size, n_heads, head_dim, block_table, dtype=torch.bfloat16):
+        super().__init__()
+        cache_shape = (num_pages, page_size, n_heads, head_dim)
+        self.register_buffer('k_cache', torch.zeros(cache_shape, dtype=dtype))
+        self.register_buffer('v_cache', torch.zeros(cache_shape, dtype=dtype))
+        # [max_batch_size, max_pages_per_seq], shared by all layers and filled by BlockManager
+        self.block_table = block_table
+
+class QuantKVCache(nn.Module):
+    def __init__(self, max_batch_size, max_seq_length, n_heads, head_dim, dtype=torch.int8):
         super().__init__()
         cache_shape = (max_batch_size, max_seq_length, n_heads, head_dim)
         self.register_buffer('k_cache', torch.zeros(cache_shape, dtype=dtype))
         self.register_buffer('v_cache', torch.zeros(cache_shape, dtype=dtype))
+        # per-token, per-head dequantization scales
+        self.register_buffer('k_scale', torch.zeros(cache_shape[:-1], dtype=torch.float32))
+        self.register_buffer('v_scale', torch.zeros(cache_shape[:-1], dtype=torch.float32))
 
 class Transformer(nn.Module):
     def __init__(self, config: ModelArgs) -> None:
@@ -88,8 +121,9 @@ class Transformer(nn.Module):
         self.mask_cache: Optional[Tensor] = None
         self.max_batch_size = -1
         self.max_seq_length = -1
+        self.kv_offload = None
 
-    def setup_caches(self, max_batch_size, max_seq_length):
+    def setup_caches(self, max_batch_size, max_seq_length, page_size=None, num_pages=None, kv_quant=None, offload_layers=0):
         if self.max_seq_length >= max_seq_length and self.max_batch_size >= max_batch_size:
             return
         head_dim = self.config.dim // self.config.n_head
@@ -102,8 +136,32 @@ class Transformer(nn.Module):
             dtype = self.output.scales.dtype
         elif hasattr(self.output, "scales_and_zeros"):
             dtype = self.output.scales_and_zeros.dtype
-        for b in self.layers:
-            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, self.config.n_local_heads, head_dim, dtype)
+        assert page_size is None or kv_quant is None, "Paged and quantized KV caches can not be combined"
+        assert offload_layers == 0 or (page_size is None and kv_quant is None), "Only the plain KV cache can be offloaded"
+        self.block_table = None
+        self.kv_offload = None
+        if kv_quant is not None:
+            assert kv_quant in KV_QUANT_DTYPES, f"Unknown KV cache quantization {kv_quant}, choose from {list(KV_QUANT_DTYPES.keys())}"
+            for b in self.layers:
+                b.attention.kv_cache = QuantKVCache(max_batch_size, max_seq_length, self.config.n_local_heads, head_dim, KV_QUANT_DTYPES[kv_quant])
+        elif page_size is None:
+            # the KV of the last offload_layers layers lives in host memory
+            first_offloaded = self.config.n_layer - offload_layers
+            for i, b in enumerate(self.layers):
+                b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, self.config.n_local_heads, head_dim, dtype, offload=i >= first_offloaded)
+            if offload_layers > 0:
+                self.kv_offload = KVOffload([b.attention.kv_cache for b in self.layers[first_offloaded:]], first_offloaded,
+                                            max_batch_size, max_seq_length, self.config.n_local_heads, head_dim, dtype, self.output.weight.device)
+        else:
+            # paged cache: sequences take pages from a shared pool of num_pages (by default max_seq_length tokens
+            # per slot) plus BlockManager's scratch page. A sequence may grow past max_seq_length into pages freed
+            # by shorter ones, up to the whole pool or the model's block_size
+            if num_pages is None:
+                num_pages = max_batch_size * ((max_seq_length + page_size - 1) // page_size)
+            max_pages_per_seq = min(num_pages, (self.config.block_size + page_size - 1) // page_size)
+            self.block_table = torch.full((max_batch_size, max_pages_per_seq), num_pages, dtype=torch.int32)
+            for b in self.layers:
+                b.attention.kv_cache = PagedKVCache(num_pages + 1, page_size, self.config.n_local_heads, head_dim, self.block_table, dtype)
 
         if (self.config.high_freq_factor is not None) and (self.config.low_freq_factor is not None):
             self.freqs_cis = precompute_freqs_cis(self.config.block_size, self.config.dim // self.config.n_head, self.config.rope_base,dtype,
@@ -114,28 +172,52 @@ class Transformer(nn.Module):
                                                   # new params
                                                   self.config.scaling_factor)
 
-    def forward(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor) -> Tensor:
+    def forward(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor, tree_mask: Optional[Tensor] = None) -> Tensor:
         assert self.freqs_cis is not None, "Caches must be initialized first"
 
         freqs_cis = self.freqs_cis[input_pos]
         x = self.tok_embeddings(idx)
+        if self.kv_offload is not None:
+            self.kv_offload.start(cache_seqlens, idx.size(1))
         for i, layer in enumerate(self.layers):
-            x = layer(x, freqs_cis, cache_seqlens)
+            if self.kv_offload is not None:
+                self.kv_offload.load(i)
+            x = layer(x, freqs_cis, cache_seqlens, tree_mask)
+            if self.kv_offload is not None:
+                self.kv_offload.store(i)
         x = self.norm(x)
         logits = self.output(x)
         return logits
 
-    def prefill(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor) -> Tensor:
+    def prefill(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor, cu_seqlens: Optional[Tensor] = None) -> Tensor:
+        # with cu_seqlens ([B + 1] offsets), idx / input_pos are [1, N] holding the new tokens of every row back
+        # to back, and the logits [1, B, vocab] of the last token of each row are returned
         assert self.freqs_cis is not None, "Caches must be initialized first"
 
         freqs_cis = self.freqs_cis[input_pos]
         x = self.tok_embeddings(idx)
+        if self.kv_offload is not None:
+            self.kv_offload.start(cache_seqlens, idx.size(1))
         for i, layer in enumerate(self.layers):
-            x = layer.prefill(x, freqs_cis, cache_seqlens)
+            if self.kv_offload is not None:
+                self.kv_offload.load(i)
+            x = layer.prefill(x, freqs_cis, cache_seqlens, cu_seqlens)
+            if self.kv_offload is not None:
+                self.kv_offload.store(i)
+        if cu_seqlens is not None:
+            x = x[:, (cu_seqlens[1:] - 1).clamp(min=0)]
         x = self.norm(x)
         logits = self.output(x)
         return logits
 
+    def commit_tree_path(self, cache_seqlens: Tensor, path: Tensor):
+        for b in self.layers:
+            b.attention.kv_cache.commit_path(cache_seqlens, path)
+
+    def set_attn_backend(self, backend: AttnBackend):
+        for b in self.layers:
+            b.attention.set_attn_backend(backend)
+
     @classmethod
     def from_name(cls, name: str):
         return cls(ModelArgs.from_name(name))
@@ -149,14 +231,14 @@ class TransformerBlock(nn.Module):
         self.ffn_norm = RMSNorm(config.dim, config.norm_eps)
         self.attention_norm = RMSNorm(config.dim, config.norm_eps)
 
-    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
-        h = x + self.attention(self.attention_norm(x), freqs_cis, cache_seqlens)
-        out = h + self.feed_forward(self.ffn_norm(h))
+    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor, tree_mask: Optional[Tensor] = None) -> Tensor:
+        normed, h = self.ffn_norm.forward_add(self.attention(self.attention_norm(x), freqs_cis, cache_seqlens, tree_mask), x)
+        out = h + self.feed_forward(normed)
         return out
 
-    def prefill(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
-        h = x + self.attention.prefill(self.attention_norm(x), freqs_cis, cache_seqlens)
-        out = h + self.feed_forward(self.ffn_norm(h))
+    def prefill(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor, cu_seqlens: Optional[Tensor] = None) -> Tensor:
+        normed, h = self.ffn_norm.forward_add(self.attention.prefill(self.attention_norm(x), freqs_cis, cache_seqlens, cu_seqlens), x)
+        out = h + self.feed_forward(normed)
         return out
 
 
@@ -177,11 +259,17 @@ class Attention(nn.Module):
         self.n_local_heads = config.n_local_heads
         self.dim = config.dim
         self._register_load_state_dict_pre_hook(self.load_hook)
+        self.set_attn_backend(get_attn_backend())
 
+    def set_attn_backend(self, backend: AttnBackend):
         if self.n_head == self.n_local_heads:
-            self._attn = torch.ops.mylib.custom_func
+            self._attn = backend.decode_with_kvcache or backend.attn_with_kvcache
         else:
-            self._attn = torch.ops.mylib.gqa_custom
+            self._attn = backend.gqa_with_kvcache
+        self._attn_kvcache = backend.attn_with_kvcache
+        self._attn_nocache = backend.attn
+        self._paged_attn = backend.paged_attn_with_kvcache
+        self._quant_attn = backend.quant_attn_with_kvcache
 
     def load_hook(self, state_dict, prefix, *args):
         if prefix + "wq.weight" in state_dict:
@@ -190,7 +278,7 @@ class Attention(nn.Module):
             wv = state_dict.pop(prefix + "wv.weight")
             state_dict[prefix + "wqkv.weight"] = torch.cat([wq, wk, wv])
 
-    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
+    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor, tree_mask: Optional[Tensor] = None) -> Tensor:
         bsz, seqlen, _ = x.shape
 
         kv_size = self.n_local_heads * self.head_dim
@@ -200,15 +288,22 @@ class Attention(nn.Module):
         k = k.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         v = v.view(bsz, seqlen, self.n_local_heads, self.head_dim)
 
-        q = apply_rotary_emb(q, freqs_cis)
-        k = apply_rotary_emb(k, freqs_cis)
+        torch.ops.mylib.rope_(q, freqs_cis)
+        torch.ops.mylib.rope_(k, freqs_cis)
 
         if self.kv_cache is not None:
             k_cache, v_cache = self.kv_cache.k_cache, self.kv_cache.v_cache
 
         # for decoding and verification, use gqa_custom
-        y = self._attn(q, k_cache, v_cache, k, v, cache_seqlens)
-        # y = torch.ops.mylib.custom_func(q, k_cache, v_cache, k, v, cache_seqlens)
+        if tree_mask is not None:
+            y = torch.ops.mylib.tree_func(q, k_cache, v_cache, k, v, cache_seqlens, tree_mask)
+        elif isinstance(self.kv_cache, PagedKVCache):
+            y = self._paged_attn(q, k_cache, v_cache, k, v, cache_seqlens, self.kv_cache.block_table)
+        elif isinstance(self.kv_cache, QuantKVCache):
+            y = self._quant_attn(q, k_cache, v_cache, self.kv_cache.k_scale, self.kv_cache.v_scale, k, v, cache_seqlens)
+        else:
+            y = self._attn(q, k_cache, v_cache, k, v, cache_seqlens)
+        # y = self._attn_kvcache(q, k_cache, v_cache, k, v, cache_seqlens)
 
         y = y.contiguous().view(bsz, seqlen, self.dim)
 
@@ -217,7 +312,7 @@ class Attention(nn.Module):
             dist.all_reduce(y)
         return y
 
-    def prefill(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
+    def prefill(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor, cu_seqlens: Optional[Tensor] = None) -> Tensor:
         bsz, seqlen, _ = x.shape
 
         kv_size = self.n_local_heads * self.head_dim
@@ -227,14 +322,22 @@ class Attention(nn.Module):
         k = k.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         v = v.view(bsz, seqlen, self.n_local_heads, self.head_dim)
 
-        q = apply_rotary_emb(q, freqs_cis)
-        k = apply_rotary_emb(k, freqs_cis)
+        torch.ops.mylib.rope_(q, freqs_cis)
+        torch.ops.mylib.rope_(k, freqs_cis)
 
         if self.kv_cache is not None:
             k_cache, v_cache = self.kv_cache.k_cache, self.kv_cache.v_cache
 
         # for prefill, use original impl
-        y = torch.ops.mylib.custom_func(q, k_cache, v_cache, k, v, cache_seqlens)
+        if cu_seqlens is not None:
+            assert isinstance(self.kv_cache, KVCache), "Packed prefill needs the plain KV cache"
+            y = torch.ops.mylib.varlen_func(q, k_cache, v_cache, k, v, cache_seqlens, cu_seqlens)
+        elif isinstance(self.kv_cache, PagedKVCache):
+            y = self._paged_attn(q, k_cache, v_cache, k, v, cache_seqlens, self.kv_cache.block_table)
+        elif isinstance(self.kv_cache, QuantKVCache):
+            y = torch.ops.mylib.sdpa_quant_func(q, k_cache, v_cache, self.kv_cache.k_scale, self.kv_cache.v_scale, k, v, cache_seqlens)
+        else:
+            y = self._attn_kvcache(q, k_cache, v_cache, k, v, cache_seqlens)
 
         y = y.contiguous().view(bsz, seqlen, self.dim)
 
@@ -246,13 +349,20 @@ class Attention(nn.Module):
 class FeedForward(nn.Module):
     def __init__(self, config: ModelArgs) -> None:
         super().__init__()
-        self.w1 = nn.Linear(config.dim, config.intermediate_size, bias=False)
-        self.w3 = nn.Linear(config.dim, config.intermediate_size, bias=False)
+        # gate (w1) and up (w3) projections merged into one matrix
+        self.w13 = nn.Linear(config.dim, 2 * config.intermediate_size, bias=False)
         self.w2 = nn.Linear(config.intermediate_size, config.dim, bias=False)
         self.process_group = None
+        self._register_load_state_dict_pre_hook(self.load_hook)
+
+    def load_hook(self, state_dict, prefix, *args):
+        if prefix + "w1.weight" in state_dict:
+            w1 = state_dict.pop(prefix + "w1.weight")
+            w3 = state_dict.pop(prefix + "w3.weight")
+            state_dict[prefix + "w13.weight"] = torch.cat([w1, w3])
 
     def forward(self, x: Tensor) -> Tensor:
-        y = self.w2(F.silu(self.w1(x)) * self.w3(x))
+        y = self.w2(torch.ops.mylib.silu_mul(self.w13(x)))
         if self.process_group != None:
             dist.all_reduce(y)
         return y
@@ -264,12 +374,12 @@ class RMSNorm(nn.Module):
         self.eps = eps
         self.weight = nn.Parameter(torch.ones(dim))
 
-    def _norm(self, x):
-        return x * torch.rsqrt(torch.mean(x * x, dim=-1, keepdim=True) + self.eps)
-
     def forward(self, x: Tensor) -> Tensor:
-        output = self._norm(x.float()).type_as(x)
-        return output * self.weight
+        return torch.ops.mylib.rms_norm(x, self.weight, self.eps)
+
+    def forward_add(self, x: Tensor, residual: Tensor):
+        # norm of x + residual, fused with the residual add: returns (normed, x + residual)
+        return torch.ops.mylib.add_rms_norm(x, residual, self.weight, self.eps)
 
 
 def _compute_llama3_parameters(inv_freq, old_context_len=8192, scaling_factor=8,low_freq_factor=1,high_freq_factor=4):
@@ -7,7 +7,11 @@ from torch import Tensor
 from torch.nn import functional as F
 import torch.distributed as dist
 import math 
-from MagicDec.Engine.utils import custom_func, custom_func_2
+from MagicDec.Engine.attn_backends import AttnBackend, get_attn_backend
+# registers the fused mylib::rms_norm, mylib::add_rms_norm, mylib::rope_ and mylib::silu_mul ops
+import MagicDec.Engine.fused_ops
+from MagicDec.Engine.kv_cache import StreamingKVCache
+from MagicDec.Engine.draft_vocab import prune_rows
 
 
 def find_multiple(n: int, k: int) -> int:
@@ -69,29 +73,6 @@ transformer_configs = {
     "llama-3.1-8b": dict(block_size=131072, n_layer=32, n_head=32, n_local_heads=8, dim=4096, intermediate_size=14336, vocab_size=128256, rope_base=500000.0, scaling_factor=8, high_freq_factor=4, low_freq_factor=1, original_max_position_embeddings=8192),
 }
 
-class KVCache(nn.Module):
-    def __init__(self, max_batch_size, max_seq_length, n_heads, head_dim, dtype=torch.bfloat16, kv_len=512):
-        super().__init__()
-        cache_shape = (max_batch_size, max_seq_length, n_heads, head_dim)
-        self.register_buffer('k_cache', torch.zeros(cache_shape, dtype=dtype))
-        self.register_buffer('v_cache', torch.zeros(cache_shape, dtype=dtype))
-        self.register_buffer('batch_indices',torch.arange(max_batch_size).unsqueeze(1))
-        self.kv_len = kv_len
-    
-    def prefill(self, cache_len, k_val, v_val):
-        k_out = self.k_cache
-        v_out = self.v_cache
-        if cache_len+k_val.shape[1] <= self.kv_len:
-            k_out[:, cache_len: cache_len+k_val.shape[1]] = k_val
-            v_out[:, cache_len: cache_len+v_val.shape[1]] = v_val
-            return k_out[:, :cache_len+k_val.shape[1]], v_out[:, :cache_len+k_val.shape[1]]
-        else:
-            new_k = torch.cat((k_out[:, 16:self.kv_len], k_val), dim=1)[:, -self.kv_len+16:]
-            new_v = torch.cat((v_out[:, 16:self.kv_len], v_val), dim=1)[:, -self.kv_len+16:]
-            k_out[:, 16:self.kv_len] = new_k
-            v_out[:, 16:self.kv_len] = new_v
-            return k_out[:, :self.kv_len], v_out[:, :self.kv_len]
-
 class Transformer(nn.Module):
     def __init__(self, config: ModelArgs) -> None:
         super().__init__()
@@ -101,13 +82,15 @@ class Transformer(nn.Module):
         self.layers = nn.ModuleList(TransformerBlock(config) for _ in range(config.n_layer))
         self.norm = RMSNorm(config.dim, eps=config.norm_eps)
         self.output = nn.Linear(config.dim, config.vocab_size, bias=False)
+        # full vocabulary id of every output row once the LM head is pruned, see setup_draft_vocab
+        self.register_buffer('draft_vocab', None, persistent=False)
 
         self.freqs_cis: Optional[Tensor] = None
         self.mask_cache: Optional[Tensor] = None
         self.max_batch_size = -1
         self.max_seq_length = -1
 
-    def setup_caches(self, max_batch_size, max_seq_length, kv_len):
+    def setup_caches(self, max_batch_size, max_seq_length, kv_len, num_sinks=16, buffer=64):
         if self.max_seq_length >= max_seq_length and self.max_batch_size >= max_batch_size:
             return
         head_dim = self.config.dim // self.config.n_head
@@ -119,40 +102,46 @@ class Transformer(nn.Module):
             dtype = self.output.scales.dtype
         elif hasattr(self.output, "scales_and_zeros"):
             dtype = self.output.scales_and_zeros.dtype
+        self.kv_len = kv_len
+        self.num_sinks = num_sinks
         for b in self.layers:
-            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, self.config.n_local_heads, head_dim, dtype, kv_len)
+            b.attention.kv_cache = StreamingKVCache(max_batch_size, self.config.n_local_heads, head_dim, kv_len, num_sinks, buffer, dtype)
 
         if (self.config.high_freq_factor is not None) and (self.config.low_freq_factor is not None):
-            self.freqs_cis = precompute_freqs_cis(self.config.block_size, self.config.dim // self.config.n_head, self.config.rope_base,dtype,
+            self.freqs_cis = precompute_freqs_cis(max(self.config.block_size, max_seq_length), self.config.dim // self.config.n_head, self.config.rope_base,dtype,
                                                   # new params
                                                   self.config.scaling_factor, self.config.low_freq_factor, self.config.high_freq_factor, self.config.original_max_position_embeddings)
         else:
-            self.freqs_cis = precompute_freqs_cis(self.config.block_size, self.config.dim // self.config.n_head, self.config.rope_base,dtype,
+            self.freqs_cis = precompute_freqs_cis(max(self.config.block_size, max_seq_length), self.config.dim // self.config.n_head, self.config.rope_base,dtype,
                                                   # new params
                                                 self.config.scaling_factor)
-        
-        self.prefill_freqs = self.freqs_cis[torch.arange(kv_len).unsqueeze(0).repeat(max_batch_size,1)]
 
     def forward(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor) -> Tensor:
         assert self.freqs_cis is not None, "Caches must be initialized first"
+        # input_pos are logical positions in the draft stream, sinks are attended as if they preceded the window
         freqs_cis = self.freqs_cis[input_pos]
+        shift = (input_pos[:, -1:] - (self.kv_len - 1)).clamp(min=0)
+        sink_freqs = self.freqs_cis[shift.expand(-1, self.num_sinks)]
         x = self.tok_embeddings(idx)
         for i, layer in enumerate(self.layers):
-            x = layer(x, freqs_cis, cache_seqlens)
-        x = self.norm(x)
-        logits = self.output(x)
-        return logits
-    
-    def prefill(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor, is_last = False) -> Tensor:
-        assert self.freqs_cis is not None, "Caches must be initialized first"
-        q_freqs_cis = self.freqs_cis[input_pos]
-        x = self.tok_embeddings(idx)
-        for i, layer in enumerate(self.layers):
-            x = layer.prefill(x, q_freqs_cis, self.prefill_freqs, cache_seqlens, is_last)
+            x = layer(x, freqs_cis, sink_freqs, cache_seqlens)
         x = self.norm(x)
         logits = self.output(x)
         return logits
 
+    def prefill(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor) -> Tensor:
+        # prompt chunks go through the same ring buffer as decoding
+        return self.forward(idx, input_pos, cache_seqlens)
+
+    def setup_draft_vocab(self, vocab: Tensor):
+        # keep only the LM head rows of the token ids vocab [N]: logits are over vocab, mapped back with draft_vocab
+        self.output = prune_rows(self.output, vocab)
+        self.draft_vocab = vocab.to(self.tok_embeddings.weight.device)
+
+    def set_attn_backend(self, backend: AttnBackend):
+        for b in self.layers:
+            b.attention.set_attn_backend(backend)
+
     @classmethod
     def from_name(cls, name: str):
         return cls(ModelArgs.from_name(name))
@@ -166,14 +155,9 @@ class TransformerBlock(nn.Module):
         self.ffn_norm = RMSNorm(config.dim, config.norm_eps)
         self.attention_norm = RMSNorm(config.dim, config.norm_eps)
 
-    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
-        h = x + self.attention(self.attention_norm(x), freqs_cis, cache_seqlens)
-        out = h + self.feed_forward(self.ffn_norm(h))
-        return out
-    
-    def prefill(self, x: Tensor, q_freqs_cis: Tensor, prefill_freqs: Tensor, cache_seqlens: Tensor, is_last: bool) -> Tensor:
-        h = x + self.attention.prefill(self.attention_norm(x), q_freqs_cis, prefill_freqs, cache_seqlens, is_last)
-        out = h + self.feed_forward(self.ffn_norm(h))
+    def forward(self, x: Tensor, freqs_cis: Tensor, sink_freqs: Tensor, cache_seqlens: Tensor) -> Tensor:
+        normed, h = self.ffn_norm.forward_add(self.attention(self.attention_norm(x), freqs_cis, sink_freqs, cache_seqlens), x)
+        out = h + self.feed_forward(normed)
         return out
 
 
@@ -194,11 +178,15 @@ class Attention(nn.Module):
         self.n_local_heads = config.n_local_heads
         self.dim = config.dim
         self._register_load_state_dict_pre_hook(self.load_hook)
+        self.set_attn_backend(get_attn_backend())
 
+    def set_attn_backend(self, backend: AttnBackend):
         if self.n_head == self.n_local_heads:
-            self._attn = torch.ops.mylib.custom_func
+            self._attn = backend.decode_with_kvcache or backend.attn_with_kvcache
         else:
-            self._attn = torch.ops.mylib.gqa_custom
+            self._attn = backend.gqa_with_kvcache
+        self._attn_kvcache = backend.attn_with_kvcache
+        self._attn_nocache = backend.attn
 
     def load_hook(self, state_dict, prefix, *args):
         if prefix + "wq.weight" in state_dict:
@@ -207,7 +195,7 @@ class Attention(nn.Module):
             wv = state_dict.pop(prefix + "wv.weight")
             state_dict[prefix + "wqkv.weight"] = torch.cat([wq, wk, wv])
 
-    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
+    def forward(self, x: Tensor, freqs_cis: Tensor, sink_freqs: Tensor, cache_seqlens: Tensor) -> Tensor:
         bsz, seqlen, _ = x.shape
 
         kv_size = self.n_local_heads * self.head_dim
@@ -217,44 +205,10 @@ class Attention(nn.Module):
         k = k.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         v = v.view(bsz, seqlen, self.n_local_heads, self.head_dim)
 
-        q = apply_rotary_emb(q, freqs_cis)
-        k = apply_rotary_emb(k, freqs_cis)
-
-        k_cache, v_cache = self.kv_cache.k_cache, self.kv_cache.v_cache
+        torch.ops.mylib.rope_(q, freqs_cis)
+        torch.ops.mylib.rope_(k, freqs_cis)
 
-        y = torch.ops.mylib.custom_func(q, k_cache, v_cache, k, v, cache_seqlens)
-        # y = self._attn(q, k_cache, v_cache, k, v, cache_seqlens)
-
-        y = y.contiguous().view(bsz, seqlen, self.dim)
-
-        y = self.wo(y)
-        if self.process_group != None:
-            dist.all_reduce(y, group=self.process_group)
-        return y
-    
-    def prefill(self, x: Tensor, q_freqs: Tensor, prefill_freqs: Tensor, cache_seqlens: Tensor, is_last: bool) -> Tensor:
-
-        bsz, seqlen, _ = x.shape
-
-        kv_size = self.n_local_heads * self.head_dim
-        q, k, v = self.wqkv(x).split([self.dim, kv_size, kv_size], dim=-1)
-
-        q = q.view(bsz, seqlen, self.n_head, self.head_dim)
-        k = k.view(bsz, seqlen, self.n_local_heads, self.head_dim)
-        v = v.view(bsz, seqlen, self.n_local_heads, self.head_dim)
-
-        if self.kv_cache is not None:
-            k, v = self.kv_cache.prefill(cache_seqlens, k, v)
-
-        k_freq = prefill_freqs[:, :k.shape[1]]
-
-        q = apply_rotary_emb(q, q_freqs)
-        k = apply_rotary_emb(k, k_freq)
-
-        if is_last:
-            self.kv_cache.k_cache[:, :k.shape[1]] = k
-
-        y = torch.ops.mylib.custom_func_2(q, k, v)
+        y = self.kv_cache.attention(q, k, v, cache_seqlens, self._attn, sink_freqs)
 
         y = y.contiguous().view(bsz, seqlen, self.dim)
 
@@ -267,13 +221,20 @@ class Attention(nn.Module):
 class FeedForward(nn.Module):
     def __init__(self, config: ModelArgs) -> None:
         super().__init__()
-        self.w1 = nn.Linear(config.dim, config.intermediate_size, bias=False)
-        self.w3 = nn.Linear(config.dim, config.intermediate_size, bias=False)
+        # gate (w1) and up (w3) projections merged into one matrix
+        self.w13 = nn.Linear(config.dim, 2 * config.intermediate_size, bias=False)
         self.w2 = nn.Linear(config.intermediate_size, config.dim, bias=False)
         self.process_group = None
+        self._register_load_state_dict_pre_hook(self.load_hook)
+
+    def load_hook(self, state_dict, prefix, *args):
+        if prefix + "w1.weight" in state_dict:
+            w1 = state_dict.pop(prefix + "w1.weight")
+            w3 = state_dict.pop(prefix + "w3.weight")
+            state_dict[prefix + "w13.weight"] = torch.cat([w1, w3])
 
     def forward(self, x: Tensor) -> Tensor:
-        y = self.w2(F.silu(self.w1(x)) * self.w3(x))
+        y = self.w2(torch.ops.mylib.silu_mul(self.w13(x)))
         if self.process_group != None:
             dist.all_reduce(y, group=self.process_group)
         return y
@@ -285,12 +246,12 @@ class RMSNorm(nn.Module):
         self.eps = eps
         self.weight = nn.Parameter(torch.ones(dim))
 
-    def _norm(self, x):
-        return x * torch.rsqrt(torch.mean(x * x, dim=-1, keepdim=True) + self.eps)
-
     def forward(self, x: Tensor) -> Tensor:
-        output = self._norm(x.float()).type_as(x)
-        return output * self.weight
+        return torch.ops.mylib.rms_norm(x, self.weight, self.eps)
+
+    def forward_add(self, x: Tensor, residual: Tensor):
+        # norm of x + residual, fused with the residual add: returns (normed, x + residual)
+        return torch.ops.mylib.add_rms_norm(x, residual, self.weight, self.eps)
 
 
 def _compute_llama3_parameters(inv_freq, old_context_len=8192, scaling_factor=8,low_freq_factor=1,high_freq_factor=4):
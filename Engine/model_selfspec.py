@@ -7,6 +7,16 @@ from torch import Tensor
 from torch.nn import functional as F
 import torch.distributed as dist
 import math 
+from MagicDec.Engine.attn_backends import AttnBackend, get_attn_backend
+# registers the fused mylib::rms_norm, mylib::add_rms_norm, mylib::rope_ and mylib::silu_mul ops
+import MagicDec.Engine.fused_ops
+from MagicDec.Engine.kv_cache import StreamingKVCache, KVOffload
+from MagicDec.Engine.draft_policies import DraftKVPolicy, StreamingLLMPolicy
+from MagicDec.Engine.quantize import quantized_copy
+from MagicDec.Engine.draft_vocab import prune_rows
+
+# fp32 elements of attention probabilities materialized at once when scoring prompt tokens for the draft KV
+SCORE_SCRATCH = 1 << 26
 
 def find_multiple(n: int, k: int) -> int:
     if n % k == 0:
@@ -68,53 +78,134 @@ transformer_configs = {
 }
 
 class KVCache(nn.Module):
-    def __init__(self, max_batch_size, max_seq_length, n_heads, head_dim, dtype=torch.bfloat16, streaming_budget = 256, buffer=0):
+    def __init__(self, max_batch_size, max_seq_length, n_heads, head_dim, dtype=torch.bfloat16, draft_policy: DraftKVPolicy = None, buffer = 64, offload=False, draft=True):
         super().__init__()
         cache_shape = (max_batch_size, max_seq_length, n_heads, head_dim)
-        draft_cache_shape = (max_batch_size, streaming_budget+buffer, n_heads, head_dim)
-        self.register_buffer('k_cache', torch.zeros(cache_shape, dtype=dtype))
-        self.register_buffer('v_cache', torch.zeros(cache_shape, dtype=dtype))
-        self.register_buffer('draft_k_cache', torch.zeros(draft_cache_shape, dtype=dtype))
-        self.register_buffer('draft_v_cache', torch.zeros(draft_cache_shape, dtype=dtype))
-        self.register_buffer('batch_indices',torch.arange(max_batch_size).unsqueeze(1))
-        self.streaming_budget = streaming_budget
-
-    # def update(self, cache_seqs, k_val, v_val):
-    #     # cache_seqs: [B], k_val: [B, S, H, D]
-    #     # v_out = self.v_cache    
-    #     cache_indices = cache_seqs.unsqueeze(1) + torch.arange(k_val.size(1), device=k_val.device)
-    #     # v_out[self.batch_indices, cache_indices] = v_val
-
-    #     k_draft = self.draft_k_cache
-    #     v_draft = self.draft_v_cache
-    #     k_draft[self.batch_indices, cache_indices] = k_val
-    #     v_draft[self.batch_indices, cache_indices] = v_val
-    #     select_indices = cache_seqs.unsqueeze(1)+ k_val.size(1) + torch.arange(16-self.streaming_budget, 0, device=k_val.device)
-    #     if self.check:
-    #         import pdb; pdb.set_trace()
-    #     selected_k = k_draft[self.batch_indices, select_indices]
-    #     selected_v = v_draft[self.batch_indices, select_indices]
-    #     return torch.cat((k_draft[:, :16], selected_k), dim = 1), torch.cat((v_draft[:, :16], selected_v), dim = 1)
-
-    # def prefill_draft(self, cache_seqs, k_val):
-    #     # cache_seqs: [B], k_val: [B, S, H, D]
-    #     cache_indices = cache_seqs.unsqueeze(1) + torch.arange(k_val.size(1), device=k_val.device)
-    #     self.draft_k_cache[self.batch_indices, cache_indices] = k_val
-    #     self.draft_v_cache[self.batch_indices, cache_indices] = k_val
-
-    def prefill(self, cache_len, k_val, v_val):
-        k_out = self.draft_k_cache
-        v_out = self.draft_v_cache
-        cache_len_int = cache_len[0].item()
-        if cache_len_int + k_val.shape[1] <= self.streaming_budget:
-            k_out[:, cache_len_int: cache_len_int + k_val.shape[1]] = k_val
-            v_out[:, cache_len_int: cache_len_int + k_val.shape[1]] = v_val
-            return k_out[:, :cache_len_int+k_val.shape[1]], v_out[:, :cache_len_int+k_val.shape[1]]
-        new_k = torch.cat((k_out[:, 16:self.streaming_budget], k_val), dim=1)[:, -self.streaming_budget+16:]
-        new_v = torch.cat((v_out[:, 16:self.streaming_budget], v_val), dim=1)[:, -self.streaming_budget+16:]
-        k_out[:, 16:self.streaming_budget] = new_k
-        v_out[:, 16:self.streaming_budget] = new_v
-        return k_out[:, :self.streaming_budget], v_out[:, :self.streaming_budget]   
+        # offloaded caches get their device buffers from KVOffload while their layer runs, the draft cache stays resident
+        self.register_buffer('k_cache', None if offload else torch.zeros(cache_shape, dtype=dtype))
+        self.register_buffer('v_cache', None if offload else torch.zeros(cache_shape, dtype=dtype))
+        # draft=False: the draft skips this layer and keeps no KV for it
+        self.paged = draft and draft_policy.paged
+        self.draft_cache = None
+        if self.paged:
+            # per-page min/max of the keys, summarising the target cache for the draft's page selection
+            self.page_size = draft_policy.page_size
+            self.draft_pages = draft_policy.num_pages
+            summary_shape = (max_batch_size, n_heads, (max_seq_length + self.page_size - 1) // self.page_size, head_dim)
+            self.register_buffer('page_min', torch.zeros(summary_shape, dtype=dtype))
+            self.register_buffer('page_max', torch.zeros(summary_shape, dtype=dtype))
+        elif draft:
+            self.draft_cache = StreamingKVCache(max_batch_size, n_heads, head_dim, draft_policy.budget, draft_policy.num_static, buffer, dtype, draft_policy.shift_static)
+        # attention received by every prompt token, used by score-based draft policies
+        self.register_buffer('draft_scores', torch.zeros((max_batch_size, n_heads, max_seq_length), dtype=torch.float32) if draft and draft_policy.needs_scores else None)
+
+    @property
+    def draft(self):
+        return self.paged or self.draft_cache is not None
+
+    def drop_draft(self):
+        # the draft now skips this layer: free its draft KV and page summaries
+        if self.paged:
+            del self.page_min, self.page_max
+        self.paged = False
+        self.draft_cache = None
+        self.draft_scores = None
+
+    def accumulate_scores(self, q, cache_seqlens, num_queries, num_keys):
+        # q: [B, T, H_q, D] rotated; the last num_queries queries add their attention to the scores of the
+        # num_keys keys they can see at most (the end of the chunk), a block of queries at a time so the
+        # fp32 probabilities stay within SCORE_SCRATCH elements
+        B, T, H_q, D = q.size()
+        H_k = self.k_cache.size(2)
+        rep = H_q // H_k
+        keys = self.k_cache[:B, :num_keys].permute(0, 2, 3, 1).unsqueeze(2)
+        block = max(1, SCORE_SCRATCH // (B * H_q * num_keys))
+        for start in range(T - num_queries, T, block):
+            end = min(start + block, T)
+            n = end - start
+            positions = cache_seqlens.long().view(-1, 1) + torch.arange(start, end, device=q.device)
+            mask = torch.arange(num_keys, device=q.device).view(1, 1, -1) <= positions.unsqueeze(-1)
+            q_block = q[:, start:end].reshape(B, n, H_k, rep, D).permute(0, 2, 3, 1, 4)
+            scores = (q_block @ keys).float() / math.sqrt(D)
+            probs = torch.softmax(scores.masked_fill(~mask.view(B, 1, 1, n, num_keys), float("-inf")), dim=-1)
+            self.draft_scores[:B, :, :num_keys] += probs.sum(dim=(2, 3))
+
+    def commit_path(self, cache_seqlens, path):
+        # move the KV of the accepted tree nodes path [B, L] to the slots cache_seqlens + arange(L)
+        B, L = path.size()
+        batch_indices = torch.arange(B, device=path.device).view(-1, 1)
+        src = cache_seqlens.long().view(-1, 1) + path
+        dst = cache_seqlens.long().view(-1, 1) + torch.arange(L, device=path.device)
+        self.k_cache[batch_indices, dst] = self.k_cache[batch_indices, src]
+        self.v_cache[batch_indices, dst] = self.v_cache[batch_indices, src]
+        if self.paged:
+            self.refresh_pages(cache_seqlens, L)
+
+    def refresh_pages(self, cache_seqlens, num_tokens):
+        # recompute the summaries of the pages touched by num_tokens keys written at cache_seqlens
+        B = cache_seqlens.size(0)
+        P = self.page_size
+        S = self.k_cache.size(1)
+        start = cache_seqlens.long().view(-1, 1, 1)
+        pages = start // P + torch.arange((num_tokens + P - 2) // P + 1, device=start.device).view(1, -1, 1)
+        pages = pages.clamp(max=self.page_min.size(2) - 1)
+        slots = pages * P + torch.arange(P, device=start.device)
+        valid = (slots < start + num_tokens).view(*slots.shape, 1, 1)
+        keys = self.k_cache[torch.arange(B, device=start.device).view(-1, 1, 1), slots.clamp(max=S - 1)]
+        batch_indices = torch.arange(B, device=start.device).view(-1, 1)
+        self.page_min[batch_indices, :, pages[..., 0]] = keys.masked_fill(~valid, float("inf")).amin(dim=2)
+        self.page_max[batch_indices, :, pages[..., 0]] = keys.masked_fill(~valid, float("-inf")).amax(dim=2)
+
+    def quest_attention(self, q, k, v, cache_seqlens, attn, target_seqlens=None):
+        # q: [B, T, H_q, D], k/v: [B, T, H_k, D] draft tokens, written to the target cache at positions from
+        # target_seqlens on (verification overwrites them). Tokens below it are already committed by the target
+        # (the first token of a double-buffer round) and keep the target's KV.
+        # attn: a kvcache op of the attention backend, run over the selected pages.
+        B, T, H_q, D = q.size()
+        H_k = self.k_cache.size(2)
+        rep = H_q // H_k
+        P = self.page_size
+        positions = cache_seqlens.long().view(-1, 1) + torch.arange(T, device=q.device)
+        batch_indices = torch.arange(B, device=q.device).view(-1, 1)
+        if target_seqlens is not None:
+            committed = (positions < target_seqlens.long().view(-1, 1)).view(B, T, 1, 1)
+            k = torch.where(committed, self.k_cache[batch_indices, positions], k)
+            v = torch.where(committed, self.v_cache[batch_indices, positions], v)
+        self.k_cache[batch_indices, positions] = k
+        self.v_cache[batch_indices, positions] = v
+        self.refresh_pages(cache_seqlens, T)
+
+        # upper bound of q.k over each page: q+ . max + q- . min, summed over the grouped heads and tokens
+        q_pages = q.view(B, T, H_k, rep, D).permute(0, 2, 3, 1, 4).reshape(B, H_k, rep * T, D)
+        page_min, page_max = self.page_min[:B], self.page_max[:B]
+        page_scores = (q_pages.clamp(min=0) @ page_max.transpose(-1, -2) + q_pages.clamp(max=0) @ page_min.transpose(-1, -2)).float().sum(dim=2)
+        page_ids = torch.arange(page_scores.size(-1), device=q.device).view(1, 1, -1)
+        first_page = (positions[:, :1] // P).view(-1, 1, 1)
+        last_page = (positions[:, -1] // P).view(-1, 1, 1)
+        page_scores = torch.where(page_ids > last_page, float("-inf"), page_scores)
+        # the pages holding the new tokens are always attended
+        page_scores = torch.where((page_ids == last_page) | (page_ids == first_page), float("inf"), page_scores)
+        pages = page_scores.topk(min(self.draft_pages, page_scores.size(-1)), dim=-1).indices.sort(dim=-1).values
+        # in page order the selected pages before the first new token's page are full, and as many for every
+        # head: gathered with the new tokens' slots after them, the cached part is a prefix of
+        # full_pages * P + cache_seqlens % P tokens, the op appends k/v after it
+        full_pages = (pages[:, 0] < first_page[:, 0]).sum(dim=-1)
+        slots = torch.cat([(pages.unsqueeze(-1) * P + torch.arange(P, device=q.device)).flatten(2), positions.unsqueeze(1).expand(-1, H_k, -1)], dim=-1)
+        index = slots.clamp(max=self.k_cache.size(1) - 1).transpose(1, 2).unsqueeze(-1).expand(-1, -1, -1, D)
+        k_sel = self.k_cache[:B].gather(1, index)
+        v_sel = self.v_cache[:B].gather(1, index)
+        return attn(q, k_sel, v_sel, k, v, (full_pages * P + positions[:, 0] % P).int())
+
+    def select_draft_kv(self, draft_policy: DraftKVPolicy, prompt_len: int):
+        # static slots: tokens picked by the policy from the target KV, ring: the last window tokens
+        B, _, H, D = self.k_cache.size()
+        recent_start = prompt_len - draft_policy.window
+        assert recent_start >= draft_policy.num_static, f"Prompt of {prompt_len} tokens is shorter than the draft budget {draft_policy.budget}"
+        positions = draft_policy.select(self.draft_scores[:, :, :recent_start])
+        index = positions.transpose(1, 2).unsqueeze(-1).expand(-1, -1, -1, D)
+        self.draft_cache.load_static(self.k_cache.gather(1, index), self.v_cache.gather(1, index))
+        self.draft_cache.update(self.k_cache[:, recent_start:prompt_len], self.v_cache[:, recent_start:prompt_len],
+                                torch.full((B,), recent_start, dtype=torch.int32, device=self.k_cache.device))
 
 class Transformer(nn.Module):
     def __init__(self, config: ModelArgs) -> None:
@@ -125,13 +216,20 @@ class Transformer(nn.Module):
         self.layers = nn.ModuleList(TransformerBlock(config) for _ in range(config.n_layer))
         self.norm = RMSNorm(config.dim, eps=config.norm_eps)
         self.output = nn.Linear(config.dim, config.vocab_size, bias=False)
+        # low-bit and / or pruned copy of the LM head for drafting, see setup_draft_weights and setup_draft_vocab
+        self.draft_output = None
+        # full vocabulary id of every draft_output row when the draft vocabulary is pruned
+        self.register_buffer('draft_vocab', None, persistent=False)
 
         self.freqs_cis: Optional[Tensor] = None
         self.mask_cache: Optional[Tensor] = None
         self.max_batch_size = -1
         self.max_seq_length = -1
+        self.kv_offload = None
+        # layers draft_forward passes the hidden states through unchanged
+        self.draft_skip_layers = frozenset()
 
-    def setup_caches(self, max_batch_size, max_seq_length, streaming_budget = 256, buffer=0):
+    def setup_caches(self, max_batch_size, max_seq_length, draft_policy: DraftKVPolicy = None, buffer = 64, offload_layers = 0, draft_skip_layers = ()):
         if self.max_seq_length >= max_seq_length and self.max_batch_size >= max_batch_size:
             return
         head_dim = self.config.dim // self.config.n_head
@@ -144,9 +242,22 @@ class Transformer(nn.Module):
             dtype = self.output.scales.dtype
         elif hasattr(self.output, "scales_and_zeros"):
             dtype = self.output.scales_and_zeros.dtype
+        if draft_policy is None:
+            draft_policy = StreamingLLMPolicy(256)
+        self.draft_policy = draft_policy
+        # the KV of the last offload_layers layers lives in host memory, drafting never reads it
+        assert offload_layers == 0 or draft_policy.streaming_prefill, f"The {draft_policy.name} draft policy reads the target KV, which can not be offloaded"
+        first_offloaded = self.config.n_layer - offload_layers
+        self.draft_skip_layers = frozenset(draft_skip_layers)
+        assert all(0 <= i < self.config.n_layer for i in self.draft_skip_layers), f"Draft skip layers {sorted(self.draft_skip_layers)} out of range"
         for i, b in enumerate(self.layers):
-            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, self.config.n_local_heads, head_dim, dtype, streaming_budget, buffer)
+            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, self.config.n_local_heads, head_dim, dtype, draft_policy, buffer,
+                                           offload=i >= first_offloaded, draft=i not in self.draft_skip_layers)
             b.attention.layer_idx = i
+        self.kv_offload = None
+        if offload_layers > 0:
+            self.kv_offload = KVOffload([b.attention.kv_cache for b in self.layers[first_offloaded:]], first_offloaded,
+                                        max_batch_size, max_seq_length, self.config.n_local_heads, head_dim, dtype, self.output.weight.device)
 
         if (self.config.high_freq_factor is not None) and (self.config.low_freq_factor is not None):
             self.freqs_cis = precompute_freqs_cis(self.config.block_size, self.config.dim // self.config.n_head, self.config.rope_base,dtype,
@@ -156,51 +267,102 @@ class Transformer(nn.Module):
             self.freqs_cis = precompute_freqs_cis(self.config.block_size, self.config.dim // self.config.n_head, self.config.rope_base,dtype,
                                                   # new params
                                                   self.config.scaling_factor)
-        self.streaming_freqs = self.freqs_cis[torch.arange(streaming_budget).unsqueeze(0).repeat(max_batch_size,1)]
 
-    def forward(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor) -> Tensor:
+    def forward(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor, tree_mask: Optional[Tensor] = None) -> Tensor:
         assert self.freqs_cis is not None, "Caches must be initialized first"
         
         freqs_cis = self.freqs_cis[input_pos]
         x = self.tok_embeddings(idx)
+        if self.kv_offload is not None:
+            self.kv_offload.start(cache_seqlens, idx.size(1))
         for i, layer in enumerate(self.layers):
-            x = layer(x, freqs_cis, cache_seqlens)
+            if self.kv_offload is not None:
+                self.kv_offload.load(i)
+            x = layer(x, freqs_cis, cache_seqlens, tree_mask)
+            if self.kv_offload is not None:
+                self.kv_offload.store(i)
         x = self.norm(x)
         logits = self.output(x)
         return logits
 
-    def prefill(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor) -> Tensor:
+    def prefill(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor, score_queries: int = 0, score_len: int = None) -> Tensor:
         assert self.freqs_cis is not None, "Caches must be initialized first"
 
         freqs_cis = self.freqs_cis[input_pos]
         x = self.tok_embeddings(idx)
+        if self.kv_offload is not None:
+            self.kv_offload.start(cache_seqlens, idx.size(1))
         for i, layer in enumerate(self.layers):
-            x = layer.prefill(x, freqs_cis, cache_seqlens)
+            if self.kv_offload is not None:
+                self.kv_offload.load(i)
+            x = layer.prefill(x, freqs_cis, cache_seqlens, score_queries, score_len)
+            if self.kv_offload is not None:
+                self.kv_offload.store(i)
         x = self.norm(x)
         logits = self.output(x)
         return logits
     
-    def draft_forward(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor) -> Tensor:
+    def draft_forward(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor, target_seqlens: Optional[Tensor] = None) -> Tensor:
         assert self.freqs_cis is not None, "Caches must be initialized first"
+        # target_seqlens: target cache lengths, the quest policy never overwrites target KV below them
 
+        # input_pos are logical positions in the draft stream, sinks are attended as if they preceded the window
         freqs_cis = self.freqs_cis[input_pos]
+        sink_freqs = None
+        if self.draft_policy.shift_static:
+            shift = (input_pos[:, -1:] - (self.draft_policy.budget - 1)).clamp(min=0)
+            sink_freqs = self.freqs_cis[shift.expand(-1, self.draft_policy.num_static)]
         x = self.tok_embeddings(idx)
         for i, layer in enumerate(self.layers):
-            x = layer.draft_forward(x, freqs_cis, cache_seqlens)
+            if i in self.draft_skip_layers:
+                continue
+            x = layer.draft_forward(x, freqs_cis, sink_freqs, cache_seqlens, target_seqlens)
         x = self.norm(x)
-        logits = self.output(x)
+        logits = (self.output if self.draft_output is None else self.draft_output)(x)
         return logits
 
-    def draft_prefill(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor, is_last=False) -> Tensor:
-        assert self.freqs_cis is not None, "Caches must be initialized first"
-
-        freqs_cis = self.freqs_cis[input_pos]
-        x = self.tok_embeddings(idx)
-        for i, layer in enumerate(self.layers):
-            x = layer.draft_prefill(x, freqs_cis, self.streaming_freqs, cache_seqlens, is_last)
-        x = self.norm(x)
-        logits = self.output(x)
-        return logits
+    def draft_prefill(self, idx: Tensor, input_pos: Optional[Tensor], cache_seqlens: Tensor) -> Tensor:
+        # streaming policies: prompt chunks go through the same ring buffer as drafting
+        return self.draft_forward(idx, input_pos, cache_seqlens)
+
+    def setup_draft_weights(self, quant: str, groupsize: int = 128):
+        # draft_forward / draft_prefill read int8 or int4 copies of the projections and the LM head,
+        # verification keeps the full precision weights
+        for b in self.layers:
+            b.attention.draft_wqkv = quantized_copy(b.attention.wqkv, quant, groupsize)
+            b.attention.draft_wo = quantized_copy(b.attention.wo, quant, groupsize)
+            b.feed_forward.draft_w13 = quantized_copy(b.feed_forward.w13, quant, groupsize)
+            b.feed_forward.draft_w2 = quantized_copy(b.feed_forward.w2, quant, groupsize)
+        self.draft_output = quantized_copy(self.output if self.draft_output is None else self.draft_output, quant, groupsize)
+
+    def setup_draft_vocab(self, vocab: Tensor):
+        # draft logits over the token ids vocab [N] only, from those rows of the LM head; verification keeps the full head
+        self.draft_output = prune_rows(self.output if self.draft_output is None else self.draft_output, vocab)
+        self.draft_vocab = vocab.to(self.tok_embeddings.weight.device)
+
+    def set_draft_skip_layers(self, layers, free: bool = True):
+        """Skip layers in draft_forward / draft_prefill from now on. Layers skipped before keep no draft KV
+        and can not be drafted again; with free the draft KV of the newly skipped ones is released too."""
+        layers = frozenset(layers)
+        assert all(b.attention.kv_cache.draft for i, b in enumerate(self.layers) if i not in layers), "Layers without draft KV must stay skipped"
+        self.draft_skip_layers = layers
+        if free:
+            for i in layers:
+                self.layers[i].attention.kv_cache.drop_draft()
+
+    def select_draft_kv(self, prompt_len: int):
+        # selection policies: fill the draft cache from the target KV once the prompt is prefilled
+        for b in self.layers:
+            if b.attention.kv_cache.draft:
+                b.attention.kv_cache.select_draft_kv(self.draft_policy, prompt_len)
+
+    def commit_tree_path(self, cache_seqlens: Tensor, path: Tensor):
+        for b in self.layers:
+            b.attention.kv_cache.commit_path(cache_seqlens, path)
+
+    def set_attn_backend(self, backend: AttnBackend):
+        for b in self.layers:
+            b.attention.set_attn_backend(backend)
 
     @classmethod
     def from_name(cls, name: str):
@@ -215,24 +377,19 @@ class TransformerBlock(nn.Module):
         self.ffn_norm = RMSNorm(config.dim, config.norm_eps)
         self.attention_norm = RMSNorm(config.dim, config.norm_eps)
 
-    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
-        h = x + self.attention(self.attention_norm(x), freqs_cis, cache_seqlens)
-        out = h + self.feed_forward(self.ffn_norm(h))
+    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor, tree_mask: Optional[Tensor] = None) -> Tensor:
+        normed, h = self.ffn_norm.forward_add(self.attention(self.attention_norm(x), freqs_cis, cache_seqlens, tree_mask), x)
+        out = h + self.feed_forward(normed)
         return out
 
-    def prefill(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
-        h = x + self.attention.prefill(self.attention_norm(x), freqs_cis, cache_seqlens)
-        out = h + self.feed_forward(self.ffn_norm(h))
+    def prefill(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor, score_queries: int = 0, score_len: int = None) -> Tensor:
+        normed, h = self.ffn_norm.forward_add(self.attention.prefill(self.attention_norm(x), freqs_cis, cache_seqlens, score_queries, score_len), x)
+        out = h + self.feed_forward(normed)
         return out
     
-    def draft_forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
-        h = x + self.attention.draft_forward(self.attention_norm(x), freqs_cis, cache_seqlens)
-        out = h + self.feed_forward.draft_forward(self.ffn_norm(h))
-        return out
-
-    def draft_prefill(self, x: Tensor, freqs_cis: Tensor, streaming_freqs: Tensor, cache_seqlens: Tensor, is_last=False) -> Tensor:
-        h = x + self.attention.draft_prefill(self.attention_norm(x), freqs_cis, streaming_freqs, cache_seqlens, is_last)
-        out = h + self.feed_forward.draft_forward(self.ffn_norm(h))
+    def draft_forward(self, x: Tensor, freqs_cis: Tensor, sink_freqs: Optional[Tensor], cache_seqlens: Tensor, target_seqlens: Optional[Tensor] = None) -> Tensor:
+        normed, h = self.ffn_norm.forward_add(self.attention.draft_forward(self.attention_norm(x), freqs_cis, sink_freqs, cache_seqlens, target_seqlens), x)
+        out = h + self.feed_forward.draft_forward(normed)
         return out
 
 class Attention(nn.Module):
@@ -244,6 +401,9 @@ class Attention(nn.Module):
         # key, query, value projections for all heads, but in a batch
         self.wqkv = nn.Linear(config.dim, total_head_dim, bias=False)
         self.wo = nn.Linear(config.dim, config.dim, bias=False)
+        # low-bit copies used by draft_forward, see Transformer.setup_draft_weights
+        self.draft_wqkv = None
+        self.draft_wo = None
         self.kv_cache = None
         self.process_group = None
 
@@ -252,11 +412,15 @@ class Attention(nn.Module):
         self.n_local_heads = config.n_local_heads
         self.dim = config.dim
         self._register_load_state_dict_pre_hook(self.load_hook)
+        self.set_attn_backend(get_attn_backend())
 
+    def set_attn_backend(self, backend: AttnBackend):
         if self.n_head == self.n_local_heads:
-            self._attn = torch.ops.mylib.custom_func
+            self._attn = backend.decode_with_kvcache or backend.attn_with_kvcache
         else:
-            self._attn = torch.ops.mylib.gqa_custom
+            self._attn = backend.gqa_with_kvcache
+        self._attn_kvcache = backend.attn_with_kvcache
+        self._attn_nocache = backend.attn
 
     def load_hook(self, state_dict, prefix, *args):
         if prefix + "wq.weight" in state_dict:
@@ -265,7 +429,7 @@ class Attention(nn.Module):
             wv = state_dict.pop(prefix + "wv.weight")
             state_dict[prefix + "wqkv.weight"] = torch.cat([wq, wk, wv])
 
-    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
+    def forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor, tree_mask: Optional[Tensor] = None) -> Tensor:
         bsz, seqlen, _ = x.shape
 
         kv_size = self.n_local_heads * self.head_dim
@@ -275,14 +439,19 @@ class Attention(nn.Module):
         k = k.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         v = v.view(bsz, seqlen, self.n_local_heads, self.head_dim)
 
-        q = apply_rotary_emb(q, freqs_cis)
-        k = apply_rotary_emb(k, freqs_cis)
+        torch.ops.mylib.rope_(q, freqs_cis)
+        torch.ops.mylib.rope_(k, freqs_cis)
 
         k_cache, v_cache = self.kv_cache.k_cache, self.kv_cache.v_cache
 
         # for decoding and verification, use gqa_custom
-        y = self._attn(q, k_cache, v_cache, k, v, cache_seqlens)
-        # y = torch.ops.mylib.custom_func(q, k_cache, v_cache, k, v, cache_seqlens)
+        if tree_mask is not None:
+            y = torch.ops.mylib.tree_func(q, k_cache, v_cache, k, v, cache_seqlens, tree_mask)
+        else:
+            y = self._attn(q, k_cache, v_cache, k, v, cache_seqlens)
+        if self.kv_cache.paged:
+            self.kv_cache.refresh_pages(cache_seqlens, seqlen)
+        # y = self._attn_kvcache(q, k_cache, v_cache, k, v, cache_seqlens)
 
         y = y.contiguous().view(bsz, seqlen, self.dim)
 
@@ -291,7 +460,7 @@ class Attention(nn.Module):
             dist.all_reduce(y)
         return y
 
-    def prefill(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
+    def prefill(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor, score_queries: int = 0, score_len: int = None) -> Tensor:
         bsz, seqlen, _ = x.shape
 
         kv_size = self.n_local_heads * self.head_dim
@@ -303,14 +472,18 @@ class Attention(nn.Module):
 
         # self.kv_cache.prefill_draft(cache_seqlens, k)
         
-        q = apply_rotary_emb(q, freqs_cis)
-        k = apply_rotary_emb(k, freqs_cis)
+        torch.ops.mylib.rope_(q, freqs_cis)
+        torch.ops.mylib.rope_(k, freqs_cis)
 
         if self.kv_cache is not None:
             k_cache, v_cache = self.kv_cache.k_cache, self.kv_cache.v_cache
 
         # for prefill, use original impl
-        y = torch.ops.mylib.custom_func(q, k_cache, v_cache, k, v, cache_seqlens)
+        y = self._attn_kvcache(q, k_cache, v_cache, k, v, cache_seqlens)
+        if score_queries and self.kv_cache.draft_scores is not None:
+            self.kv_cache.accumulate_scores(q, cache_seqlens, score_queries, score_len)
+        if self.kv_cache.paged:
+            self.kv_cache.refresh_pages(cache_seqlens, seqlen)
 
         y = y.contiguous().view(bsz, seqlen, self.dim)
 
@@ -319,58 +492,28 @@ class Attention(nn.Module):
             dist.all_reduce(y)
         return y
     
-    def draft_forward(self, x: Tensor, freqs_cis: Tensor, cache_seqlens: Tensor) -> Tensor:
+    def draft_forward(self, x: Tensor, freqs_cis: Tensor, sink_freqs: Optional[Tensor], cache_seqlens: Tensor, target_seqlens: Optional[Tensor] = None) -> Tensor:
         bsz, seqlen, _ = x.shape
 
         kv_size = self.n_local_heads * self.head_dim
-        q, k, v = self.wqkv(x).split([self.dim, kv_size, kv_size], dim=-1)
+        wqkv = self.wqkv if self.draft_wqkv is None else self.draft_wqkv
+        q, k, v = wqkv(x).split([self.dim, kv_size, kv_size], dim=-1)
 
         q = q.view(bsz, seqlen, self.n_head, self.head_dim)
         k = k.view(bsz, seqlen, self.n_local_heads, self.head_dim)
         v = v.view(bsz, seqlen, self.n_local_heads, self.head_dim)
-        
-        # if self.kv_cache is not None:
-        #     k, v = self.kv_cache.update(cache_seqlens, k, v)
-
-        q = apply_rotary_emb(q, freqs_cis)
-        # k = apply_rotary_emb(k, streaming_freqs)
-        k = apply_rotary_emb(k, freqs_cis)
 
-        # y = torch.ops.mylib.custom_func_2(q, k, v)
-        k_cache, v_cache = self.kv_cache.draft_k_cache, self.kv_cache.draft_v_cache
-        y = self._attn(q, k_cache, v_cache, k, v, cache_seqlens)
+        torch.ops.mylib.rope_(q, freqs_cis)
+        torch.ops.mylib.rope_(k, freqs_cis)
 
-        y = y.contiguous().view(bsz, seqlen, self.dim)
-
-        y = self.wo(y)
-        if self.process_group != None:
-            dist.all_reduce(y)
-        return y
-    
-    def draft_prefill(self, x: Tensor, freqs_cis: Tensor, streaming_freqs: Tensor, cache_seqlens: Tensor, is_last=False) -> Tensor:
-        bsz, seqlen, _ = x.shape
-
-        kv_size = self.n_local_heads * self.head_dim
-        q, k, v = self.wqkv(x).split([self.dim, kv_size, kv_size], dim=-1)
-
-        q = q.view(bsz, seqlen, self.n_head, self.head_dim)
-        k = k.view(bsz, seqlen, self.n_local_heads, self.head_dim)
-        v = v.view(bsz, seqlen, self.n_local_heads, self.head_dim)
-
-        if self.kv_cache is not None:
-            k, v = self.kv_cache.prefill(cache_seqlens, k, v)
-
-        q = apply_rotary_emb(q, freqs_cis)
-        k = apply_rotary_emb(k, streaming_freqs[:, :k.shape[1]])
-
-        if is_last:
-            self.kv_cache.draft_k_cache[:, :k.shape[1]] = k
-
-        y = torch.ops.mylib.custom_func_2(q, k, v)
+        if self.kv_cache.paged:
+            y = self.kv_cache.quest_attention(q, k, v, cache_seqlens, self._attn, target_seqlens)
+        else:
+            y = self.kv_cache.draft_cache.attention(q, k, v, cache_seqlens, self._attn, sink_freqs)
 
         y = y.contiguous().view(bsz, seqlen, self.dim)
 
-        y = self.wo(y)
+        y = (self.wo if self.draft_wo is None else self.draft_wo)(y)
         if self.process_group != None:
             dist.all_reduce(y)
         return y
@@ -378,19 +521,30 @@ class Attention(nn.Module):
 class FeedForward(nn.Module):
     def __init__(self, config: ModelArgs) -> None:
         super().__init__()
-        self.w1 = nn.Linear(config.dim, config.intermediate_size, bias=False)
-        self.w3 = nn.Linear(config.dim, config.intermediate_size, bias=False)
+        # gate (w1) and up (w3) projections merged into one matrix
+        self.w13 = nn.Linear(config.dim, 2 * config.intermediate_size, bias=False)
         self.w2 = nn.Linear(config.intermediate_size, config.dim, bias=False)
+        self.draft_w13 = None
+        self.draft_w2 = None
         self.process_group = None
+        self._register_load_state_dict_pre_hook(self.load_hook)
+
+    def load_hook(self, state_dict, prefix, *args):
+        if prefix + "w1.weight" in state_dict:
+            w1 = state_dict.pop(prefix + "w1.weight")
+            w3 = state_dict.pop(prefix + "w3.weight")
+            state_dict[prefix + "w13.weight"] = torch.cat([w1, w3])
 
     def forward(self, x: Tensor) -> Tensor:
-        y = self.w2(F.silu(self.w1(x)) * self.w3(x))
+        y = self.w2(torch.ops.mylib.silu_mul(self.w13(x)))
         if self.process_group != None:
             dist.all_reduce(y)
         return y
     
     def draft_forward(self, x: Tensor) -> Tensor:
-        y = self.w2(F.silu(self.w1(x)) * self.w3(x))
+        w13 = self.w13 if self.draft_w13 is None else self.draft_w13
+        w2 = self.w2 if self.draft_w2 is None else self.draft_w2
+        y = w2(torch.ops.mylib.silu_mul(w13(x)))
         if self.process_group != None:
             dist.all_reduce(y)
         return y
@@ -402,12 +556,12 @@ class RMSNorm(nn.Module):
         self.eps = eps
         self.weight = nn.Parameter(torch.ones(dim))
 
-    def _norm(self, x):
-        return x * torch.rsqrt(torch.mean(x * x, dim=-1, keepdim=True) + self.eps)
-
     def forward(self, x: Tensor) -> Tensor:
-        output = self._norm(x.float()).type_as(x)
-        return output * self.weight
+        return torch.ops.mylib.rms_norm(x, self.weight, self.eps)
+
+    def forward_add(self, x: Tensor, residual: Tensor):
+        # norm of x + residual, fused with the residual add: returns (normed, x + residual)
+        return torch.ops.mylib.add_rms_norm(x, residual, self.weight, self.eps)
 
 
 def _compute_llama3_parameters(inv_freq, old_context_len=8192, scaling_factor=8,low_freq_factor=1,high_freq_factor=4):
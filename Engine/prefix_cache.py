@@ -0,0 +1,172 @@
+import torch
+
+from MagicDec.Engine.kv_cache import slot_caches
+
+
+class RadixNode:
+    def __init__(self, parent=None, key=None, page: int = -1, draft_state=None):
+        self.parent = parent
+        self.key = key
+        self.children = {}
+        # index of the block's target KV in the pool, and the draft cache state after the block
+        self.page = page
+        self.draft_state = draft_state
+        self.last_access = 0
+
+
+class PrefixCache:
+    """Reuses the KV of prompt prefixes shared across requests.
+
+    Prompts are cut into blocks of block_size tokens, stored in a radix tree with one node per block
+    (keyed by its tokens, so a node stands for the whole prefix up to it). A node holds the target KV
+    of its block in a pool of num_blocks blocks on the engine's device, and a snapshot of the draft
+    cache state of the slot right after the block, so the draft resumes from the same point as the
+    target. When the pool is full the least recently used leaf is evicted.
+
+    engine is a target LMBackend with the plain KV cache (optionally with draft an LMBackend_Draft), or a
+    self-speculation LMBackend with the streamingllm or quest draft policy. The score-based policies
+    select the draft KV with scores over the whole prompt, which a cached prefix does not carry.
+    """
+    def __init__(self, engine, draft=None, block_size: int = 1024, num_blocks: int = 64):
+        assert block_size % 32 == 0, "block_size must be a multiple of the 32-token prefill chunk"
+        policy = getattr(engine, "draft_policy", None)
+        assert policy is None or not policy.needs_scores, f"Prefix caching does not support the {policy.name} draft policy"
+        assert getattr(engine, "block_manager", None) is None and not hasattr(engine.model.layers[0].attention.kv_cache, "k_scale"), "Prefix caching needs the plain KV cache"
+        self.engine = engine
+        self.draft = draft
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        k_cache = engine.model.layers[0].attention.kv_cache.k_cache
+        pool_shape = (len(engine.model.layers), num_blocks, block_size) + tuple(k_cache.shape[2:])
+        self.k_pool = torch.zeros(pool_shape, dtype=k_cache.dtype, device=k_cache.device)
+        self.v_pool = torch.zeros(pool_shape, dtype=k_cache.dtype, device=k_cache.device)
+        self.free_pages = list(range(num_blocks - 1, -1, -1))
+        self.root = RadixNode()
+        self.clock = 0
+        self.hit_tokens = 0
+        self.query_tokens = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hit_tokens / max(self.query_tokens, 1)
+
+    def _target_caches(self):
+        return [b.attention.kv_cache for b in self.engine.model.layers]
+
+    def _draft_caches(self):
+        # the modules holding per-slot draft state
+        if self.draft is not None:
+            return [b.attention.kv_cache for b in self.draft.model.layers]
+        return [b.attention.kv_cache.draft_cache for b in self.engine.model.layers if getattr(b.attention.kv_cache, "draft_cache", None) is not None]
+
+    def _key(self, tokens: torch.LongTensor, i: int):
+        return tuple(tokens[i * self.block_size:(i + 1) * self.block_size].tolist())
+
+    def _touch(self, node: RadixNode):
+        self.clock += 1
+        while node is not None:
+            node.last_access = self.clock
+            node = node.parent
+
+    def match(self, tokens: torch.LongTensor):
+        """Deepest cached node for a prefix of tokens (1D), leaving at least one token to prefill."""
+        node, depth = self.root, 0
+        while (depth + 1) * self.block_size < tokens.numel():
+            child = node.children.get(self._key(tokens, depth))
+            if child is None:
+                break
+            node, depth = child, depth + 1
+        return node, depth
+
+    @torch.inference_mode()
+    def restore(self, slot: int, tokens: torch.LongTensor) -> int:
+        """Load the cached KV of the longest matching prefix of tokens into slot of the target and draft
+        caches. Returns the number of tokens restored (a multiple of block_size), prefill goes on from there."""
+        node, depth = self.match(tokens.flatten())
+        self.query_tokens += tokens.numel()
+        if depth == 0:
+            return 0
+        self._touch(node)
+        pages = []
+        n = node
+        while n is not self.root:
+            pages.append(n.page)
+            n = n.parent
+        pages = torch.tensor(pages[::-1], device=self.k_pool.device)
+        length = depth * self.block_size
+        for layer, cache in enumerate(self._target_caches()):
+            cache.k_cache[slot, :length] = self.k_pool[layer, pages].flatten(0, 1)
+            cache.v_cache[slot, :length] = self.v_pool[layer, pages].flatten(0, 1)
+            if hasattr(cache, "page_min"):
+                with slot_caches([cache], slot):
+                    cache.refresh_pages(torch.zeros(1, dtype=torch.int32, device=self.k_pool.device), length)
+        for buf, state in zip(self._draft_buffers(slot), node.draft_state):
+            buf.copy_(state)
+        self.engine.cachelens[slot] = length
+        if self.draft is not None:
+            self.draft.cachelens[slot] = length
+        elif hasattr(self.engine, "draft_cachelens"):
+            self.engine.draft_cachelens[slot] = length
+        self.hit_tokens += length
+        return length
+
+    def _draft_buffers(self, slot: int):
+        return [buf[slot] for cache in self._draft_caches() for buf in cache.buffers() if buf is not None]
+
+    def _evict(self, protect: RadixNode):
+        leaves = []
+        stack = [self.root]
+        while stack:
+            n = stack.pop()
+            stack.extend(n.children.values())
+            if n is not self.root and n is not protect and len(n.children) == 0:
+                leaves.append(n)
+        if len(leaves) == 0:
+            return False
+        victim = min(leaves, key=lambda n: n.last_access)
+        del victim.parent.children[victim.key]
+        self.free_pages.append(victim.page)
+        return True
+
+    @torch.inference_mode()
+    def insert(self, slot: int, tokens: torch.LongTensor, end: int):
+        """Cache the block of tokens (1D) ending at end, which must be a multiple of block_size and the
+        current length of slot, so its draft state is the one after the block. Its prefix must be cached."""
+        assert end % self.block_size == 0
+        depth = end // self.block_size - 1
+        node = self.root
+        for i in range(depth):
+            node = node.children.get(self._key(tokens, i))
+            if node is None:
+                return
+        key = self._key(tokens, depth)
+        if key in node.children:
+            self._touch(node.children[key])
+            return
+        if len(self.free_pages) == 0 and not self._evict(protect=node):
+            return
+        page = self.free_pages.pop()
+        start = end - self.block_size
+        for layer, cache in enumerate(self._target_caches()):
+            self.k_pool[layer, page] = cache.k_cache[slot, start:end]
+            self.v_pool[layer, page] = cache.v_cache[slot, start:end]
+        child = RadixNode(node, key, page, [buf.clone() for buf in self._draft_buffers(slot)])
+        node.children[key] = child
+        self._touch(child)
+
+    @torch.inference_mode()
+    def prefill_slot(self, slot: int, input_ids: torch.LongTensor):
+        """Prefill one sequence (input_ids [1, T]) into slot like engine.prefill_slot (and draft.prefill_slot),
+        reusing cached prefix blocks and caching the new full blocks. Returns the logits of the last chunk."""
+        tokens = input_ids.flatten()
+        seq_len = tokens.numel()
+        start = self.restore(slot, tokens)
+        while start < seq_len:
+            end = min(start - start % self.block_size + self.block_size, seq_len)
+            logits = self.engine.prefill_slot(slot, input_ids, start, end)
+            if self.draft is not None:
+                self.draft.prefill_slot(slot, input_ids, start, end)
+            if end % self.block_size == 0:
+                self.insert(slot, tokens, end)
+            start = end
+        return logits
@@ -0,0 +1,200 @@
+import re
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+try:
+    from MagicDec.Engine.triton_quant import int8_matmul, int4_matmul
+except ImportError:
+    int8_matmul = int4_matmul = None
+
+# above this many rows (prefill) the weight is dequantized once and multiplied with the dense GEMM
+MAX_FUSED_ROWS = 64
+
+
+def quantize_int8_per_channel(w: torch.Tensor):
+    """Symmetric per-output-channel int8 quantization of w [out, in]. Returns (w_q int8, scales [out])."""
+    w = w.float()
+    scales = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+    w_q = (w / scales.unsqueeze(1)).round().clamp(-127, 127).to(torch.int8)
+    return w_q, scales
+
+def quantize_int4_groupwise(w: torch.Tensor, groupsize: int):
+    """Asymmetric int4 quantization of w [out, in] in groups of groupsize input channels.
+    Returns (packed [out, in // 2] uint8, scales_and_zeros [in // groupsize, out, 2]) with w = (q - 8) * scale + zero."""
+    out_features, in_features = w.shape
+    assert in_features % groupsize == 0, f"in_features ({in_features}) must be a multiple of groupsize ({groupsize})"
+    w = w.float().view(out_features, in_features // groupsize, groupsize)
+    w_min = w.amin(dim=-1, keepdim=True)
+    scales = (w.amax(dim=-1, keepdim=True) - w_min).clamp(min=1e-6) / 15
+    q = ((w - w_min) / scales).round().clamp(0, 15).to(torch.uint8).view(out_features, in_features)
+    packed = q[:, 0::2] | (q[:, 1::2] << 4)
+    zeros = w_min + scales * 8
+    scales_and_zeros = torch.cat([scales, zeros], dim=-1).transpose(0, 1).contiguous()
+    return packed, scales_and_zeros
+
+def dequantize_int4(packed: torch.Tensor, scales_and_zeros: torch.Tensor, groupsize: int, dtype: torch.dtype):
+    out_features = packed.size(0)
+    q = torch.stack([packed & 0xF, packed >> 4], dim=-1).view(out_features, -1, groupsize).float()
+    scales_and_zeros = scales_and_zeros.transpose(0, 1).float()
+    w = (q - 8) * scales_and_zeros[..., :1] + scales_and_zeros[..., 1:]
+    return w.view(out_features, -1).to(dtype)
+
+
+# x @ (weight * scales)^T for int8 weight [out, in] and per-channel scales [out]
+torch.library.define(
+    "mylib::int8_linear",
+    "(Tensor x, Tensor weight, Tensor scales) -> Tensor",
+)
+
+@torch.library.impl("mylib::int8_linear", "cuda")
+def int8_linear(x, weight, scales):
+    if int8_matmul is None or x.numel() // x.size(-1) > MAX_FUSED_ROWS:
+        return int8_linear_cpu(x, weight, scales)
+    return int8_matmul(x, weight, scales)
+
+@torch.library.impl("mylib::int8_linear", "cpu")
+def int8_linear_cpu(x, weight, scales):
+    return F.linear(x, weight.to(dtype=x.dtype)) * scales.to(x.dtype)
+
+@torch.library.impl_abstract("mylib::int8_linear")
+def int8_linear_abstract(x, weight, scales):
+    return x.new_empty((*x.shape[:-1], weight.size(0)))
+
+
+# x @ dequant(weight)^T for group-wise int4 weight [out, in // 2] (two per byte)
+torch.library.define(
+    "mylib::int4_linear",
+    "(Tensor x, Tensor weight, Tensor scales_and_zeros, int groupsize) -> Tensor",
+)
+
+@torch.library.impl("mylib::int4_linear", "cuda")
+def int4_linear(x, weight, scales_and_zeros, groupsize):
+    if int4_matmul is None or x.numel() // x.size(-1) > MAX_FUSED_ROWS:
+        return int4_linear_cpu(x, weight, scales_and_zeros, groupsize)
+    return int4_matmul(x, weight, scales_and_zeros, groupsize)
+
+@torch.library.impl("mylib::int4_linear", "cpu")
+def int4_linear_cpu(x, weight, scales_and_zeros, groupsize):
+    return F.linear(x, dequantize_int4(weight, scales_and_zeros, groupsize, x.dtype))
+
+@torch.library.impl_abstract("mylib::int4_linear")
+def int4_linear_abstract(x, weight, scales_and_zeros, groupsize):
+    return x.new_empty((*x.shape[:-1], weight.size(0)))
+
+
+class WeightOnlyInt8Linear(nn.Module):
+    def __init__(self, in_features: int, out_features: int, bias: bool = False, device=None, dtype=None) -> None:
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.empty((out_features, in_features), dtype=torch.int8))
+        self.register_buffer("scales", torch.ones(out_features, dtype=torch.bfloat16))
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        return torch.ops.mylib.int8_linear(input, self.weight, self.scales)
+
+
+class WeightOnlyInt4Linear(nn.Module):
+    def __init__(self, in_features: int, out_features: int, bias: bool = False, device=None, dtype=None, groupsize: int = 128) -> None:
+        super().__init__()
+        assert in_features % groupsize == 0 and groupsize >= 32, f"in_features ({in_features}) must be a multiple of groupsize ({groupsize}), at least 32"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.groupsize = groupsize
+        self.register_buffer("weight", torch.empty((out_features, in_features // 2), dtype=torch.uint8))
+        self.register_buffer("scales_and_zeros", torch.empty((in_features // groupsize, out_features, 2), dtype=torch.bfloat16))
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        return torch.ops.mylib.int4_linear(input, self.weight, self.scales_and_zeros, self.groupsize)
+
+
+@torch.no_grad()
+def quantized_copy(linear: nn.Linear, mode: str, groupsize: int = 128) -> nn.Module:
+    """A WeightOnlyInt8Linear / WeightOnlyInt4Linear holding a quantized copy of linear's weight, on its device.
+    int4 falls back to int8 when in_features is not a multiple of groupsize."""
+    assert isinstance(linear, nn.Linear), f"Can only quantize full precision linear layers, not {type(linear).__name__}"
+    weight = linear.weight
+    if mode == "int4" and linear.in_features % groupsize != 0:
+        mode = "int8"
+    with torch.device(weight.device):
+        if mode == "int8":
+            copy = WeightOnlyInt8Linear(linear.in_features, linear.out_features)
+            w_q, scales = quantize_int8_per_channel(weight)
+            copy.weight.copy_(w_q)
+            copy.scales = scales.to(weight.dtype)
+        elif mode == "int4":
+            copy = WeightOnlyInt4Linear(linear.in_features, linear.out_features, groupsize=groupsize)
+            w_q, scales_and_zeros = quantize_int4_groupwise(weight, groupsize)
+            copy.weight.copy_(w_q)
+            copy.scales_and_zeros = scales_and_zeros.to(weight.dtype)
+        else:
+            raise ValueError(f"Invalid quantization mode {mode} needs to be one of [int8, int4]")
+    return copy
+
+
+def _quantizable(module: nn.Module, groupsize: int = None):
+    # the nn.Linear layers of the model: every projection and the LM head
+    for name, child in module.named_modules():
+        if isinstance(child, nn.Linear) and (groupsize is None or child.in_features % groupsize == 0):
+            yield name, child
+
+def _replace(module: nn.Module, name: str, new: nn.Module):
+    parent_name, _, child_name = name.rpartition(".")
+    setattr(module.get_submodule(parent_name) if parent_name else module, child_name, new)
+
+
+class WeightOnlyInt8QuantHandler:
+    def __init__(self, mod: nn.Module):
+        self.mod = mod
+
+    @torch.no_grad()
+    def create_quantized_state_dict(self):
+        cur_state_dict = self.mod.state_dict()
+        for name, linear in _quantizable(self.mod):
+            weight, scales = quantize_int8_per_channel(linear.weight)
+            cur_state_dict[f"{name}.weight"] = weight
+            cur_state_dict[f"{name}.scales"] = scales.to(linear.weight.dtype)
+        return cur_state_dict
+
+    def convert_for_runtime(self):
+        for name, linear in list(_quantizable(self.mod)):
+            _replace(self.mod, name, WeightOnlyInt8Linear(linear.in_features, linear.out_features))
+        return self.mod
+
+
+class WeightOnlyInt4QuantHandler:
+    def __init__(self, mod: nn.Module, groupsize: int = 128):
+        assert groupsize in [32, 64, 128, 256]
+        self.mod = mod
+        self.groupsize = groupsize
+
+    @torch.no_grad()
+    def create_quantized_state_dict(self):
+        cur_state_dict = self.mod.state_dict()
+        for name, linear in _quantizable(self.mod, self.groupsize):
+            weight, scales_and_zeros = quantize_int4_groupwise(linear.weight, self.groupsize)
+            cur_state_dict[f"{name}.weight"] = weight
+            cur_state_dict[f"{name}.scales_and_zeros"] = scales_and_zeros.to(linear.weight.dtype)
+        return cur_state_dict
+
+    def convert_for_runtime(self):
+        for name, linear in list(_quantizable(self.mod, self.groupsize)):
+            _replace(self.mod, name, WeightOnlyInt4Linear(linear.in_features, linear.out_features, groupsize=self.groupsize))
+        return self.mod
+
+
+def convert_for_checkpoint(model: nn.Module, checkpoint_path) -> nn.Module:
+    """Swap the linear layers of model for the quantized ones a checkpoint written by quantize.py holds,
+    recognised by its name: model_int8.pth or model_int4.g{groupsize}.pth."""
+    name = checkpoint_path.name
+    if "int8" in name:
+        print("Using int8 weight-only quantization")
+        return WeightOnlyInt8QuantHandler(model).convert_for_runtime()
+    if "int4" in name:
+        match = re.search(r"\.g(\d+)\.", name)
+        assert match is not None, f"int4 checkpoint name must give the groupsize, like model_int4.g128.pth: {name}"
+        print(f"Using int4 weight-only quantization, groupsize {match.group(1)}")
+        return WeightOnlyInt4QuantHandler(model, int(match.group(1))).convert_for_runtime()
+    return model
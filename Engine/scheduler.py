@@ -0,0 +1,214 @@
+from collections import deque
+from dataclasses import dataclass, field
+
+import torch
+
+from MagicDec.Engine.draft_vocab import to_full_vocab
+
+
+@dataclass
+class Request:
+    request_id: int
+    prompt: torch.LongTensor
+    max_new_tokens: int
+    output: list = field(default_factory=list)
+
+
+class ContinuousBatcher:
+    """Continuous batching for greedy speculative decoding.
+
+    Requests wait in a queue. Whenever the sequence in a batch slot finishes (EOS or max_new_tokens) it is
+    retired and the next request is prefilled into that slot of the target and draft caches, while the
+    other slots keep decoding. engine is the target LMBackend with draft an LMBackend_Draft, or a
+    self-speculation LMBackend (backend_selfspec) with draft=None. Every slot must fit
+    prompt + max_new_tokens + gamma + 1 tokens in the engine's max_length. With a paged target cache a request
+    is only admitted once the page pool can hold it until it finishes, so decoding never runs out of pages.
+
+    Without prefill_budget a new request is prefilled whole when it is admitted, stalling the decoding slots
+    for the length of its prompt. With prefill_budget each step spends at most that many tokens in total:
+    the gamma + 1 verified tokens of every decoding slot, and prompt chunks (at least prefill_chunk tokens)
+    of the slots being prefilled, which start decoding in the step their prompt completes.
+
+    With a prefix_cache (prefix_cache.PrefixCache over the same engine and draft) admitted requests start
+    from the KV of their longest cached prompt prefix, and the full blocks they prefill are cached.
+    """
+    def __init__(self, engine, draft=None, gamma: int = 4, eos_token_ids=(), prefill_budget: int = None, prefill_chunk: int = 32, prefix_cache=None):
+        self.engine = engine
+        self.draft = draft
+        self.gamma = gamma
+        self.eos_token_ids = set(eos_token_ids)
+        self.batch_size = engine.batch_size
+        self.device = engine.device
+        self.queue = deque()
+        self.slots = [None] * self.batch_size
+        # prompt tokens already in the caches of each slot
+        self.prefilled = [0] * self.batch_size
+        self.prefill_budget = prefill_budget
+        self.prefill_chunk = prefill_chunk
+        self.prefix_cache = prefix_cache
+        self.finished = []
+        self.num_requests = 0
+        self.rounds = 0
+        self.busy_slot_rounds = 0
+        self.tokens_buffer = torch.zeros((self.batch_size, gamma + 1), dtype=torch.long, device=self.device)
+        self.double_buffer = torch.zeros((self.batch_size, 2), dtype=torch.long, device=self.device)
+        self.cachelens_update = torch.ones(self.batch_size, dtype=torch.long, device=self.device)
+        self.next_double = False
+
+    def submit(self, prompt: torch.LongTensor, max_new_tokens: int) -> Request:
+        assert prompt.numel() + max_new_tokens + self.gamma + 1 <= self.engine.max_length, "Request does not fit in max_seq_length"
+        request = Request(self.num_requests, prompt.flatten(), max_new_tokens)
+        self.num_requests += 1
+        self.queue.append(request)
+        return request
+
+    @property
+    def occupancy(self) -> float:
+        return self.busy_slot_rounds / max(self.rounds * self.batch_size, 1)
+
+    def _draft_inference(self, input_ids, cachelen_update=None):
+        if self.draft is None:
+            return self.engine.draft_inference(input_ids, cachelen_update=cachelen_update)
+        return self.draft.inference(input_ids, cachelen_update=cachelen_update)
+
+    def _draft_cachelens(self):
+        return self.engine.draft_cachelens if self.draft is None else self.draft.cachelens
+
+    def _draft_vocab(self):
+        return self.engine.model.draft_vocab if self.draft is None else self.draft.model.draft_vocab
+
+    def _decoding(self, slot: int) -> bool:
+        request = self.slots[slot]
+        return request is not None and self.prefilled[slot] == request.prompt.numel()
+
+    def _reach(self, request: Request) -> int:
+        # the most tokens the request can hold in the target cache: prompt + max_new_tokens - 1 plus the gamma + 1 of a round
+        return request.prompt.numel() + request.max_new_tokens + self.gamma
+
+    def _admit(self):
+        # with a paged target cache, the head of the queue waits until the pool can hold it next to the tokens
+        # the admitted requests may still grow to (an empty pool always fits one request, see submit)
+        reserved = {slot: self._reach(request) for slot, request in enumerate(self.slots) if request is not None}
+        for slot in range(self.batch_size):
+            if self.slots[slot] is not None or len(self.queue) == 0:
+                continue
+            if getattr(self.engine, "block_manager", None) is not None and not self.engine.can_admit(self._reach(self.queue[0]), reserved):
+                break
+            request = self.queue.popleft()
+            request.prompt = request.prompt.to(self.device).view(1, -1)
+            self.slots[slot] = request
+            reserved[slot] = self._reach(request)
+            self.prefilled[slot] = 0 if self.prefix_cache is None else self.prefix_cache.restore(slot, request.prompt)
+
+    def _prefill(self):
+        # prefill the admitted slots oldest request first, within the step's token budget
+        pending = sorted((slot for slot in range(self.batch_size) if self.slots[slot] is not None and not self._decoding(slot)),
+                         key=lambda slot: self.slots[slot].request_id)
+        if self.prefill_budget is not None:
+            num_decoding = sum(self._decoding(slot) for slot in range(self.batch_size))
+            budget = max(self.prefill_budget - num_decoding * (self.gamma + 1), self.prefill_chunk)
+        for slot in pending:
+            request = self.slots[slot]
+            while not self._decoding(slot) and (self.prefill_budget is None or budget > 0):
+                start = self.prefilled[slot]
+                end = request.prompt.numel()
+                if self.prefix_cache is not None:
+                    # stop at block boundaries, where the new blocks are cached
+                    block_size = self.prefix_cache.block_size
+                    end = min(end, start - start % block_size + block_size)
+                if self.prefill_budget is not None:
+                    end = min(end, start + budget)
+                    budget -= end - start
+                logits = self.engine.prefill_slot(slot, request.prompt, start, end)
+                if self.draft is not None:
+                    self.draft.prefill_slot(slot, request.prompt, start, end)
+                self.prefilled[slot] = end
+                if self.prefix_cache is not None and end % self.prefix_cache.block_size == 0:
+                    self.prefix_cache.insert(slot, request.prompt.flatten(), end)
+            if self._decoding(slot):
+                self._start_decoding(slot, logits[0, -1].argmax())
+
+    def _start_decoding(self, slot: int, token: torch.LongTensor):
+        self.slots[slot].output.append(token.item())
+        self.tokens_buffer[slot, 0] = token
+        # the draft has not seen the first token yet: a single-token step, also within a double round
+        self.double_buffer[slot, 0] = token
+        self.double_buffer[slot, 1] = 0
+        self.cachelens_update[slot] = 1
+
+    def _retire(self, slot: int):
+        self.finished.append(self.slots[slot])
+        self.slots[slot] = None
+        self.prefilled[slot] = 0
+        self.engine.free_slot(slot)
+        if self.draft is not None:
+            self.draft.cachelens[slot] = 0
+
+    @torch.inference_mode()
+    def step(self):
+        """Admit waiting requests into free slots, prefill them (within the budget), then run one draft + verify
+        round for the whole batch."""
+        self._admit()
+        self._prefill()
+        if not any(self._decoding(slot) for slot in range(self.batch_size)):
+            return self.finished
+        gamma = self.gamma
+        if getattr(self.engine, "block_manager", None) is not None:
+            # pages for the round's gamma + 1 tokens of the decoding slots, from their host-side lengths
+            # (prompt + output - 1 cached tokens); the other slots write to the scratch page
+            self.engine.reserve({slot: self.slots[slot].prompt.numel() + len(self.slots[slot].output) + gamma
+                                 for slot in range(self.batch_size) if self._decoding(slot)})
+        for i in range(gamma):
+            if i == 0 and self.next_double:
+                draft_logits = self._draft_inference(self.double_buffer, cachelen_update=self.cachelens_update)
+                draft_logits = draft_logits[torch.arange(self.batch_size, device=self.device), self.cachelens_update - 1]
+                self.next_double = False
+            else:
+                draft_logits = self._draft_inference(self.tokens_buffer[:, i].view(-1, 1))[:, -1]
+            self.tokens_buffer[:, i + 1] = to_full_vocab(draft_logits.argmax(dim=-1), self._draft_vocab())
+
+        target_tokens = self.engine.inference(self.tokens_buffer).argmax(dim=-1)
+        accept_nums = 1 + (target_tokens[:, :gamma] == self.tokens_buffer[:, 1:]).int().cumprod(dim=1).sum(dim=1)
+        bonus_tokens = target_tokens.gather(1, (accept_nums - 1).view(-1, 1)).flatten()
+        self.engine.cachelens += accept_nums - gamma - 1
+        draft_cachelens = self._draft_cachelens()
+        draft_cachelens += accept_nums.clamp(max=gamma) - gamma
+
+        # the last draft token is not in the draft cache when the whole chain was accepted
+        mask = accept_nums == gamma + 1
+        self.double_buffer[:, 0] = torch.where(mask, self.tokens_buffer[:, gamma], bonus_tokens)
+        self.double_buffer[:, 1] = torch.where(mask, bonus_tokens, torch.zeros_like(bonus_tokens))
+        self.cachelens_update = 1 + mask.long()
+        self.next_double = bool(mask.any())
+
+        accepted = self.tokens_buffer[:, 1:].tolist()
+        accept_list, bonus_list = accept_nums.tolist(), bonus_tokens.tolist()
+        self.tokens_buffer[:, 0] = bonus_tokens
+        self.rounds += 1
+        for slot, request in enumerate(self.slots):
+            if not self._decoding(slot):
+                continue
+            self.busy_slot_rounds += 1
+            new_tokens = accepted[slot][:accept_list[slot] - 1] + [bonus_list[slot]]
+            done = False
+            for token in new_tokens:
+                request.output.append(token)
+                if token in self.eos_token_ids or len(request.output) >= request.max_new_tokens:
+                    done = True
+                    break
+            if done:
+                self._retire(slot)
+        # free and prefilling slots keep running with the batch, their caches go back to the prompt tokens
+        # prefilled so far every round (what the round wrote past them is overwritten by the next chunk)
+        hold = torch.tensor([not self._decoding(slot) for slot in range(self.batch_size)], device=self.device)
+        hold_lens = torch.tensor(self.prefilled, device=self.device)
+        for cachelens in (self.engine.cachelens, self._draft_cachelens()):
+            cachelens.copy_(torch.where(hold, hold_lens.to(cachelens.dtype), cachelens))
+        self.cachelens_update.masked_fill_(hold, 1)
+        return self.finished
+
+    def run(self):
+        """Serve every submitted request, returns them in submission order."""
+        while len(self.queue) > 0 or any(request is not None for request in self.slots):
+            self.step()
+        return sorted(self.finished, key=lambda request: request.request_id)
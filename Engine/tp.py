@@ -97,6 +97,9 @@ def _apply_tp_linear(linear: nn.Linear, style: str, weight_splits: List[int] = [
         v = shard(v, dim, kv_start, kv_end)
         return torch.cat((q,k,v), dim=dim)
 
+    # int4 layers pack two input channels per byte, with a (scale, zero) per group of input channels
+    groupsize = getattr(linear, "groupsize", None)
+
     # shard
     if weight_splits:
         # attention
@@ -104,14 +107,22 @@ def _apply_tp_linear(linear: nn.Linear, style: str, weight_splits: List[int] = [
         sharded_weight = shard_qkv(linear.weight, shard_dim, weight_splits)
         if hasattr(linear, "scales") and style == "colwise":
             linear.scales = shard_qkv(linear.scales, 0, weight_splits)
+        if hasattr(linear, "scales_and_zeros"):
+            linear.scales_and_zeros = shard_qkv(linear.scales_and_zeros, 1, weight_splits)
+    elif groupsize is not None and style == "rowwise":
+        assert q_start % groupsize == 0 and q_end % groupsize == 0, f"Shards of {linear} must hold whole groups of {groupsize}"
+        sharded_weight = shard(linear.weight, 1, q_start // 2, q_end // 2)
+        linear.scales_and_zeros = shard(linear.scales_and_zeros, 0, q_start // groupsize, q_end // groupsize)
     else:
         sharded_weight = shard(linear.weight, shard_dim, q_start, q_end)
         if hasattr(linear, "scales") and style == "colwise":
             linear.scales = shard(linear.scales, 0, q_start, q_end)
+        if hasattr(linear, "scales_and_zeros"):
+            linear.scales_and_zeros = shard(linear.scales_and_zeros, 1, q_start, q_end)
 
     # local_break()
     linear.weight = nn.Parameter(sharded_weight, requires_grad=False)
-    setattr(linear, size_attr, linear.weight.shape[shard_dim])
+    setattr(linear, size_attr, linear.weight.shape[shard_dim] * (2 if groupsize is not None and style == "rowwise" else 1))
 
     # shape info should still be synced
     # assert linear.weight.shape == (linear.out_features, linear.in_features)
@@ -136,26 +147,41 @@ def _apply_tp_linear_mlp(linear: nn.Linear, style: str, weight_splits: List[int]
         # assert x.size(dim=dim) % world_size == 0
         return torch.chunk(x, world_size, dim=dim)[rank]
 
+    def shard_merged(x, dim, weight_splits):
+        # shard every part of a merged matrix on its own, so each rank keeps the same layout
+        if not weight_splits:
+            return shard(x, dim)
+        return torch.cat([shard(part, dim) for part in x.split(weight_splits, dim=dim)], dim=dim)
+
+    # int4 layers pack two input channels per byte, with a (scale, zero) per group of input channels
+    groupsize = getattr(linear, "groupsize", None)
+
     # shard
-    sharded_weight = shard(linear.weight, shard_dim)
+    sharded_weight = shard_merged(linear.weight, shard_dim, weight_splits)
     if hasattr(linear, "scales") and style == "colwise":
-        linear.scales = shard(linear.scales, 0)
+        linear.scales = shard_merged(linear.scales, 0, weight_splits)
+    if hasattr(linear, "scales_and_zeros"):
+        if style == "colwise":
+            linear.scales_and_zeros = shard_merged(linear.scales_and_zeros, 1, weight_splits)
+        else:
+            assert linear.scales_and_zeros.size(0) % world_size == 0, f"Shards of {linear} must hold whole groups of {groupsize}"
+            linear.scales_and_zeros = shard(linear.scales_and_zeros, 0)
 
     # local_break()
     linear.weight = nn.Parameter(sharded_weight, requires_grad=False)
-    setattr(linear, size_attr, linear.weight.shape[shard_dim])
+    setattr(linear, size_attr, linear.weight.shape[shard_dim] * (2 if groupsize is not None and style == "rowwise" else 1))
 
     # shape info should still be synced
     # assert linear.weight.shape == (linear.out_features, linear.in_features)
 
 
 def _apply_tp_ffn(mlp: FeedForward, rank_group, group) -> None:
-    assert hasattr(mlp, "w1")
-    assert hasattr(mlp, "w3")
+    assert hasattr(mlp, "w13")
     assert hasattr(mlp, "w2")
 
-    _apply_tp_linear_mlp(mlp.w1, "colwise", rank_group=rank_group)
-    _apply_tp_linear_mlp(mlp.w3, "colwise", rank_group=rank_group)
+    # w13 is [w1; w3]: each rank takes its slice of both
+    intermediate_size = mlp.w13.weight.size(0) // 2
+    _apply_tp_linear_mlp(mlp.w13, "colwise", [intermediate_size, intermediate_size], rank_group=rank_group)
     _apply_tp_linear_mlp(mlp.w2, "rowwise", rank_group=rank_group)
     mlp.process_group = group
 
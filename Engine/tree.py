@@ -0,0 +1,59 @@
+import torch
+
+
+class SpecTree:
+    """Token tree verified by the target in one forward pass.
+
+    The draft's greedy chain of `depth` tokens is expanded with the next `width` - 1 best draft tokens
+    at every depth as sibling leaves. Node 0 is the root (the last accepted token), nodes 1..depth are
+    the chain and the siblings follow depth by depth, so an accepted chain prefix is already contiguous.
+    """
+    def __init__(self, depth: int, width: int, device):
+        assert depth >= 1 and width >= 1
+        self.depth = depth
+        self.width = width
+        self.size = 1 + depth * width
+        parents = [-1] + list(range(depth)) + [d for d in range(depth) for _ in range(width - 1)]
+        depths = [0] + list(range(1, depth + 1)) + [d + 1 for d in range(depth) for _ in range(width - 1)]
+        # mask[i, j]: node j is node i or one of its ancestors
+        mask = torch.eye(self.size, dtype=torch.bool)
+        for i in range(1, self.size):
+            mask[i] |= mask[parents[i]]
+        self.mask = mask.to(device)
+        self.depths = torch.tensor(depths, device=device)
+        # [depth, width - 1] node indices of the siblings at depth d + 1
+        self.siblings = torch.arange(depth + 1, self.size, device=device).view(depth, width - 1)
+
+    def build(self, chain_tokens, sibling_tokens):
+        # chain_tokens: [B, depth + 1] root and chain, sibling_tokens: [B, depth, width - 1]
+        return torch.cat([chain_tokens, sibling_tokens.flatten(1)], dim=1)
+
+def top_siblings(logits, width):
+    # logits: [B, V] of one draft step, returns the runner-up tokens [B, width - 1]
+    return logits.topk(width, dim=-1).indices[:, 1:]
+
+def verify_tree_greedy(tree: SpecTree, tokens, target_tokens):
+    """Greedy verification of a SpecTree. tokens/target_tokens: [B, tree.size] tree tokens and the target's
+    argmax after every node. The chain is accepted as long as it matches, then a sibling at the first
+    mismatching depth can still be accepted.
+
+    Returns path [B, depth + 1] (node indices of the root and the accepted tokens, valid up to accept_nums),
+    path_tokens, accept_nums [B] (root included), bonus [B] and sibling_accepted [B].
+    """
+    B, d = tokens.size(0), tree.depth
+    batch = torch.arange(B, device=tokens.device)
+    chain_accept = (tokens[:, 1:d + 1] == target_tokens[:, :d]).int().cumprod(dim=1).sum(dim=1)
+    path = torch.arange(d + 1, device=tokens.device).repeat(B, 1)
+    if tree.width > 1:
+        expected = target_tokens[batch, chain_accept]
+        sibling_nodes = tree.siblings[chain_accept.clamp(max=d - 1)]
+        match = (tokens.gather(1, sibling_nodes) == expected.unsqueeze(1)) & (chain_accept < d).unsqueeze(1)
+        sibling_accepted = match.any(dim=1)
+        sibling = sibling_nodes.gather(1, match.int().argmax(dim=1, keepdim=True)).squeeze(1)
+        index = (chain_accept + 1).clamp(max=d)
+        path[batch, index] = torch.where(sibling_accepted, sibling, path[batch, index])
+    else:
+        sibling_accepted = torch.zeros(B, dtype=torch.bool, device=tokens.device)
+    accept_nums = chain_accept + 1 + sibling_accepted.long()
+    bonus = target_tokens[batch, path[batch, accept_nums - 1]]
+    return path, tokens.gather(1, path), accept_nums, bonus, sibling_accepted
@@ -0,0 +1,169 @@
+import math
+from functools import lru_cache
+
+import torch
+import triton
+import triton.language as tl
+
+from MagicDec.Engine.utils import merge_attn_states
+
+
+@triton.jit
+def _decode_attn_kernel(
+    Q, K_cache, V_cache, K_new, V_new, Out, Lse, CacheSeqlens, K_scale, V_scale, sm_scale,
+    stride_qb, stride_qt, stride_qh,
+    stride_kb, stride_ks, stride_kh,
+    stride_vb, stride_vs, stride_vh,
+    stride_nkb, stride_nkt, stride_nkh,
+    stride_nvb, stride_nvt, stride_nvh,
+    stride_ob, stride_ot, stride_oh, stride_os,
+    stride_lb, stride_lt, stride_lh,
+    stride_sb, stride_ss, stride_sh,
+    T: tl.constexpr, REP: tl.constexpr, HEAD_DIM: tl.constexpr,
+    NUM_SPLITS: tl.constexpr, MIN_CHUNK: tl.constexpr, QUANT: tl.constexpr,
+    BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_T: tl.constexpr,
+):
+    bid = tl.program_id(0)
+    kv_head = tl.program_id(1)
+    split = tl.program_id(2)
+
+    # the REP query heads sharing this KV head and the T new tokens form one tile of T*REP rows,
+    # so every K/V block is read once per KV head
+    offs_m = tl.arange(0, BLOCK_M)
+    offs_n = tl.arange(0, BLOCK_N)
+    offs_t = tl.arange(0, BLOCK_T)
+    offs_d = tl.arange(0, HEAD_DIM)
+    tok = offs_m // REP
+    head = kv_head * REP + offs_m % REP
+    m_valid = offs_m < T * REP
+    t_valid = offs_t < T
+
+    cache_len = tl.load(CacheSeqlens + bid)
+    q = tl.load(Q + bid * stride_qb + tok[:, None] * stride_qt + head[:, None] * stride_qh + offs_d[None, :],
+                mask=m_valid[:, None], other=0.0)
+
+    m_i = tl.full([BLOCK_M], float("-inf"), dtype=tl.float32)
+    l_i = tl.zeros([BLOCK_M], dtype=tl.float32)
+    acc = tl.zeros([BLOCK_M, HEAD_DIM], dtype=tl.float32)
+    qk_scale = sm_scale * 1.44269504
+
+    # past tokens: visible to every query row. The cached range is cut into NUM_SPLITS partitions
+    # sized from this row's cache_seqlens, short rows use fewer (but at least MIN_CHUNK long) partitions.
+    chunk = tl.maximum(tl.cdiv(tl.cdiv(cache_len, NUM_SPLITS), BLOCK_N) * BLOCK_N, MIN_CHUNK)
+    start = split * chunk
+    end = tl.minimum(start + chunk, cache_len)
+    k_base = K_cache + bid * stride_kb + kv_head * stride_kh
+    v_base = V_cache + bid * stride_vb + kv_head * stride_vh
+    ks_base = K_scale + bid * stride_sb + kv_head * stride_sh
+    vs_base = V_scale + bid * stride_sb + kv_head * stride_sh
+    for start_n in range(start, end, BLOCK_N):
+        cols = start_n + offs_n
+        k = tl.load(k_base + cols[None, :] * stride_ks + offs_d[:, None], mask=cols[None, :] < end, other=0.0)
+        if QUANT:
+            # 8-bit cache: dequantize with the per-token, per-head scales
+            k_s = tl.load(ks_base + cols * stride_ss, mask=cols < end, other=0.0)
+            k = (k.to(tl.float32) * k_s[None, :]).to(Q.dtype.element_ty)
+        qk = tl.dot(q, k) * qk_scale
+        qk = tl.where(cols[None, :] < end, qk, float("-inf"))
+        m_new = tl.maximum(m_i, tl.max(qk, 1))
+        alpha = tl.math.exp2(m_i - m_new)
+        p = tl.math.exp2(qk - m_new[:, None])
+        l_i = l_i * alpha + tl.sum(p, 1)
+        v = tl.load(v_base + cols[:, None] * stride_vs + offs_d[None, :], mask=cols[:, None] < end, other=0.0)
+        if QUANT:
+            v_s = tl.load(vs_base + cols * stride_ss, mask=cols < end, other=0.0)
+            v = (v.to(tl.float32) * v_s[:, None]).to(Q.dtype.element_ty)
+        acc = acc * alpha[:, None] + tl.dot(p.to(v.dtype), v)
+        m_i = m_new
+
+    # new tokens: causal among themselves, read from registers and appended to the cache by the last split
+    # (a quantized cache is written by the caller instead)
+    if split == NUM_SPLITS - 1:
+        k_new = tl.load(K_new + bid * stride_nkb + offs_t[None, :] * stride_nkt + kv_head * stride_nkh + offs_d[:, None],
+                        mask=t_valid[None, :], other=0.0)
+        v_new = tl.load(V_new + bid * stride_nvb + offs_t[:, None] * stride_nvt + kv_head * stride_nvh + offs_d[None, :],
+                        mask=t_valid[:, None], other=0.0)
+        qk = tl.dot(q, k_new) * qk_scale
+        qk = tl.where((offs_t[None, :] <= tok[:, None]) & t_valid[None, :], qk, float("-inf"))
+        m_new = tl.maximum(m_i, tl.max(qk, 1))
+        alpha = tl.math.exp2(m_i - m_new)
+        p = tl.math.exp2(qk - m_new[:, None])
+        l_i = l_i * alpha + tl.sum(p, 1)
+        acc = acc * alpha[:, None] + tl.dot(p.to(v_new.dtype), v_new)
+        m_i = m_new
+
+        if not QUANT:
+            tl.store(k_base + (cache_len + offs_t)[None, :] * stride_ks + offs_d[:, None], k_new, mask=t_valid[None, :])
+            tl.store(v_base + (cache_len + offs_t)[:, None] * stride_vs + offs_d[None, :], v_new, mask=t_valid[:, None])
+
+    # empty partitions produce a zero output with lse = -inf, which drops out of the merge
+    acc = tl.where(l_i[:, None] > 0, acc / l_i[:, None], 0.0)
+    tl.store(Out + bid * stride_ob + tok[:, None] * stride_ot + head[:, None] * stride_oh + split * stride_os + offs_d[None, :],
+             acc.to(Out.dtype.element_ty), mask=m_valid[:, None])
+    if NUM_SPLITS > 1:
+        lse = (m_i + tl.math.log2(l_i)) * 0.69314718
+        tl.store(Lse + bid * stride_lb + tok * stride_lt + head * stride_lh + split, lse, mask=m_valid)
+
+
+@lru_cache
+def _multi_processor_count(device):
+    return torch.cuda.get_device_properties(device).multi_processor_count
+
+def num_kv_splits(batch_size, num_kv_heads, max_seq_length, device, min_chunk=512, max_splits=64):
+    """Number of KV partitions needed to give every SM a couple of (batch, kv head, split) programs."""
+    splits = triton.cdiv(2 * _multi_processor_count(device), batch_size * num_kv_heads)
+    return max(1, min(splits, triton.cdiv(max_seq_length, min_chunk), max_splits))
+
+def _launch_decode_attn(q, k_cache, v_cache, k, v, cache_seqlens, num_splits, min_chunk=512, k_scale=None, v_scale=None):
+    B, T, H_q, D = q.size()
+    H_k = k_cache.size(2)
+    rep = H_q // H_k
+    assert q.stride(-1) == k_cache.stride(-1) == v_cache.stride(-1) == k.stride(-1) == v.stride(-1) == 1
+    quant = k_scale is not None
+    if quant:
+        assert k_scale.stride() == v_scale.stride()
+    else:
+        k_scale = v_scale = cache_seqlens
+    if num_splits == 1:
+        out = torch.empty_like(q).unsqueeze(3)
+        lse = out
+    else:
+        out = torch.empty(B, T, H_q, num_splits, D, dtype=torch.float32, device=q.device)
+        lse = torch.empty(B, T, H_q, num_splits, dtype=torch.float32, device=q.device)
+    _decode_attn_kernel[(B, H_k, num_splits)](
+        q, k_cache, v_cache, k, v, out, lse, cache_seqlens, k_scale, v_scale, 1.0 / math.sqrt(D),
+        q.stride(0), q.stride(1), q.stride(2),
+        k_cache.stride(0), k_cache.stride(1), k_cache.stride(2),
+        v_cache.stride(0), v_cache.stride(1), v_cache.stride(2),
+        k.stride(0), k.stride(1), k.stride(2),
+        v.stride(0), v.stride(1), v.stride(2),
+        out.stride(0), out.stride(1), out.stride(2), out.stride(3),
+        lse.stride(0), lse.stride(1), lse.stride(2),
+        *(k_scale.stride() if quant else (0, 0, 0)),
+        T=T, REP=rep, HEAD_DIM=D, NUM_SPLITS=num_splits, MIN_CHUNK=min_chunk, QUANT=quant,
+        BLOCK_M=max(16, triton.next_power_of_2(T * rep)), BLOCK_N=64, BLOCK_T=max(16, triton.next_power_of_2(T)),
+        num_warps=4,
+    )
+    if num_splits == 1:
+        return out.squeeze(3)
+    return merge_attn_states(out, lse)[0].to(q.dtype)
+
+def gqa_decode_attention(q, k_cache, v_cache, k, v, cache_seqlens):
+    """Append k/v to the cache at cache_seqlens and attend q causally with grouped heads, in one kernel.
+
+    q: [B, T, H_q, D], k_cache/v_cache: [B, S, H_k, D], k/v: [B, T, H_k, D], cache_seqlens: [B] int32
+    """
+    return _launch_decode_attn(q, k_cache, v_cache, k, v, cache_seqlens, num_splits=1)
+
+def split_kv_decode_attention(q, k_cache, v_cache, k, v, cache_seqlens):
+    """Flash-decoding: same contract as gqa_decode_attention, but the cached sequence is split into
+    partitions attended in parallel and merged with log-sum-exp, for long contexts at small batch sizes."""
+    num_splits = num_kv_splits(q.size(0), k_cache.size(2), k_cache.size(1), q.device)
+    return _launch_decode_attn(q, k_cache, v_cache, k, v, cache_seqlens, num_splits=num_splits)
+
+def quant_decode_attention(q, k_cache, v_cache, k_scale, v_scale, k, v, cache_seqlens):
+    """Decode attention over an 8-bit (int8/fp8) cache with per-token, per-head scales [B, S, H_k],
+    dequantized on load. The caller appends the quantized k/v to the cache; the new tokens themselves
+    are attended at full precision."""
+    num_splits = num_kv_splits(q.size(0), k_cache.size(2), k_cache.size(1), q.device)
+    return _launch_decode_attn(q, k_cache, v_cache, k, v, cache_seqlens, num_splits=num_splits, k_scale=k_scale, v_scale=v_scale)
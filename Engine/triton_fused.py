@@ -0,0 +1,105 @@
+import torch
+import triton
+import triton.language as tl
+
+
+@triton.jit
+def _add_rms_norm_kernel(
+    X, R, W, Out, H,
+    N, eps,
+    HAS_RESIDUAL: tl.constexpr, BLOCK_N: tl.constexpr,
+):
+    # one row per program: h = x + r (rounded to the input dtype), out = norm(h) * w
+    row = tl.program_id(0)
+    cols = tl.arange(0, BLOCK_N)
+    mask = cols < N
+    x = tl.load(X + row * N + cols, mask=mask, other=0.0)
+    if HAS_RESIDUAL:
+        r = tl.load(R + row * N + cols, mask=mask, other=0.0)
+        x = (x.to(tl.float32) + r.to(tl.float32)).to(X.dtype.element_ty)
+        tl.store(H + row * N + cols, x, mask=mask)
+    xf = x.to(tl.float32)
+    rstd = tl.rsqrt(tl.sum(xf * xf, axis=0) / N + eps)
+    # same roundings as the reference: normalized value in the input dtype, then times the weight
+    y = (xf * rstd).to(X.dtype.element_ty).to(tl.float32)
+    w = tl.load(W + cols, mask=mask, other=0.0).to(tl.float32)
+    tl.store(Out + row * N + cols, (y * w).to(Out.dtype.element_ty), mask=mask)
+
+
+def add_rms_norm(x, residual, weight, eps):
+    """norm(x + residual) * weight and x + residual, in one pass over the rows (residual may be None)."""
+    N = x.size(-1)
+    x = x.reshape(-1, N).contiguous()
+    out = torch.empty(x.shape, dtype=torch.result_type(x, weight), device=x.device)
+    h = None
+    if residual is not None:
+        residual = residual.reshape(-1, N).contiguous()
+        h = torch.empty_like(x)
+    BLOCK_N = triton.next_power_of_2(N)
+    _add_rms_norm_kernel[(x.size(0),)](
+        x, residual if residual is not None else x, weight, out, h if h is not None else x,
+        N, eps,
+        HAS_RESIDUAL=residual is not None, BLOCK_N=BLOCK_N,
+        num_warps=min(max(BLOCK_N // 256, 1), 16),
+    )
+    return out, h
+
+
+@triton.jit
+def _rope_kernel(
+    X, F,
+    stride_b, stride_t, stride_h,
+    T, num_heads,
+    HALF: tl.constexpr, BLOCK_H: tl.constexpr, BLOCK_D: tl.constexpr,
+):
+    # one (batch, token) per program, all heads rotated in place
+    bt = tl.program_id(0)
+    b = bt // T
+    t = bt % T
+    heads = tl.arange(0, BLOCK_H)[:, None]
+    pairs = tl.arange(0, BLOCK_D)[None, :]
+    mask = (heads < num_heads) & (pairs < HALF)
+    cos = tl.load(F + bt * HALF * 2 + pairs * 2, mask=pairs < HALF, other=0.0).to(tl.float32)
+    sin = tl.load(F + bt * HALF * 2 + pairs * 2 + 1, mask=pairs < HALF, other=0.0).to(tl.float32)
+    ptrs = X + b * stride_b + t * stride_t + heads * stride_h + pairs * 2
+    x0 = tl.load(ptrs, mask=mask, other=0.0).to(tl.float32)
+    x1 = tl.load(ptrs + 1, mask=mask, other=0.0).to(tl.float32)
+    tl.store(ptrs, (x0 * cos - x1 * sin).to(X.dtype.element_ty), mask=mask)
+    tl.store(ptrs + 1, (x1 * cos + x0 * sin).to(X.dtype.element_ty), mask=mask)
+
+
+def rotary_emb_(x, freqs_cis):
+    # x: [B, T, H, D] with a contiguous last dim, freqs_cis: [B, T, D // 2, 2]
+    B, T, H, D = x.shape
+    assert x.stride(-1) == 1
+    freqs_cis = freqs_cis.contiguous()
+    _rope_kernel[(B * T,)](
+        x, freqs_cis,
+        x.stride(0), x.stride(1), x.stride(2),
+        T, H,
+        HALF=D // 2, BLOCK_H=triton.next_power_of_2(H), BLOCK_D=triton.next_power_of_2(D // 2),
+        num_warps=4,
+    )
+
+
+@triton.jit
+def _silu_mul_kernel(X, Out, N, BLOCK_N: tl.constexpr):
+    # X rows are [gate | up], Out rows silu(gate) * up
+    row = tl.program_id(0)
+    cols = tl.program_id(1) * BLOCK_N + tl.arange(0, BLOCK_N)
+    mask = cols < N
+    gate = tl.load(X + row * 2 * N + cols, mask=mask, other=0.0).to(tl.float32)
+    up = tl.load(X + row * 2 * N + N + cols, mask=mask, other=0.0)
+    # same roundings as F.silu(gate) * up
+    act = (gate * tl.sigmoid(gate)).to(X.dtype.element_ty).to(tl.float32)
+    tl.store(Out + row * N + cols, (act * up.to(tl.float32)).to(Out.dtype.element_ty), mask=mask)
+
+
+def silu_mul(x):
+    """silu(x[..., :N]) * x[..., N:] for x [..., 2N], without materializing the activation."""
+    N = x.size(-1) // 2
+    x2d = x.reshape(-1, 2 * N).contiguous()
+    out = torch.empty((x2d.size(0), N), dtype=x.dtype, device=x.device)
+    BLOCK_N = 1024
+    _silu_mul_kernel[(x2d.size(0), triton.cdiv(N, BLOCK_N))](x2d, out, N, BLOCK_N=BLOCK_N, num_warps=4)
+    return out.view(*x.shape[:-1], N)
@@ -0,0 +1,94 @@
+import torch
+import triton
+import triton.language as tl
+
+
+@triton.jit
+def _int8_matmul_kernel(
+    X, W, S, Out,
+    M, N, K,
+    stride_xm, stride_om,
+    BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_K: tl.constexpr,
+):
+    # Out = (X @ W^T) * S with W [N, K] int8 and per-output-channel scales S [N]
+    pid_m = tl.program_id(0)
+    pid_n = tl.program_id(1)
+    rm = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+    rn = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+    rk = tl.arange(0, BLOCK_K)
+    acc = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+    for k in range(0, K, BLOCK_K):
+        kk = k + rk
+        x = tl.load(X + rm[:, None] * stride_xm + kk[None, :], mask=(rm[:, None] < M) & (kk[None, :] < K), other=0.0)
+        w = tl.load(W + rn[None, :] * K + kk[:, None], mask=(rn[None, :] < N) & (kk[:, None] < K), other=0)
+        acc += tl.dot(x, w.to(x.dtype))
+    s = tl.load(S + rn, mask=rn < N, other=0.0).to(tl.float32)
+    acc = acc * s[None, :]
+    tl.store(Out + rm[:, None] * stride_om + rn[None, :], acc.to(Out.dtype.element_ty), mask=(rm[:, None] < M) & (rn[None, :] < N))
+
+
+def int8_matmul(x, weight, scales):
+    K = x.size(-1)
+    N = weight.size(0)
+    x2d = x.reshape(-1, K).contiguous()
+    M = x2d.size(0)
+    out = torch.empty((M, N), dtype=x.dtype, device=x.device)
+    BLOCK_M, BLOCK_N, BLOCK_K = 16, 64, 64
+    _int8_matmul_kernel[(triton.cdiv(M, BLOCK_M), triton.cdiv(N, BLOCK_N))](
+        x2d, weight, scales, out,
+        M, N, K,
+        x2d.stride(0), out.stride(0),
+        BLOCK_M=BLOCK_M, BLOCK_N=BLOCK_N, BLOCK_K=BLOCK_K,
+        num_warps=4,
+    )
+    return out.view(*x.shape[:-1], N)
+
+
+@triton.jit
+def _int4_matmul_kernel(
+    X, W, SZ, Out,
+    M, N, K,
+    stride_xm, stride_om, groupsize,
+    BLOCK_M: tl.constexpr, BLOCK_N: tl.constexpr, BLOCK_K: tl.constexpr,
+):
+    # W [N, K // 2] uint8 holds column 2i in the low and 2i + 1 in the high nibble,
+    # SZ [K // groupsize, N, 2] the (scale, zero) of every group: w = (q - 8) * scale + zero
+    pid_m = tl.program_id(0)
+    pid_n = tl.program_id(1)
+    rm = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+    rn = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+    rp = tl.arange(0, BLOCK_K // 2)
+    x_mask = rm[:, None] < M
+    n_mask = rn < N
+    acc = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+    for k in range(0, K, BLOCK_K):
+        even = k + 2 * rp
+        x_even = tl.load(X + rm[:, None] * stride_xm + even[None, :], mask=x_mask, other=0.0)
+        x_odd = tl.load(X + rm[:, None] * stride_xm + even[None, :] + 1, mask=x_mask, other=0.0)
+        packed = tl.load(W + rn[None, :] * (K // 2) + (k // 2 + rp)[:, None], mask=n_mask[None, :], other=0)
+        group = k // groupsize
+        scale = tl.load(SZ + group * N * 2 + rn * 2, mask=n_mask, other=0.0).to(tl.float32)
+        zero = tl.load(SZ + group * N * 2 + rn * 2 + 1, mask=n_mask, other=0.0).to(tl.float32)
+        lo = ((packed & 0xF).to(tl.float32) - 8.0) * scale[None, :] + zero[None, :]
+        hi = ((packed >> 4).to(tl.float32) - 8.0) * scale[None, :] + zero[None, :]
+        acc += tl.dot(x_even, lo.to(x_even.dtype))
+        acc += tl.dot(x_odd, hi.to(x_odd.dtype))
+    tl.store(Out + rm[:, None] * stride_om + rn[None, :], acc.to(Out.dtype.element_ty), mask=x_mask & n_mask[None, :])
+
+
+def int4_matmul(x, weight, scales_and_zeros, groupsize):
+    K = x.size(-1)
+    N = weight.size(0)
+    x2d = x.reshape(-1, K).contiguous()
+    M = x2d.size(0)
+    out = torch.empty((M, N), dtype=x.dtype, device=x.device)
+    # a K block never crosses a group, and half of it is a valid tl.dot size
+    BLOCK_M, BLOCK_N, BLOCK_K = 16, 64, min(64, groupsize)
+    _int4_matmul_kernel[(triton.cdiv(M, BLOCK_M), triton.cdiv(N, BLOCK_N))](
+        x2d, weight, scales_and_zeros.contiguous(), out,
+        M, N, K,
+        x2d.stride(0), out.stride(0), groupsize,
+        BLOCK_M=BLOCK_M, BLOCK_N=BLOCK_N, BLOCK_K=BLOCK_K,
+        num_warps=4,
+    )
+    return out.view(*x.shape[:-1], N)
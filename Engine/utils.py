@@ -2,7 +2,12 @@ import torch
 import numpy as np
 import random
 from torch.nn.functional import softmax
-from flash_attn import flash_attn_with_kvcache
+from MagicDec.Engine.quantize import convert_for_checkpoint
+try:
+    from flash_attn import flash_attn_with_kvcache, flash_attn_varlen_func
+except ImportError:
+    # flash-attn is only needed by the "flash_attn" attention backend, see attn_backends.py
+    flash_attn_with_kvcache = flash_attn_varlen_func = None
 
 torch.library.define(
     "mylib::custom_func",
@@ -34,6 +39,21 @@ def custom_func_2(q, k_cache, v_cache):
 def custom_func_2_abstract(q, k_cache, v_cache):
     return torch.empty_like(q)
 
+torch.library.define(
+    "mylib::paged_func",
+    "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor k, Tensor v, Tensor cache_seqlens, Tensor block_table) -> Tensor",
+)
+
+@torch.library.impl("mylib::paged_func", "cuda")
+def paged_func(q, k_cache, v_cache, k, v, cache_seqlens, block_table):
+    return flash_attn_with_kvcache(
+        q, k_cache, v_cache, k=k, v=v, cache_seqlens=cache_seqlens, block_table=block_table, causal=True
+    )
+
+@torch.library.impl_abstract("mylib::paged_func")
+def paged_func_abstract(q, k_cache, v_cache, k, v, cache_seqlens, block_table):
+    return torch.empty_like(q)
+
 torch.library.define(
     "mylib::gqa_custom",
     "(Tensor q, Tensor(a!) k_cache, Tensor(b!) v_cache, Tensor k, Tensor v, Tensor cache_seqlens) -> Tensor",
@@ -106,6 +126,17 @@ def gqa_custom(q, k_cache, v_cache, k, v, cache_seqlens):
 
     return y.to(q.dtype)
 
+def merge_attn_states(out, lse):
+    """Merge partial attention results computed over disjoint key sets.
+
+    out: [..., P, D], lse: [..., P] log-sum-exp of the scores of each part. Returns ([..., D], [...]).
+    """
+    lse_max = lse.max(dim=-1, keepdim=True).values
+    weights = torch.exp(lse - lse_max)
+    weights_sum = weights.sum(dim=-1)
+    merged = (out.float() * weights.unsqueeze(-1)).sum(dim=-2) / weights_sum.unsqueeze(-1)
+    return merged, lse_max.squeeze(-1) + torch.log(weights_sum)
+
 def get_sampling_logits(logits :torch.Tensor, top_p:float, T: float, replicate = False):
     if replicate:
         logits = logits.clone()
@@ -135,9 +166,40 @@ def sample(logits, top_p, T):
         seq_len = 1
     logits = get_sampling_logits(logits=logits, top_p=top_p, T=T, replicate=True)
     logits = softmax(logits / T, dim=-1)
-    next_tokens = logits.view(-1, 32000).multinomial(num_samples=1).view(batch_size, seq_len)
+    next_tokens = logits.view(-1, logits.size(-1)).multinomial(num_samples=1).view(batch_size, seq_len)
     return next_tokens
 
+def get_sampling_probs(logits, top_p, T):
+    """Temperature / top-p distribution over the vocabulary, float32 [..., V]."""
+    logits = get_sampling_logits(logits=logits, top_p=top_p, T=T, replicate=True)
+    return softmax(logits.float() / T, dim=-1)
+
+def speculative_sampling(draft_tokens, draft_probs, target_probs, draft_lens=None):
+    """Lossless verification of sampled draft tokens by rejection sampling, for all rows and positions at once.
+
+    draft_tokens: [B, gamma] sampled from draft_probs [B, gamma, V], target_probs: [B, gamma + 1, V].
+    Draft token i is accepted with probability min(1, p / q). Returns the accept flags [B, gamma] (the number
+    accepted is the leading run of True) and a target token [B, gamma + 1] for every position: drawn from the
+    residual max(0, p - q) where the draft token was rejected and from p otherwise, so the token following
+    the accepted prefix keeps the output distribution exactly that of the target.
+    draft_lens [B] optionally limits the number of draft tokens of each row; later positions are not verified.
+    """
+    B, gamma = draft_tokens.size()
+    vocab_size = target_probs.size(-1)
+    p = target_probs[:, :gamma].gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+    q = draft_probs.gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+    accept_flags = torch.rand_like(p) * q <= p
+    drafted = torch.ones_like(accept_flags)
+    if draft_lens is not None:
+        drafted = torch.arange(gamma, device=draft_tokens.device).view(1, -1) < draft_lens.view(-1, 1)
+        accept_flags &= drafted
+    residual = (target_probs[:, :gamma] - draft_probs).clamp(min=0)
+    # p == q leaves no residual, the draft token is then always accepted
+    residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, target_probs[:, :gamma])
+    probs = torch.cat([torch.where((accept_flags | ~drafted).unsqueeze(-1), target_probs[:, :gamma], residual), target_probs[:, gamma:]], dim=1)
+    target_tokens = probs.reshape(-1, vocab_size).multinomial(num_samples=1).view(B, gamma + 1)
+    return accept_flags, target_tokens
+
 def cg_get_sampling_logits(logits :torch.Tensor, top_p:float, T: float):
     logits = logits.clone()
     batch_size, seq_len, voc_size = logits.size()
@@ -157,7 +219,7 @@ def cg_sample(logits, top_p, T):
     batch_size, seq_len, _ = logits.size()
     logits = get_sampling_logits(logits=logits, top_p=top_p, T=T, replicate=True)
     logits = softmax(logits / T, dim=-1)
-    next_tokens = logits.view(-1, 32000).multinomial(num_samples=1).view(batch_size, seq_len)
+    next_tokens = logits.view(-1, logits.size(-1)).multinomial(num_samples=1).view(batch_size, seq_len)
     return next_tokens
 
 def cuda_graph_for_target_sample(
@@ -196,6 +258,9 @@ def cuda_graph_for_sampling_argmax_batch(
                 device="cuda:0", dtype=torch.bfloat16, 
                 dim=32000, n_warmups=3, mempool=None,
                 idx_len = 1, batch_size=1):
+    if "cuda" not in str(device):
+        # no CUDA graphs off-GPU, sample eagerly
+        return sampling_argmax_batch
     
     static_sampling_logits = torch.full((batch_size, idx_len, dim), 1, dtype=dtype, device=device)
     s = torch.cuda.Stream()
@@ -238,6 +303,8 @@ def load_model(checkpoint_path, device, precision, use_tp, rank_group=None, grou
     from MagicDec.Engine.model import Transformer
     with torch.device('meta'):
         model = Transformer.from_name(checkpoint_path.parent.name)
+        # quantized checkpoints (written by quantize.py) swap in the matching linear layers
+        model = convert_for_checkpoint(model, checkpoint_path)
     checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
     if "model" in checkpoint and "stories" in str(checkpoint_path):
         checkpoint = checkpoint["model"]
@@ -256,6 +323,8 @@ def load_model_draft(checkpoint_path, device, precision, use_tp, rank_group=None
     import MagicDec.Engine.model_draft as draft
     with torch.device('meta'):
         model = draft.Transformer.from_name(checkpoint_path.parent.name)
+        # quantized checkpoints (written by quantize.py) swap in the matching linear layers
+        model = convert_for_checkpoint(model, checkpoint_path)
     checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
     if "model" in checkpoint and "stories" in str(checkpoint_path):
         checkpoint = checkpoint["model"]
@@ -273,6 +342,8 @@ def load_model_selfspec(checkpoint_path, device, precision, use_tp, rank_group=N
     import MagicDec.Engine.model_selfspec as selfspec
     with torch.device('meta'):
         model = selfspec.Transformer.from_name(checkpoint_path.parent.name)
+        # quantized checkpoints (written by quantize.py) swap in the matching linear layers
+        model = convert_for_checkpoint(model, checkpoint_path)
     checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
     if "model" in checkpoint and "stories" in str(checkpoint_path):
         checkpoint = checkpoint["model"]
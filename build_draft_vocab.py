@@ -0,0 +1,48 @@
+import sys
+sys.path.append("..")
+from pathlib import Path
+
+import torch
+from transformers import AutoTokenizer
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from MagicDec.Data.data_converter import pg19_token_counts
+from MagicDec.Engine.draft_vocab import top_tokens
+
+
+def build_draft_vocab(
+    model_name: str = "meta-llama/Meta-Llama-3.1-8B",
+    size: int = 32768,
+    output: Path = None,
+    start: int = 50,
+    end: int = None,
+) -> None:
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    vocab_size = len(tokenizer)
+    print(f"Counting the tokens of PG-19 books [{start}, {end or 'end'}) over a vocabulary of {vocab_size}")
+    counts = pg19_token_counts(tokenizer, vocab_size, start=start, end=end)
+    keep = [i for i in tokenizer.all_special_ids if i < vocab_size]
+    vocab = top_tokens(counts, size, keep=keep)
+    coverage = counts[vocab].sum().item() / max(counts.sum().item(), 1)
+    print(f"The {vocab.numel()} kept tokens cover {coverage:.2%} of the corpus")
+
+    output = output or Path(f"checkpoints/{model_name}/draft_vocab.{size}.pt")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    print(f"Writing the draft vocabulary to {output}")
+    torch.save(vocab, output)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Pick the most frequent PG-19 tokens as the pruned vocabulary of a draft LM head.')
+    parser.add_argument('--model_name', type=str, default="meta-llama/Meta-Llama-3.1-8B", help='Tokenizer of the draft and target.')
+    parser.add_argument('--size', type=int, default=32768, help='Tokens kept, the special ones included.')
+    parser.add_argument('--output', type=Path, default=None, help='Output file, checkpoints/{model_name}/draft_vocab.{size}.pt by default.')
+    parser.add_argument('--start', type=int, default=50, help='First PG-19 book counted (the benchmarks prompt from the first 50).')
+    parser.add_argument('--end', type=int, default=None, help='End of the PG-19 books counted.')
+
+    args = parser.parse_args()
+    build_draft_vocab(args.model_name, args.size, args.output, args.start, args.end)
@@ -124,6 +124,13 @@ def convert_hf_checkpoint(
             del final_result[key]
             del final_result[key.replace("wq", "wk")]
             del final_result[key.replace("wq", "wv")]
+        if ".w1." in key:
+            # gate and up projections merged, FeedForward runs them as one GEMM
+            w1 = final_result[key]
+            w3 = final_result[key.replace(".w1.", ".w3.")]
+            final_result[key.replace(".w1.", ".w13.")] = torch.cat([w1, w3])
+            del final_result[key]
+            del final_result[key.replace(".w1.", ".w3.")]
     print(f"Saving checkpoint to {checkpoint_dir / 'model.pth'}")
     torch.save(final_result, checkpoint_dir / "model.pth")
     if 'llama-3' in model_name.lower():
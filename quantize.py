@@ -0,0 +1,61 @@
+import sys
+sys.path.append("..")
+import time
+from pathlib import Path
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from MagicDec.Engine.model import Transformer
+from MagicDec.Engine.quantize import WeightOnlyInt8QuantHandler, WeightOnlyInt4QuantHandler
+
+
+def quantize(
+    checkpoint_path: Path = Path("checkpoints/meta-llama/Llama-2-7b-hf/model.pth"),
+    mode: str = 'int8',
+    groupsize: int = 128,
+    device: str = 'cpu',
+) -> None:
+    assert checkpoint_path.is_file(), checkpoint_path
+    precision = torch.bfloat16
+
+    print("Loading model ...")
+    t0 = time.time()
+    with torch.device('meta'):
+        model = Transformer.from_name(checkpoint_path.parent.name)
+    checkpoint = torch.load(str(checkpoint_path), mmap=True, weights_only=True)
+    # the load hooks merge wq/wk/wv and w1/w3 of older checkpoints, so the quantized one has wqkv and w13
+    model.load_state_dict(checkpoint, assign=True)
+    model = model.to(dtype=precision, device=device)
+
+    if mode == 'int8':
+        print("Quantizing model weights for int8 weight-only symmetric per-channel quantization")
+        quantized_state_dict = WeightOnlyInt8QuantHandler(model).create_quantized_state_dict()
+        new_base_name = checkpoint_path.name.replace('.pth', '_int8.pth')
+    elif mode == 'int4':
+        print(f"Quantizing model weights for int4 weight-only group-wise quantization, groupsize {groupsize}")
+        quantized_state_dict = WeightOnlyInt4QuantHandler(model, groupsize).create_quantized_state_dict()
+        new_base_name = checkpoint_path.name.replace('.pth', f'_int4.g{groupsize}.pth')
+    else:
+        raise ValueError(f"Invalid quantization mode {mode} needs to be one of [int8, int4]")
+
+    quantize_path = checkpoint_path.parent / new_base_name
+    print(f"Writing quantized weights to {quantize_path}")
+    quantize_path.unlink(missing_ok=True)
+    torch.save({k: v.cpu() for k, v in quantized_state_dict.items()}, quantize_path)
+    print(f"Quantization complete took {time.time() - t0:.02f} seconds")
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Quantize the weights of a converted checkpoint (model.pth).')
+    parser.add_argument('--checkpoint_path', type=Path, default=Path("checkpoints/meta-llama/Llama-2-7b-hf/model.pth"), help='Path to the model checkpoint to be quantized.')
+    parser.add_argument('--mode', '-q', type=str, default='int8', choices=['int8', 'int4'], help='Type of quantization to perform.')
+    parser.add_argument('--groupsize', type=int, default=128, help='Group size of int4 quantization.')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to quantize on.')
+
+    args = parser.parse_args()
+    quantize(args.checkpoint_path, args.mode, args.groupsize, args.device)
@@ -4,7 +4,7 @@ import sys
 sys.path.append("..")
 from pathlib import Path
 import torch.distributed as dist
-from MagicDec.Engine.utils import setup_seed, sampling_argmax_batch
+from MagicDec.Engine.utils import setup_seed, device_sync, sampling_argmax_batch
 from MagicDec.Data.data_converter import convert_pg19_dataset
 from transformers import AutoTokenizer
 from torch.utils.data.dataloader import DataLoader
@@ -23,6 +23,10 @@ parser.add_argument('--gen_len', type=int, default=64, help='Generate length')
 parser.add_argument('--seed', type=int, default=123, help='Random seed.')
 
 parser.add_argument('--compile', action='store_true', help='Whether to compile the model.')
+parser.add_argument('--attn_backend', type=str, default=None, help='Attention backend (flash_attn, flash_decoding, flashinfer or sdpa), defaults to flash_attn on CUDA and sdpa otherwise.')
+parser.add_argument('--page_size', type=int, default=None, help='Use a paged target KV cache with this page size (a multiple of 256 for flash_attn).')
+parser.add_argument('--kv_pages', type=int, default=None, help='Number of pages in the paged KV pool, defaults to enough for every sequence at max length.')
+parser.add_argument('--kv_quant', type=str, default=None, choices=['int8', 'fp8'], help='Store the target KV cache at 8 bits with per-token, per-head scales. Compare accuracy and acceptance against a run without it.')
 parser.add_argument('--rank_group', nargs='+', type=int, help='Target group of ranks')
 parser.add_argument('--printoutput', action='store_true', help='Whether to compile the model.')
 
@@ -43,11 +47,12 @@ MAX_LEN = args.prefix_len + args.gen_len
 DTYPE = torch.bfloat16
 BATCH_SIZE = args.B
 checkpoint_path = args.model
-engine = LMBackend(dtype=DTYPE, device=DEVICE)
+engine = LMBackend(dtype=DTYPE, device=DEVICE, attn_backend=args.attn_backend)
 engine.load_model(checkpoint_path, use_tp=use_tp, rank_group = args.rank_group, group=global_group)
 if args.compile:
     engine.compile()
-engine.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN)
+engine.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN, page_size=args.page_size, num_pages=args.kv_pages, kv_quant=args.kv_quant)
+print(f"Target KV cache: {engine.kv_cache_bytes() / 2**30:.2f} GiB ({args.kv_quant or DTYPE})")
 
 tokenizer = AutoTokenizer.from_pretrained(args.model_name)
 tokenizer.pad_token = tokenizer.eos_token
@@ -71,16 +76,18 @@ for step, batch in tqdm(enumerate(dataloader), total=num_eval_steps):
     logits = engine.encode(input_ids=input_ids)[:,-1]
     next_tokens = sampling_argmax_batch(logits=logits)
     output = torch.cat((output, next_tokens),dim=-1)
-    torch.cuda.synchronize()
+    device_sync(DEVICE)
     t1 = time.perf_counter()
     while output.size(1)<args.prefix_len + args.gen_len and terminate == False:
         input_ids=next_tokens.clone()
+        # pages for the token this step writes, from the host-side length (no-op without --page_size)
+        engine.reserve([output.size(1)] * BATCH_SIZE)
         logits = engine.inference(input_ids=input_ids)[:, -1]
         next_tokens = sampling_argmax_batch(logits=logits)
         output = torch.cat((output, next_tokens),dim=-1)
         model_steps += 1
         if (next_tokens[:,-1] == eot_1)._is_any_true() or (next_tokens[:,-1] == eot_2)._is_any_true(): terminate = True
-    torch.cuda.synchronize()
+    device_sync(DEVICE)
     t2=time.perf_counter()
 
     if args.printoutput:
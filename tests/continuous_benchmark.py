@@ -0,0 +1,109 @@
+import time
+import torch
+import sys
+sys.path.append("..")
+from pathlib import Path
+from MagicDec.Engine.utils import setup_seed, device_sync
+from MagicDec.Data.data_converter import convert_pg19_dataset
+from transformers import AutoTokenizer
+import argparse
+from MagicDec.Engine.scheduler import ContinuousBatcher
+from MagicDec.Engine.prefix_cache import PrefixCache
+
+parser = argparse.ArgumentParser(description='Continuous batching with speculative decoding.')
+parser.add_argument('--mode', type=str, default='selfspec', choices=['selfspec', 'standalone'], help='Self-speculation with a StreamingLLM draft cache, or a standalone draft model.')
+parser.add_argument('--model', type=Path, default=Path("checkpoints/meta-llama/Llama-2-7b-hf/model.pth"), help='model (the draft in standalone mode)')
+parser.add_argument('--target', type=Path, default=Path("checkpoints/meta-llama/Llama-2-70b-hf/model.pth"), help='target model (standalone mode)')
+parser.add_argument('--model_name', type=str, default="meta-llama/Llama-2-7b-hf", help='model name')
+parser.add_argument('--streamingllm_budget', type=int, default=256, help='Draft KV budget.')
+parser.add_argument('--compile', action='store_true', help='Whether to compile the model.')
+parser.add_argument('--attn_backend', type=str, default=None, help='Attention backend (flash_attn, flash_decoding, flashinfer or sdpa), defaults to flash_attn on CUDA and sdpa otherwise.')
+parser.add_argument('--page_size', type=int, default=None, help='Use a paged target KV cache with this page size (standalone mode).')
+parser.add_argument('--kv_pages', type=int, default=None, help='Number of pages in the paged KV pool, defaults to enough for every slot at max length. Requests wait in the queue while the pool cannot hold them.')
+parser.add_argument('--draft_vocab', type=str, default=None, help='Prune the draft LM head to the token ids in this file, written by build_draft_vocab.py.')
+
+parser.add_argument('--gamma', type=int, default=5, help='Speculation length')
+parser.add_argument('--prefill_budget', type=int, default=None, help='Tokens per step shared by the verified tokens of decoding slots and the prompt chunks of admitted ones. Prompts are prefilled whole on admission when not given.')
+parser.add_argument('--prefix_cache_blocks', type=int, default=None, help='Cache the KV of up to this many prompt blocks and reuse it for requests sharing a prefix.')
+parser.add_argument('--prefix_block_size', type=int, default=1024, help='Tokens per prefix cache block.')
+parser.add_argument('--num_docs', type=int, default=None, help='Draw the prompts from this many documents only, so requests share prefixes.')
+parser.add_argument('--B', type=int, default=4, help='Batch size (number of slots).')
+parser.add_argument('--num_requests', type=int, default=16, help='Number of requests submitted.')
+parser.add_argument('--prefix_len', type=int, default=4000, help='Maximum prompt length, prompts are cut to between half of it and all of it')
+parser.add_argument('--gen_len', type=int, default=256, help='Maximum generate length, requests ask for between a quarter of it and all of it')
+parser.add_argument('--seed', type=int, default=123, help='Random seed.')
+parser.add_argument('--printoutput', action='store_true', help='Whether to print the outputs.')
+args = parser.parse_args()
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+setup_seed(args.seed)
+print(f"Using device={DEVICE}")
+DTYPE = torch.bfloat16
+BATCH_SIZE = args.B
+MAX_LEN = args.prefix_len + args.gen_len + args.gamma + 1
+
+if args.mode == 'selfspec':
+    from MagicDec.Engine.backend_selfspec import LMBackend
+    engine = LMBackend(dtype=DTYPE, device=DEVICE, dec_list=[args.gamma + 1], draft_dec_list=[1, 2], attn_backend=args.attn_backend)
+    engine.load_model(args.model, use_tp=False, rank_group=[0], draft_vocab=args.draft_vocab)
+    if args.compile:
+        engine.compile()
+    engine.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN, streamingllm_budget=args.streamingllm_budget, buffer=max(32, args.gamma + 1))
+    draft = None
+else:
+    from MagicDec.Engine.backend import LMBackend
+    from MagicDec.Engine.backend_draft import LMBackend_Draft
+    engine = LMBackend(dtype=DTYPE, device=DEVICE, dec_list=[args.gamma + 1], attn_backend=args.attn_backend)
+    engine.load_model(args.target, use_tp=False, rank_group=[0])
+    draft = LMBackend_Draft(dtype=DTYPE, device=DEVICE, dec_list=[1, 2], attn_backend=args.attn_backend)
+    draft.load_model(args.model, use_tp=False, rank_group=[0], draft_vocab=args.draft_vocab)
+    if args.compile:
+        engine.compile()
+        draft.compile()
+    engine.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN, page_size=args.page_size, num_pages=args.kv_pages)
+    draft.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN, kv_len=args.streamingllm_budget, buffer=max(32, args.gamma + 1))
+
+tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+eos_token_ids = [tokenizer.eos_token_id]
+if tokenizer.unk_token_id is not None:
+    eos_token_ids.append(tokenizer.unk_token_id)
+else:
+    eos_token_ids.append(tokenizer.encode("<|eot_id|>")[-1])
+dataset = convert_pg19_dataset(tokenizer=tokenizer, seq_len=args.prefix_len)
+
+prefix_cache = None
+if args.prefix_cache_blocks is not None:
+    prefix_cache = PrefixCache(engine, draft=draft, block_size=args.prefix_block_size, num_blocks=args.prefix_cache_blocks)
+batcher = ContinuousBatcher(engine, draft=draft, gamma=args.gamma, eos_token_ids=eos_token_ids, prefill_budget=args.prefill_budget, prefix_cache=prefix_cache)
+num_docs = min(args.num_docs or len(dataset), len(dataset))
+for i in range(args.num_requests):
+    prompt_len = torch.randint(args.prefix_len // 2, args.prefix_len + 1, (1,)).item()
+    max_new_tokens = torch.randint(max(args.gen_len // 4, 1), args.gen_len + 1, (1,)).item()
+    batcher.submit(dataset[i % num_docs][0][:prompt_len], max_new_tokens)
+
+# time of every step that decoded, the gap between tokens of the running requests
+step_times = []
+device_sync(DEVICE)
+t1 = time.perf_counter()
+while len(batcher.queue) > 0 or any(request is not None for request in batcher.slots):
+    rounds = batcher.rounds
+    t_step = time.perf_counter()
+    batcher.step()
+    device_sync(DEVICE)
+    if batcher.rounds > rounds:
+        step_times.append(time.perf_counter() - t_step)
+t2 = time.perf_counter()
+requests = sorted(batcher.finished, key=lambda request: request.request_id)
+
+num_gen_tokens = sum(len(request.output) for request in requests)
+print(f"Requests: {len(requests)}, generated tokens: {num_gen_tokens}, rounds: {batcher.rounds}")
+print(f"Mean generated tokens per slot and round: {num_gen_tokens / max(batcher.busy_slot_rounds, 1):.2f}")
+print(f"Slot occupancy: {batcher.occupancy:.2%}")
+step_times = torch.tensor(step_times)
+print(f"Time between decode steps: mean {step_times.mean() * 1000:.2f}ms, p99 {step_times.quantile(0.99) * 1000:.2f}ms, max {step_times.max() * 1000:.2f}ms")
+if prefix_cache is not None:
+    print(f"Prefix cache: {prefix_cache.hit_tokens} of {prefix_cache.query_tokens} prompt tokens reused ({prefix_cache.hit_rate:.2%})")
+print(f"Throughput: {num_gen_tokens / (t2 - t1):.2f} tokens/s, total time: {t2 - t1:.2f}s")
+if args.printoutput:
+    for request in requests:
+        print(request.request_id, tokenizer.decode(request.output))
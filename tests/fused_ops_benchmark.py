@@ -0,0 +1,65 @@
+import time
+import torch
+import sys
+sys.path.append("..")
+import argparse
+from MagicDec.Engine.utils import setup_seed, device_sync
+from MagicDec.Engine.fused_ops import rms_norm_ref, rotary_emb_ref, silu_mul_ref
+
+parser = argparse.ArgumentParser(description='Microbenchmark of the fused residual + RMSNorm, rotary embedding and SwiGLU ops.')
+parser.add_argument('--B', type=int, default=8, help='Batch size.')
+parser.add_argument('--dec_len', type=int, default=4, help='Number of tokens (gamma + 1)')
+parser.add_argument('--dim', type=int, default=4096, help='Model dimension')
+parser.add_argument('--intermediate_size', type=int, default=11008, help='FeedForward hidden size')
+parser.add_argument('--n_head', type=int, default=32, help='Number of query heads')
+parser.add_argument('--head_dim', type=int, default=128, help='Head dimension')
+parser.add_argument('--n_warmups', type=int, default=5, help='Warmup iterations')
+parser.add_argument('--n_iters', type=int, default=100, help='Timed iterations')
+parser.add_argument('--seed', type=int, default=123, help='Random seed.')
+args = parser.parse_args()
+
+setup_seed(args.seed)
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+DTYPE = torch.bfloat16 if DEVICE == 'cuda' else torch.float32
+B, T = args.B, args.dec_len
+
+x = torch.randn(B, T, args.dim, device=DEVICE, dtype=DTYPE)
+residual = torch.randn(B, T, args.dim, device=DEVICE, dtype=DTYPE)
+weight = torch.randn(args.dim, device=DEVICE, dtype=DTYPE)
+q = torch.randn(B, T, args.n_head, args.head_dim, device=DEVICE, dtype=DTYPE)
+angles = torch.rand(B, T, args.head_dim // 2, device=DEVICE) * 6.28
+freqs_cis = torch.stack([angles.cos(), angles.sin()], dim=-1).to(DTYPE)
+
+def timed(fn):
+    for _ in range(args.n_warmups):
+        fn()
+    device_sync(DEVICE)
+    t1 = time.perf_counter()
+    for _ in range(args.n_iters):
+        fn()
+    device_sync(DEVICE)
+    return (time.perf_counter() - t1) / args.n_iters * 1000
+
+print(f"Using device={DEVICE}, B={B}, dec_len={T}, dim={args.dim}, heads={args.n_head}")
+ref_h = x + residual
+ref_norm = rms_norm_ref(ref_h, weight, 1e-5)
+norm, h = torch.ops.mylib.add_rms_norm(x, residual, weight, 1e-5)
+err = max((norm.float() - ref_norm.float()).abs().max().item(), (h.float() - ref_h.float()).abs().max().item())
+t_ref = timed(lambda: rms_norm_ref(x + residual, weight, 1e-5))
+t_fused = timed(lambda: torch.ops.mylib.add_rms_norm(x, residual, weight, 1e-5))
+print("{:<24} reference: {:.3f}ms, fused: {:.3f}ms, max abs err: {:.5f}".format("residual + RMSNorm", t_ref, t_fused, err))
+
+ref_q = rotary_emb_ref(q, freqs_cis)
+q_fused = q.clone()
+torch.ops.mylib.rope_(q_fused, freqs_cis)
+err = (q_fused.float() - ref_q.float()).abs().max().item()
+t_ref = timed(lambda: rotary_emb_ref(q, freqs_cis))
+t_fused = timed(lambda: torch.ops.mylib.rope_(q_fused, freqs_cis))
+print("{:<24} reference: {:.3f}ms, fused: {:.3f}ms, max abs err: {:.5f}".format("rotary embedding", t_ref, t_fused, err))
+
+gate_up = torch.randn(B, T, 2 * args.intermediate_size, device=DEVICE, dtype=DTYPE)
+ref_act = silu_mul_ref(gate_up)
+err = (torch.ops.mylib.silu_mul(gate_up).float() - ref_act.float()).abs().max().item()
+t_ref = timed(lambda: silu_mul_ref(gate_up))
+t_fused = timed(lambda: torch.ops.mylib.silu_mul(gate_up))
+print("{:<24} reference: {:.3f}ms, fused: {:.3f}ms, max abs err: {:.5f}".format("SiLU-mul", t_ref, t_fused, err))
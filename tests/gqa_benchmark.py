@@ -0,0 +1,74 @@
+import time
+import torch
+import sys
+sys.path.append("..")
+import argparse
+from MagicDec.Engine.utils import setup_seed, device_sync
+from MagicDec.Engine.attn_backends import sdpa_with_kvcache
+from MagicDec.Engine.kv_cache import KV_QUANT_DTYPES, quantize_kv
+
+parser = argparse.ArgumentParser(description='Microbenchmark of decode attention ops.')
+parser.add_argument('--B', type=int, default=8, help='Batch size.')
+parser.add_argument('--prefix_len', type=int, default=16000, help='Number of tokens already in the cache')
+parser.add_argument('--dec_len', type=int, default=4, help='Number of new tokens (gamma + 1)')
+parser.add_argument('--n_head', type=int, default=32, help='Number of query heads')
+parser.add_argument('--n_local_heads', type=int, default=8, help='Number of KV heads')
+parser.add_argument('--head_dim', type=int, default=128, help='Head dimension')
+parser.add_argument('--n_warmups', type=int, default=5, help='Warmup iterations')
+parser.add_argument('--n_iters', type=int, default=50, help='Timed iterations')
+parser.add_argument('--kv_quant', type=str, default=None, choices=['int8', 'fp8'], help='Also benchmark attention over a quantized cache')
+parser.add_argument('--seed', type=int, default=123, help='Random seed.')
+args = parser.parse_args()
+
+setup_seed(args.seed)
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+DTYPE = torch.bfloat16 if DEVICE == 'cuda' else torch.float32
+B, T = args.B, args.dec_len
+max_len = args.prefix_len + T
+
+q = torch.randn(B, T, args.n_head, args.head_dim, device=DEVICE, dtype=DTYPE)
+k = torch.randn(B, T, args.n_local_heads, args.head_dim, device=DEVICE, dtype=DTYPE)
+v = torch.randn(B, T, args.n_local_heads, args.head_dim, device=DEVICE, dtype=DTYPE)
+k_cache = torch.randn(B, max_len, args.n_local_heads, args.head_dim, device=DEVICE, dtype=DTYPE)
+v_cache = torch.randn(B, max_len, args.n_local_heads, args.head_dim, device=DEVICE, dtype=DTYPE)
+cache_seqlens = torch.full((B,), args.prefix_len, dtype=torch.int32, device=DEVICE)
+
+ops = {"sdpa reference": sdpa_with_kvcache, "mylib::gqa_decode": torch.ops.mylib.gqa_decode, "mylib::split_kv_decode": torch.ops.mylib.split_kv_decode}
+if DEVICE == 'cuda':
+    ops["mylib::gqa_custom"] = torch.ops.mylib.gqa_custom
+    ops["mylib::custom_func"] = torch.ops.mylib.custom_func
+
+ref = sdpa_with_kvcache(q, k_cache.clone(), v_cache.clone(), k, v, cache_seqlens).float()
+print(f"Using device={DEVICE}, B={B}, prefix_len={args.prefix_len}, dec_len={T}, heads={args.n_head}/{args.n_local_heads}")
+for name, op in ops.items():
+    k_c, v_c = k_cache.clone(), v_cache.clone()
+    y = op(q, k_c, v_c, k, v, cache_seqlens)
+    max_err = (y.float() - ref).abs().max().item()
+    for _ in range(args.n_warmups):
+        op(q, k_c, v_c, k, v, cache_seqlens)
+    device_sync(DEVICE)
+    t1 = time.perf_counter()
+    for _ in range(args.n_iters):
+        op(q, k_c, v_c, k, v, cache_seqlens)
+    device_sync(DEVICE)
+    t2 = time.perf_counter()
+    print("{:<24} time per call :{:.3f}ms, max abs err vs reference: {:.5f}".format(name, (t2 - t1) / args.n_iters * 1000, max_err))
+
+if args.kv_quant is not None:
+    # same cache stored at 8 bits: error is measured against the full precision reference
+    k_q, k_scale = quantize_kv(k_cache, KV_QUANT_DTYPES[args.kv_quant])
+    v_q, v_scale = quantize_kv(v_cache, KV_QUANT_DTYPES[args.kv_quant])
+    print(f"KV cache bytes per token and head: {k_cache.element_size() * args.head_dim} -> {k_q.element_size() * args.head_dim + k_scale.element_size()}")
+    for name, op in {"mylib::sdpa_quant_func": torch.ops.mylib.sdpa_quant_func, "mylib::quant_decode": torch.ops.mylib.quant_decode}.items():
+        k_c, v_c, k_s, v_s = k_q.clone(), v_q.clone(), k_scale.clone(), v_scale.clone()
+        y = op(q, k_c, v_c, k_s, v_s, k, v, cache_seqlens)
+        max_err = (y.float() - ref).abs().max().item()
+        for _ in range(args.n_warmups):
+            op(q, k_c, v_c, k_s, v_s, k, v, cache_seqlens)
+        device_sync(DEVICE)
+        t1 = time.perf_counter()
+        for _ in range(args.n_iters):
+            op(q, k_c, v_c, k_s, v_s, k, v, cache_seqlens)
+        device_sync(DEVICE)
+        t2 = time.perf_counter()
+        print("{:<24} time per call :{:.3f}ms, max abs err vs reference: {:.5f}".format(f"{name} ({args.kv_quant})", (t2 - t1) / args.n_iters * 1000, max_err))
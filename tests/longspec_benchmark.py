@@ -1,33 +1,54 @@
+import os
 import time
 import torch
 import sys
 sys.path.append("..")
 from pathlib import Path
 import torch.distributed as dist
-from MagicDec.Engine.utils import setup_seed, cuda_graph_for_sampling_argmax_batch, sampling_argmax_batch
+from MagicDec.Engine.utils import setup_seed, device_sync, cuda_graph_for_sampling_argmax_batch, sampling_argmax_batch, sample, get_sampling_probs, speculative_sampling
 from MagicDec.Data.data_converter import convert_pg19_dataset
 from transformers import AutoTokenizer
 from torch.utils.data.dataloader import DataLoader
 from tqdm import tqdm
 import argparse
+from MagicDec.Engine.adaptive_gamma import GammaController, DraftStopper, SpecModeTracker
+from MagicDec.Engine.tree import SpecTree, top_siblings, verify_tree_greedy
+from MagicDec.Engine.kv_snapshot import KVSnapshotStore
 from MagicDec.Engine.backend import LMBackend
 from MagicDec.Engine.backend_draft import LMBackend_Draft
+from MagicDec.Engine.draft_vocab import to_full_vocab, full_vocab_probs
 
 parser = argparse.ArgumentParser(description='Process model configuration and partitions.')
 parser.add_argument('--model', type=Path, default=Path("checkpoints/meta-llama/Llama-2-7b-hf/model.pth"), help='model')
 parser.add_argument('--model_name', type=str, default="meta-llama/Llama-2-7b-hf", help='model name')
 parser.add_argument('--draft_ranks', nargs='+', type=int, help='Target group of ranks')
 parser.add_argument('--streamingllm_budget', type=int, default=256, help='Dataset end index.')
+parser.add_argument('--draft_vocab', type=str, default=None, help='Prune the draft LM head to the token ids in this file, written by build_draft_vocab.py. Verification keeps the full head.')
 
 parser.add_argument('--target', type=Path, default=Path("checkpoints/meta-llama/Llama-2-70b-hf/model.pth"), help='target model')
 parser.add_argument('--rank_group', nargs='+', type=int, help='Target group of ranks')
 parser.add_argument('--compile', action='store_true', help='Whether to compile the model.')
+parser.add_argument('--attn_backend', type=str, default=None, help='Attention backend (flash_attn, flash_decoding, flashinfer or sdpa), defaults to flash_attn on CUDA and sdpa otherwise.')
+parser.add_argument('--page_size', type=int, default=None, help='Use a paged target KV cache with this page size (a multiple of 256 for flash_attn).')
+parser.add_argument('--kv_pages', type=int, default=None, help='Number of pages in the paged KV pool, defaults to enough for every sequence at max length.')
+parser.add_argument('--kv_quant', type=str, default=None, choices=['int8', 'fp8'], help='Store the target KV cache at 8 bits with per-token, per-head scales. Compare accuracy and acceptance against a run without it.')
 
 parser.add_argument('--gamma', type=int, default=5, help='start')
+parser.add_argument('--adaptive_gamma', nargs='+', type=int, default=None, help='Speculation lengths to choose from every round (the target is compiled for each), picked from the observed acceptance rate and draft/target step times. --gamma is used when not given.')
+parser.add_argument('--draft_threshold', type=float, default=None, help='Stop drafting a row within a round once the probability of its drafted token falls below this value.')
+parser.add_argument('--draft_min_accept', type=float, default=None, help='Stop drafting a row once the product of its draft token probabilities in the round falls below this value.')
+parser.add_argument('--spec_min_accept', type=float, default=None, help='Rows whose recent mean of accepted draft tokens per round is below this value decode without speculation (re-probed every --spec_probe_every rounds).')
+parser.add_argument('--spec_probe_every', type=int, default=16, help='Rounds between re-enabling speculation for every row.')
+parser.add_argument('--temperature', type=float, default=0.0, help='Sampling temperature, 0 for greedy decoding. Above 0 draft tokens are sampled and verified by lossless rejection sampling.')
+parser.add_argument('--top_p', type=float, default=1.0, help='Top-p of the sampling distribution (with --temperature > 0).')
+parser.add_argument('--tree_width', type=int, default=1, help='Draft tokens kept per depth. Above 1 the target verifies a token tree: the greedy draft chain plus the next tree_width - 1 draft tokens at every depth.')
+parser.add_argument('--offload_layers', type=int, default=0, help='Keep the target KV of the last N layers in pinned host memory, prefetched a layer ahead during each forward.')
 
 parser.add_argument('--B', type=int, default=1, help='Batch size.')
 parser.add_argument('--prefix_len', type=int, default=4000, help='Prefix length')
 parser.add_argument('--gen_len', type=int, default=64, help='Generate length')
+parser.add_argument('--min_prefix_len', type=int, default=None, help='Give every row a random prompt length between this and prefix_len, prefilled without padding.')
+parser.add_argument('--kv_snapshot_dir', type=str, default=None, help='Snapshot the KV of every prompt to this directory and restore the longest stored prefix of later prompts instead of prefilling it.')
 
 parser.add_argument('--seed', type=int, default=123, help='Random seed.')
 
@@ -56,50 +77,84 @@ if use_tp:
 
 setup_seed(args.seed)
 print(f"Using device={DEVICE}")
-MAX_LEN_TARGET = args.prefix_len + args.gen_len + args.gamma
-MAX_LEN_DRAFT = args.streamingllm_budget + args.gen_len + args.gamma
+# speculation lengths the target is compiled for, chosen from every round by the controller
+GAMMAS = sorted(set(args.adaptive_gamma)) if args.adaptive_gamma else [args.gamma]
+MAX_GAMMA = max(GAMMAS)
+# rounds where no row speculates verify a single token
+VERIFY_GAMMAS = ([0] if args.spec_min_accept is not None else []) + GAMMAS
+# the verified tree holds the root and tree_width tokens at each of the gamma depths
+TREE_SIZE = 1 + args.gamma * args.tree_width
+MAX_LEN_TARGET = args.prefix_len + args.gen_len + max(TREE_SIZE - 1, MAX_GAMMA)
+# the draft keeps streamingllm_budget tokens in a ring buffer, MAX_LEN_DRAFT only bounds its positions
+MAX_LEN_DRAFT = args.prefix_len + args.gen_len + MAX_GAMMA + 1
 DTYPE = torch.bfloat16
 BATCH_SIZE = args.B
 benchmark = args.benchmark
 checkpoint_path = args.target
 draft_checkpoint_path = args.model
 
-target_dec_list = [args.gamma + 1]
+target_dec_list = [gamma + 1 for gamma in VERIFY_GAMMAS]
 
 # Load target model
-engine = LMBackend(dtype=DTYPE, device=DEVICE, dec_list=target_dec_list)
+engine = LMBackend(dtype=DTYPE, device=DEVICE, dec_list=target_dec_list, attn_backend=args.attn_backend)
 engine.load_model(checkpoint_path, use_tp=use_tp, rank_group = args.rank_group, group=global_group)
 
-assert args.prefix_len + args.gen_len + args.gamma + 1 <= engine.model.config.block_size, f"Model block_size is {engine.model.config.block_size}, but max_gen+gamma+1 is {args.prefix_len + args.gen_len + args.gamma + 1}"
+assert args.prefix_len + args.gen_len + MAX_GAMMA + 1 <= engine.model.config.block_size, f"Model block_size is {engine.model.config.block_size}, but max_gen+gamma+1 is {args.prefix_len + args.gen_len + MAX_GAMMA + 1}"
 vocab_size = engine.model.config.vocab_size
 
 if args.compile:
     engine.compile()
-engine.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN_TARGET)
-target_sample = cuda_graph_for_sampling_argmax_batch(device=DEVICE, dtype=DTYPE, batch_size=BATCH_SIZE, idx_len=args.gamma+1, dim=vocab_size)
+engine.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN_TARGET, page_size=args.page_size, num_pages=args.kv_pages, kv_quant=args.kv_quant, offload_layers=args.offload_layers)
+print(f"Target KV cache: {engine.kv_cache_bytes() / 2**30:.2f} GiB ({args.kv_quant or DTYPE})")
+target_sample = {}
+for i in set(target_dec_list + [TREE_SIZE]):
+    target_sample[i] = cuda_graph_for_sampling_argmax_batch(device=DEVICE, dtype=DTYPE, batch_size=BATCH_SIZE, idx_len=i, dim=vocab_size)
+tree = SpecTree(args.gamma, args.tree_width, DEVICE) if args.tree_width > 1 else None
+assert tree is None or args.offload_layers == 0, "Tree speculation needs the resident KV cache"
+if engine.model.kv_offload is not None:
+    assert not args.compile, "Offloaded KV caches run eagerly"
+    print(f"Offloaded target KV: {engine.model.kv_offload.host_bytes() / 2**30:.2f} GiB in host memory")
+assert tree is None or args.temperature == 0, "Tree speculation is only verified greedily"
+assert tree is None or args.adaptive_gamma is None, "Tree speculation uses a fixed gamma"
+controller = GammaController(GAMMAS) if len(GAMMAS) > 1 else None
+stopper = None
+tracker = None
+if args.draft_threshold is not None or args.draft_min_accept is not None or args.spec_min_accept is not None:
+    assert tree is None, "Per-row draft lengths are not supported with tree speculation"
+    stopper = DraftStopper(BATCH_SIZE, DEVICE, threshold=args.draft_threshold or 0.0, min_accept=args.draft_min_accept or 0.0)
+if args.spec_min_accept is not None:
+    tracker = SpecModeTracker(BATCH_SIZE, DEVICE, min_accept=args.spec_min_accept, probe_every=args.spec_probe_every)
 
 # Load draft model
 if not use_tp:
-    draft = LMBackend_Draft(dtype=DTYPE, device=DEVICE, dec_list=[1,2])
-    draft.load_model(draft_checkpoint_path, use_tp=False, rank_group=args.rank_group, group=global_group)
+    draft = LMBackend_Draft(dtype=DTYPE, device=DEVICE, dec_list=[1,2], attn_backend=args.attn_backend)
+    draft.load_model(draft_checkpoint_path, use_tp=False, rank_group=args.rank_group, group=global_group, draft_vocab=args.draft_vocab)
     if args.compile:
         draft.compile()
-    draft.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN_DRAFT, kv_len=args.streamingllm_budget)
+    draft.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN_DRAFT, kv_len=args.streamingllm_budget, buffer=max(32, MAX_GAMMA + 1))
+    draft_vocab = draft.model.draft_vocab
     draft_sample = {}
-    for i in [1, 2]:
-        draft_sample[i] = cuda_graph_for_sampling_argmax_batch(device=DEVICE, dtype=DTYPE, batch_size=BATCH_SIZE, idx_len=i, dim=vocab_size)
+    for i in [1]:
+        draft_sample[i] = cuda_graph_for_sampling_argmax_batch(device=DEVICE, dtype=DTYPE, batch_size=BATCH_SIZE, idx_len=i, dim=vocab_size if draft_vocab is None else draft_vocab.numel())
 else:
     if rank in args.draft_ranks:
-        draft = LMBackend_Draft(dtype=DTYPE, device=DEVICE, dec_list=[1,2])
-        draft.load_model(draft_checkpoint_path, use_tp=draft_tp, rank_group=args.draft_ranks, group=draft_group)
+        draft = LMBackend_Draft(dtype=DTYPE, device=DEVICE, dec_list=[1,2], attn_backend=args.attn_backend)
+        draft.load_model(draft_checkpoint_path, use_tp=draft_tp, rank_group=args.draft_ranks, group=draft_group, draft_vocab=args.draft_vocab)
         if args.compile:
             draft.compile()
-        draft.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN_DRAFT, kv_len=args.streamingllm_budget)
+        draft.setup_caches(max_batch_size=BATCH_SIZE, max_seq_length=MAX_LEN_DRAFT, kv_len=args.streamingllm_budget, buffer=max(32, MAX_GAMMA + 1))
+        draft_vocab = draft.model.draft_vocab
         draft_sample = {}
-        for i in [1, 2]:
-            draft_sample[i] = cuda_graph_for_sampling_argmax_batch(device=DEVICE, dtype=DTYPE, batch_size=BATCH_SIZE, idx_len=i, dim=vocab_size)
+        for i in [1]:
+            draft_sample[i] = cuda_graph_for_sampling_argmax_batch(device=DEVICE, dtype=DTYPE, batch_size=BATCH_SIZE, idx_len=i, dim=vocab_size if draft_vocab is None else draft_vocab.numel())
     dist.barrier()
 
+# the snapshots of each rank hold its own shard of the KV
+snapshots = None
+if args.kv_snapshot_dir is not None:
+    snapshot_draft = draft if not use_tp or rank in args.draft_ranks else None
+    snapshots = KVSnapshotStore(os.path.join(args.kv_snapshot_dir, f"rank{rank}" if use_tp else ""), engine, draft=snapshot_draft)
+
 # Load dataset
 tokenizer = AutoTokenizer.from_pretrained(args.model_name)
 tokenizer.pad_token = tokenizer.eos_token
@@ -128,146 +183,229 @@ for step, batch in tqdm(enumerate(dataloader), total=num_eval_steps):
         break
     input_ids = batch[0].to(DEVICE)
     terminal = False
-    tokens_buffer= torch.zeros((BATCH_SIZE, args.gamma+1), device=DEVICE).long()
-    output = torch.zeros(BATCH_SIZE, args.prefix_len + args.gen_len + args.gamma + 1, device=DEVICE).long()
+    tokens_buffer= torch.zeros((BATCH_SIZE, MAX_GAMMA+1), device=DEVICE).long()
+    sibling_buffer = torch.zeros((BATCH_SIZE, args.gamma, args.tree_width - 1), device=DEVICE).long()
+    draft_probs = torch.zeros((BATCH_SIZE, MAX_GAMMA, vocab_size), device=DEVICE) if args.temperature > 0 else None
+    output = torch.zeros(BATCH_SIZE, args.prefix_len + args.gen_len + MAX_GAMMA + 1, device=DEVICE).long()
     output[:, :input_ids.shape[1]] = input_ids
-    num_nodes = torch.zeros(BATCH_SIZE,device=DEVICE).long()
-    num_nodes += input_ids.shape[1]
-
-    logits = engine.encode(input_ids=input_ids)[:,-1]
+    # per-row prompt lengths, the tokens after them are ignored
+    seqlens = None if args.min_prefix_len is None else torch.randint(args.min_prefix_len, input_ids.shape[1] + 1, (BATCH_SIZE,), device=DEVICE)
+    prompt_lens = torch.full((BATCH_SIZE,), input_ids.shape[1], device=DEVICE).long() if seqlens is None else seqlens
+    num_nodes = prompt_lens.clone()
 
-    if not use_tp:
-        draft.encode(input_ids=input_ids)
+    if snapshots is not None:
+        logits = snapshots.encode(input_ids=input_ids, seqlens=seqlens)[:,-1]
     else:
-        if rank in args.draft_ranks:
-            draft.encode(input_ids=input_ids)
-        dist.barrier()
+        logits = engine.encode(input_ids=input_ids, seqlens=seqlens)[:,-1]
+
+        if not use_tp:
+            draft.encode(input_ids=input_ids, seqlens=seqlens)
+        else:
+            if rank in args.draft_ranks:
+                draft.encode(input_ids=input_ids, seqlens=seqlens)
+            dist.barrier()
     
-    tokens_buffer[:,:1] = sampling_argmax_batch(logits=logits)
+    if args.temperature > 0:
+        tokens_buffer[:,:1] = sample(logits, args.top_p, args.temperature)
+    else:
+        tokens_buffer[:,:1] = sampling_argmax_batch(logits=logits)
     
     next_double = False
     double_buffer = None
+    if tracker is not None:
+        tracker.reset()
     cachelens_update = None
 
-    torch.cuda.synchronize()
+    device_sync(DEVICE)
     start = time.perf_counter()
     while terminal == False:
-
-        if benchmark:
-            torch.cuda.synchronize()
+        gamma = args.gamma
+        if controller is not None:
+            gamma = controller.choose()
+            if use_tp:
+                # every rank must verify the same number of tokens
+                gamma_tensor = torch.tensor([gamma], device=DEVICE)
+                dist.broadcast(gamma_tensor, src=args.rank_group[0], group=global_group)
+                gamma = gamma_tensor.item()
+        if engine.block_manager is not None:
+            # pages for the round's verified tokens, sized once per round
+            engine.reserve((engine.cachelens + gamma + 1).tolist())
+
+        if benchmark or controller is not None:
+            device_sync(DEVICE)
             t1 = time.time()
 
         # Draft speculation
+        if stopper is not None:
+            stopper.reset(gamma, tracker.disabled() if tracker is not None else None)
         if not use_tp:
-            for i in range(args.gamma):
-                if i == 0:
-                    if next_double:
+            for i in range(gamma):
+                if i == 0 and next_double:
+                    # The cachelens should increase 1 or 2
+                    draft_logits = draft.inference(double_buffer, cachelen_update=cachelens_update)
+                    draft_logits = draft_logits[torch.arange(BATCH_SIZE, device=DEVICE), cachelens_update - 1]
+                    next_double = False
+                else:
+                    draft_logits = draft.inference(tokens_buffer[:, i].view(-1,1))[:, -1]
+                if args.temperature > 0:
+                    draft_probs[:, i] = full_vocab_probs(get_sampling_probs(draft_logits, args.top_p, args.temperature), draft_vocab, vocab_size)
+                    tokens_buffer[:,i+1] = draft_probs[:, i].multinomial(num_samples=1).flatten()
+                else:
+                    tokens_buffer[:,i+1:i+2] = to_full_vocab(draft_sample[1](draft_logits.unsqueeze(1)), draft_vocab)
+                if tree is not None:
+                    sibling_buffer[:, i] = to_full_vocab(top_siblings(draft_logits, args.tree_width), draft_vocab)
+                if stopper is not None and stopper.step(i, draft_probs[:, i] if args.temperature > 0 else full_vocab_probs(torch.softmax(draft_logits.float(), dim=-1), draft_vocab, vocab_size), tokens_buffer[:, i+1]):
+                    break
+        else:
+            if rank in args.draft_ranks:
+                for i in range(gamma):
+                    if i == 0 and next_double:
                         # The cachelens should increase 1 or 2
-                        next_tokens = draft_sample[2](draft.inference(double_buffer, cachelen_update=cachelens_update))
-                        tokens_buffer[:,i+1:i+2] = next_tokens.gather(1, cachelens_update.view(-1,1) - 1)
+                        draft_logits = draft.inference(double_buffer, cachelen_update=cachelens_update)
+                        draft_logits = draft_logits[torch.arange(BATCH_SIZE, device=DEVICE), cachelens_update - 1]
                         next_double = False
                     else:
-                        tokens_buffer[:,i+1:i+2] = draft_sample[1](draft.inference(tokens_buffer[:, i].view(-1,1)))
-                    continue
-                tokens_buffer[:,i+1:i+2] = draft_sample[1](draft.inference(tokens_buffer[:, i].view(-1,1)))
-        else:
-            if rank in args.draft_ranks:
-                for i in range(args.gamma):
-                    if i == 0:
-                        if next_double:
-                            next_tokens = draft_sample[2](draft.inference(double_buffer,cachelen_update=cachelens_update))
-                            tokens_buffer[:,i+1:i+2] = next_tokens.gather(1, cachelens_update.view(-1,1) - 1)
-                            next_double = False
-                        else:
-                            tokens_buffer[:,i+1:i+2] = draft_sample[1](draft.inference(tokens_buffer[:, i].view(-1,1)))
-                        continue
-                    tokens_buffer[:,i+1:i+2] = draft_sample[1](draft.inference(tokens_buffer[:, i].view(-1,1)))
+                        draft_logits = draft.inference(tokens_buffer[:, i].view(-1,1))[:, -1]
+                    if args.temperature > 0:
+                        draft_probs[:, i] = full_vocab_probs(get_sampling_probs(draft_logits, args.top_p, args.temperature), draft_vocab, vocab_size)
+                        tokens_buffer[:,i+1] = draft_probs[:, i].multinomial(num_samples=1).flatten()
+                    else:
+                        tokens_buffer[:,i+1:i+2] = to_full_vocab(draft_sample[1](draft_logits.unsqueeze(1)), draft_vocab)
+                    if tree is not None:
+                        sibling_buffer[:, i] = to_full_vocab(top_siblings(draft_logits, args.tree_width), draft_vocab)
+                    if stopper is not None and stopper.step(i, draft_probs[:, i] if args.temperature > 0 else full_vocab_probs(torch.softmax(draft_logits.float(), dim=-1), draft_vocab, vocab_size), tokens_buffer[:, i+1]):
+                        break
             dist.broadcast(tokens_buffer, src=args.draft_ranks[0], group=global_group)
+            if tree is not None:
+                dist.broadcast(sibling_buffer, src=args.draft_ranks[0], group=global_group)
+            if stopper is not None:
+                dist.broadcast(stopper.draft_lens, src=args.draft_ranks[0], group=global_group)
 
+        # rows that stopped early verify only their draft_lens tokens, the draft ran draft_steps steps
+        draft_lens = stopper.draft_lens if stopper is not None else None
+        # the draft always runs its first step, which also feeds it the last accepted token
+        draft_steps = max(draft_lens.max().item(), 1) if stopper is not None else gamma
+        # verify with the shortest compiled length covering the drafted tokens
+        verify_gamma = min(g for g in VERIFY_GAMMAS if g >= (draft_lens.max().item() if stopper is not None else gamma))
 
-        if benchmark:
-            torch.cuda.synchronize()
+
+        if benchmark or controller is not None:
+            device_sync(DEVICE)
             t2 = time.time()
+        if benchmark:
             draft_time+=t2-t1
 
         # Target Verification
-        target_logits = engine.inference(tokens_buffer)
+        if tree is None:
+            target_logits = engine.inference(tokens_buffer[:, :verify_gamma+1])
+        else:
+            tree_tokens = tree.build(tokens_buffer, sibling_buffer)
+            target_logits = engine.tree_inference(tree_tokens, tree)
 
-        if benchmark:
-            torch.cuda.synchronize()
+        if benchmark or controller is not None:
+            device_sync(DEVICE)
             t3 = time.time()
+        if benchmark:
             target_time+=t3-t2
             
         # target_tokens = sample(target_logits, args.top_p, args.temperature)
-        target_tokens = target_sample(target_logits)
+        if args.temperature > 0:
+            target_probs = get_sampling_probs(target_logits, args.top_p, args.temperature)
+            accept_matrix, target_tokens = speculative_sampling(tokens_buffer[:, 1:verify_gamma+1], draft_probs[:, :verify_gamma], target_probs, draft_lens)
+        else:
+            target_tokens = target_sample[target_logits.size(1)](target_logits)
+            accept_matrix = target_tokens[:, :verify_gamma] == tokens_buffer[:, 1:verify_gamma+1]
+            if draft_lens is not None:
+                accept_matrix &= torch.arange(verify_gamma, device=DEVICE).view(1, -1) < draft_lens.view(-1, 1)
         target_steps+=1
 
 
     # Verify loop
-        bonus_tokens = torch.full((BATCH_SIZE, 1), 0, device=DEVICE).long()
-        accept_nums = torch.full((BATCH_SIZE, 1), 1, device=DEVICE).long()
-        accept_flags = torch.full((BATCH_SIZE, 1), True, device=DEVICE)
-        for pos in range(args.gamma):
-            target_token = target_tokens[:, pos]
-            draft_token = tokens_buffer[:, pos+1]
-            flag_accept = (target_token == draft_token).unsqueeze(1)
-            # Ensure flags remain False once they have been set to False
-            accept_flags = accept_flags & flag_accept
-            # Only increase accept_nums where accept_flags are still True
-            accept_nums += accept_flags.int()
-            # Wether or not terminate
-            condition = ((draft_token.unsqueeze(1) == eot_1) | (draft_token.unsqueeze(1) == eot_2)) & accept_flags
-            if condition.any():
+        if tree is not None:
+            path, accepted_tokens, accept_nums, bonus_tokens, sibling_accepted = verify_tree_greedy(tree, tree_tokens, target_tokens)
+            # stop at the first accepted end of text token
+            is_eot = ((accepted_tokens == eot_1) | (accepted_tokens == eot_2)) & (torch.arange(verify_gamma+1, device=DEVICE).view(1, -1) < accept_nums.view(-1, 1))
+            is_eot[:, 0] = False
+            if is_eot.any():
                 terminal = True
-            accept_flags = accept_flags & ~condition
-        
-        # Rollback the memory length
-        engine.cachelens = engine.cachelens - args.gamma - 1
+                accept_nums = torch.where(is_eot.any(dim=1), is_eot.int().argmax(dim=1) + 1, accept_nums)
+                bonus_tokens = target_tokens.gather(1, path.gather(1, accept_nums.view(-1, 1) - 1)).flatten()
+            accept_nums, bonus_tokens = accept_nums.view(-1, 1), bonus_tokens.view(-1, 1)
+            # the draft has only seen the chain, an accepted sibling is fed to it with the bonus token
+            draft_accept_nums = accept_nums - sibling_accepted.long().view(-1, 1)
+        else:
+            accept_nums = torch.full((BATCH_SIZE, 1), 1, device=DEVICE).long()
+            accept_flags = torch.full((BATCH_SIZE, 1), True, device=DEVICE)
+            for pos in range(verify_gamma):
+                draft_token = tokens_buffer[:, pos+1]
+                flag_accept = accept_matrix[:, pos].unsqueeze(1)
+                # Ensure flags remain False once they have been set to False
+                accept_flags = accept_flags & flag_accept
+                # Only increase accept_nums where accept_flags are still True
+                accept_nums += accept_flags.int()
+                # Wether or not terminate
+                condition = ((draft_token.unsqueeze(1) == eot_1) | (draft_token.unsqueeze(1) == eot_2)) & accept_flags
+                if condition.any():
+                    terminal = True
+                accept_flags = accept_flags & ~condition
+
+            # Rollback the memory length
+            engine.cachelens = engine.cachelens - verify_gamma - 1
+            accepted_tokens = tokens_buffer[:, :verify_gamma+1]
+            draft_accept_nums = accept_nums
+            bonus_tokens = target_tokens.gather(1, accept_nums - 1)
 
         # Put the accepted tokens to output
         positions = torch.arange(output.shape[1], device=DEVICE).view(1, -1).repeat(BATCH_SIZE, 1)
         mask = (positions < (engine.cachelens.view(-1,1) + accept_nums)) & (positions >= engine.cachelens.view(-1, 1))
-        positions_buffer = torch.arange(args.gamma+1, device=DEVICE).view(1, -1).repeat(BATCH_SIZE, 1)
+        positions_buffer = torch.arange(verify_gamma+1, device=DEVICE).view(1, -1).repeat(BATCH_SIZE, 1)
         mask_buffer = positions_buffer<accept_nums.view(-1,1)
-        output[mask] = tokens_buffer[mask_buffer]
+        output[mask] = accepted_tokens[mask_buffer]
 
         # Set the cache length to the accepted length
-        engine.cachelens += accept_nums.flatten()
-        max_limit = torch.full_like(accept_nums, args.gamma, device = DEVICE)
-        limited_accept_nums = torch.min(accept_nums, max_limit)
+        if tree is None:
+            engine.cachelens += accept_nums.flatten()
+        else:
+            engine.commit_tree_path(path, accept_nums.flatten())
+        max_limit = torch.full_like(accept_nums, draft_steps, device = DEVICE)
+        limited_accept_nums = torch.min(draft_accept_nums, max_limit)
         if not use_tp:
-            draft.cachelens = draft.cachelens - args.gamma
+            draft.cachelens = draft.cachelens - draft_steps
             draft.cachelens += limited_accept_nums.flatten()
         else:
             if rank in args.draft_ranks:
-                draft.cachelens = draft.cachelens - args.gamma
+                draft.cachelens = draft.cachelens - draft_steps
                 draft.cachelens += limited_accept_nums.flatten()
         
-        # Get the bonus tokens
-        indices = accept_nums - 1
-        bonus_tokens = target_tokens.gather(1, indices)
+        if controller is not None and verify_gamma > 0:
+            controller.update(gamma, accept_nums, draft_lens, draft_steps=draft_steps, draft_time=t2 - t1, target_time=t3 - t2)
+        if tracker is not None:
+            tracker.update(accept_nums, draft_lens)
+
+        # Check the bonus tokens
         if (bonus_tokens == 2).any() or (bonus_tokens == 0).any():
             terminal = True
         num_nodes += accept_nums.flatten()
 
         # Check Number of Nodes + Bonus Token <= max_target_token
-        if num_nodes.max() + 1 >= args.prefix_len + args.gen_len:
+        if (num_nodes - prompt_lens).max() + 1 >= args.gen_len:
             terminal = True
         # Put Bonus tokens to the tokens buffer, and prepare the variables for next itr
         if not terminal:
             tokens_buffer[:, :1] = bonus_tokens
-            if accept_nums.max() == args.gamma + 1:
+            # rows whose last accepted token was not drafted from (the last chain token or a sibling) feed it with the bonus token
+            mask = ((draft_accept_nums == draft_steps + 1) | (accept_nums > draft_accept_nums)).flatten()
+            if mask.any():
                 next_double = True
                 double_buffer = torch.zeros((BATCH_SIZE, 2), device=DEVICE).long()
-                mask = (accept_nums == (args.gamma + 1)).squeeze()
-                double_buffer[:, 0] = torch.where(mask, tokens_buffer[:, -1], bonus_tokens[:, 0])
+                last_tokens = accepted_tokens.gather(1, accept_nums - 1)[:, 0]
+                double_buffer[:, 0] = torch.where(mask, last_tokens, bonus_tokens[:, 0])
                 double_buffer[:, 1] = torch.where(mask, bonus_tokens[:, 0], torch.zeros_like(bonus_tokens[:, 0]))
-                non_zero_mask = double_buffer != 0
-                cachelens_update = non_zero_mask.sum(dim=1).flatten()
+                cachelens_update = 1 + mask.long()
         
         if not terminal:
             if benchmark:
-                torch.cuda.synchronize()
+                device_sync(DEVICE)
                 t4 = time.time()
                 verify_loop += t4-t3
         else:
@@ -275,18 +413,20 @@ for step, batch in tqdm(enumerate(dataloader), total=num_eval_steps):
                 output[i, num_nodes[i]] = bonus_tokens[i]
             num_nodes += 1
             if benchmark:
-                torch.cuda.synchronize()
+                device_sync(DEVICE)
                 t4 = time.time()
                 verify_loop += t4-t3
 
-    torch.cuda.synchronize()
+    device_sync(DEVICE)
     end=time.perf_counter()
     total_time += end-start
-    num_gen_tokens += (num_nodes.sum() - (input_ids.shape[1]+1)*BATCH_SIZE)
+    num_gen_tokens += (num_nodes - prompt_lens - 1).sum()
     if args.printoutput:
         for i in range(BATCH_SIZE):
-            print(tokenizer.decode(output[i, args.prefix_len:num_nodes[i]]))
-    print("total time :{:.5f}s, time per iter :{:.5f}s, decoding step: {}, large model step: {}".format(total_time, total_time / target_steps, num_gen_tokens, target_steps))
+            print(tokenizer.decode(output[i, prompt_lens[i]:num_nodes[i]]))
+    print("total time :{:.5f}s, time per iter :{:.5f}s, decoding step: {}, large model step: {}, mean accepted length: {:.3f}".format(total_time, total_time / target_steps, num_gen_tokens, target_steps, num_gen_tokens / target_steps / BATCH_SIZE))
+    if controller is not None:
+        print(controller)
     if benchmark:
         print("target time :{:.5f}s, draft time :{:.5f}s, verify loop : {}, avg generate len per sentence: {}".format(target_time/target_steps, draft_time / target_steps, verify_loop/target_steps, num_gen_tokens/target_steps/BATCH_SIZE))
     if step < 3:   # TODO: revert to 10?